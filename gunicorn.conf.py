@@ -0,0 +1,13 @@
+"""gunicorn configuration for the web process (see the Procfile)
+"""
+
+
+def post_worker_init(worker):
+    """start the observations listener in each web worker, once it has forked
+    and loaded the app. Threads don't survive a fork, so it can't be started
+    in the master (e.g., with --preload) or when Django sets up.
+    """
+    from django.conf import settings
+    if settings.OBSERVATION_LISTENER_ENABLED:
+        from trwwapi.rainfall.listeners import start_observations_listener
+        start_observations_listener()
@@ -0,0 +1,42 @@
+"""compression.py
+
+helpers for negotiating and applying HTTP response compression
+
+"""
+import re
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODING_BROTLI = 'br'
+ENCODING_GZIP = 'gzip'
+
+re_accepts_brotli = re.compile(r'\bbr\b')
+re_accepts_gzip = re.compile(r'\bgzip\b')
+
+
+def get_accepted_encoding(request):
+    """get the best content-encoding supported by both the client (per the 
+    request's Accept-Encoding header) and this server. Prefers brotli when the
+    brotli package is installed. Returns None if neither is accepted.
+    """
+    ae = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if brotli is not None and re_accepts_brotli.search(ae):
+        return ENCODING_BROTLI
+    if re_accepts_gzip.search(ae):
+        return ENCODING_GZIP
+    return None
+
+
+def compress_body(body, encoding):
+    """compress the bytes in body with the given encoding. Returns body as-is
+    if no (or an unsupported) encoding is provided.
+    """
+    if encoding == ENCODING_BROTLI and brotli is not None:
+        return brotli.compress(body, mode=brotli.MODE_TEXT, quality=5)
+    if encoding == ENCODING_GZIP:
+        return compress_string(body)
+    return body
@@ -70,10 +70,115 @@ F_ALL = F_MD + F_CSV + F_GEOJSON + F_JSON + F_ARRAYS
 
 MAX_RECORDS = 750000
 
+# seconds to cache the summary of latest observation timestamps
+LATEST_OBSERVATIONS_CACHE_TTL = 30
+# max seconds to keep an in-memory pixel index before rebuilding it
+PIXEL_INDEX_MAX_AGE = 60 * 60 * 24
+# Redis key holding the version of the pixels; bumped whenever they change, so
+# every process knows to rebuild its index
+PIXEL_INDEX_VERSION_KEY = "trwwapi:pixel-index-version"
+
+# windows (in hours) for which rolling rainfall totals are maintained, and how
+# stale (in minutes) those totals can get before we stop using them
+ROLLING_TOTAL_WINDOWS = [24, 48, 24 * 7]
+ROLLING_TOTAL_MAX_LAG = 60
+
+# number of observation records written per transaction by the ingestion tools
+INGEST_BATCH_SIZE = 1000
+
+# Postgres NOTIFY channel the observation table triggers publish to (see the
+# 0017_observation_notify_triggers migration), and seconds between checks for
+# notifications by the listener
+OBSERVATIONS_NOTIFY_CHANNEL = 'rainfall_observations'
+OBSERVATIONS_LISTEN_TIMEOUT = 5
+
+# rough calibration for the request cost planner: bytes per output record for 
+# each response format (plus geometry per sensor for geojson), and the number 
+# of records per second we can query and post-process
+PLANNER_BYTES_PER_RECORD = dict(json=75, geojson=75, csv=25, arrays=8)
+PLANNER_GEOMETRY_BYTES = 600
+PLANNER_RECORDS_PER_SECOND = 50000
+# requests estimated to take longer than this many seconds run on the large 
+# queue. This has to stay well under MAX_RECORDS / PLANNER_RECORDS_PER_SECOND
+# (15s), or every request big enough to go there is turned away first.
+PLANNER_LARGE_REQUEST_SECONDS = 5
+RAINFALL_DEFAULT_QUEUE = 'default'
+RAINFALL_LARGE_QUEUE = 'large'
+# seconds to cache the number of sensors for each observation model
+SENSOR_COUNT_CACHE_TTL = 60 * 60
+
 RAINWAYS_DEFAULT_CRS = 2272
 
+# seconds to wait for each stage of a Rainways analysis to complete, when run
+# in the request and when run as a queued job
+RAINWAYS_STAGE_TIMEOUT = 30
+RAINWAYS_JOB_STAGE_TIMEOUT = 300
+# AOIs larger than this (in square units of RAINWAYS_DEFAULT_CRS; here, one 
+# square mile) are analyzed as a queued job rather than in the request
+RAINWAYS_INLINE_MAX_AREA = 5280 ** 2
+RAINWAYS_QUEUE = 'default'
+# most features accepted by the batch AOI analysis endpoint, and the most that 
+# are analyzed in the request rather than as a queued job
+RAINWAYS_BATCH_MAX_FEATURES = 500
+RAINWAYS_BATCH_INLINE_MAX_FEATURES = 5
+# Rainways analysis results are cached by AOI geometry: coordinates are snapped 
+# to this tolerance (in units of RAINWAYS_DEFAULT_CRS) for the cache key, and 
+# results are kept for this many seconds. Bump the version to drop all cached 
+# results (e.g., after changing the analysis).
+RAINWAYS_RESULT_CACHE_TOLERANCE = 1
+RAINWAYS_RESULT_CACHE_TTL = 60 * 60 * 24
+RAINWAYS_RESULT_CACHE_VERSION = 1
+# seconds to wait on requests to external feature services
+RAINWAYS_REQUEST_TIMEOUT = 20
+# seconds to keep a raster open in each worker thread before reopening it (so 
+# that updates to the file are picked up)
+RAINWAYS_RASTER_HANDLE_MAX_AGE = 60 * 60
+
 RAINWAYS_RESOURCES = dict(
     sustain="https://services6.arcgis.com/dMKWX9NPCcfmaZl3/arcgis/rest/services/sustain2013_composite/FeatureServer/0/query",
     soils="https://services6.arcgis.com/dMKWX9NPCcfmaZl3/arcgis/rest/services/Rainways_TetraTech_NRCS_Soils/FeatureServer/0/query",
     slope="s3://3rww-rainways-data/rainways_3m_filled_slope_cog.tif"
-)
\ No newline at end of file
+)
+
+# raster layers summarized for Rainways analysis: the raster each is in, and 
+# its band. Layers in the same raster are read together. The elevation 
+# summary is included when an "elev" layer is listed here.
+# Layers with a value range can have summaries precomputed by grid cell (see 
+# the summarize_raster_cells command).
+RAINWAYS_RASTER_LAYERS = dict(
+    slope=dict(href=RAINWAYS_RESOURCES['slope'], band=1, range=(0, 90))
+)
+# percentiles and number of histogram bins in raster zonal statistics
+RAINWAYS_ZONAL_PERCENTILES = [10, 25, 50, 75, 90]
+RAINWAYS_ZONAL_HISTOGRAM_BINS = 10
+
+# grids that raster layer summaries are precomputed for, coarsest first: the 
+# rainfall pixels, and square cells of RAINWAYS_CELL_SIZE (in units of 
+# RAINWAYS_DEFAULT_CRS)
+RAINWAYS_CELL_GRIDS = ['pixel', 'cell']
+RAINWAYS_CELL_SIZE = 500
+# histogram bins (over each layer's range) kept for each cell; a multiple of
+# RAINWAYS_ZONAL_HISTOGRAM_BINS
+RAINWAYS_CELL_HISTOGRAM_BINS = 100
+# cells summarized per raster read when precomputing
+RAINWAYS_CELL_BATCH_SIZE = 250
+# AOIs (or AOI features) smaller than this area use exact clipping only
+RAINWAYS_CELL_SUMMARY_MIN_AREA = 4 * RAINWAYS_CELL_SIZE ** 2
+
+# feature layers in RAINWAYS_RESOURCES that can be mirrored locally (see the
+# mirror_rainways_layers command), and the field each is summarized by
+RAINWAYS_MIRRORED_LAYERS = dict(
+    soils='SOIL_HYDRO',
+    sustain='GI_Type'
+)
+# title of the Collection that mirrored layer Resources belong to
+RAINWAYS_MIRROR_COLLECTION = "Rainways mirrored layers"
+# features per request when mirroring a layer
+RAINWAYS_MIRROR_PAGE_SIZE = 1000
+
+# feature service queries for Rainways analysis are cached by tile: the width 
+# of each (square) tile in units of RAINWAYS_DEFAULT_CRS (feet), seconds to 
+# keep a tile, and the most tiles an AOI can span before we skip the cache
+RAINWAYS_FEATURE_TILE_SIZE = 5280
+RAINWAYS_FEATURE_TILE_TTL = 60 * 60 * 24
+RAINWAYS_FEATURE_TILE_MAX = 64
@@ -0,0 +1,50 @@
+"""middleware.py
+
+custom django middleware
+
+"""
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+from .compression import get_accepted_encoding, compress_body, ENCODING_BROTLI
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Compress responses with brotli if the client accepts it and the brotli
+    package is available, otherwise fall back to Django's gzip handling.
+
+    Responses that already have a Content-Encoding (e.g., pre-compressed 
+    cached job results) are passed through untouched.
+    """
+
+    def process_response(self, request, response):
+
+        # streaming responses and anything not going out as brotli are handled
+        # by the gzip middleware.
+        if response.streaming or get_accepted_encoding(request) != ENCODING_BROTLI:
+            return super().process_response(request, response)
+
+        # It's not worth attempting to compress really short responses.
+        if len(response.content) < 200:
+            return response
+
+        # Avoid compressing if we've already got a content-encoding.
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        # Return the compressed content only if it's actually shorter.
+        compressed_content = compress_body(response.content, ENCODING_BROTLI)
+        if len(compressed_content) >= len(response.content):
+            return response
+        response.content = compressed_content
+        response['Content-Length'] = str(len(response.content))
+
+        # make any strong ETag weak, as the gzip middleware does.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = ENCODING_BROTLI
+
+        return response
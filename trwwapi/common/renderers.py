@@ -0,0 +1,47 @@
+"""renderers.py
+
+custom renderers for the django-rest-framework
+
+"""
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """Renders JSON with orjson, if it is installed; otherwise falls back to 
+    DRF's JSONRenderer (which uses the stdlib json module).
+
+    orjson natively handles datetimes, dataclasses, and numpy types. Anything 
+    else it doesn't know about (e.g., Decimals, lazy strings) is handed off to 
+    DRF's JSONEncoder.
+    """
+
+    encoder = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+
+        if orjson is None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if data is None:
+            return b''
+
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            option |= orjson.OPT_INDENT_2
+
+        return orjson.dumps(data, default=self.encoder.default, option=option)
+
+
+def get_high_volume_renderer_classes():
+    """get the renderer classes for the high-volume API routes, as listed in 
+    the HIGH_VOLUME_RENDERER_CLASSES setting.
+    """
+    return [import_string(c) for c in settings.HIGH_VOLUME_RENDERER_CLASSES]
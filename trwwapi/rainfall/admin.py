@@ -5,7 +5,8 @@ from leaflet.admin import LeafletGeoAdmin
 from .models import (
     RainfallEvent,
     Pixel,
-    Gauge
+    Gauge,
+    IngestWatermark
 )
 
 # customize admin site info
@@ -17,9 +18,14 @@ class RainfallEventAdmin(admin.ModelAdmin):
     list_filter = ('start_dt', 'end_dt')
     search_fields = ['start_dt', 'end_dt', 'report_label', 'event_label']
 
+class IngestWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('table', 'watermark', 'rows_ingested', 'modified')
+    readonly_fields = ('table', 'watermark', 'rows_ingested', 'created', 'modified')
+
 for i in [
     [RainfallEvent, RainfallEventAdmin],
     [Pixel, LeafletGeoAdmin],
-    [Gauge, LeafletGeoAdmin]
+    [Gauge, LeafletGeoAdmin],
+    [IngestWatermark, IngestWatermarkAdmin]
 ]:
     admin.site.register(*i)
\ No newline at end of file
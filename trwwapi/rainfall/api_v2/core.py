@@ -5,6 +5,7 @@ from pathlib import PurePosixPath
 from datetime import datetime, timedelta
 from urllib.parse import parse_qs
 from collections import OrderedDict
+import json
 import pdb
 
 from dateutil.parser import parse
@@ -20,7 +21,7 @@ from django.db.models import Q
 
 
 from .models import RequestSchema, RainfallObservation, TableGARR15, TableGauge15, TableRTRR15
-from .utils import datetime_range, dt_parser
+from .utils import datetime_range, count_datetime_range, dt_parser
 from ...common.config import (
 #from .config import (
     DATA_DIR,
@@ -45,7 +46,9 @@ from ...common.config import (
     F_MD,
     F_ALL,
     F_ARRAYS,
-    MIN_INTERVAL
+    MIN_INTERVAL,
+    STATUS_CALIBRATED,
+    STATUS_REALTIME
 )
 
 from ..serializers import RainfallQueryResultSerializer
@@ -257,7 +260,7 @@ def parse_datetime_args(start_dt, end_dt, interval=None, delta=15):
     #         timedelta(minutes=delta)
     #     )
     # ]
-    interval_count = len([i for i in datetime_range(start_dt, end_dt, timedelta(minutes=delta))])
+    interval_count = count_datetime_range(start_dt, end_dt, timedelta(minutes=delta))
     # print(len(dts), "datetimes to be queried")
     # return dts
     return [start_dt, end_dt], interval_count
@@ -388,6 +391,75 @@ def _postprocess_pg_response(postgres_table_model, queryset, timezone=TZ):
 
     return rows        
 
+def _build_best_available_query(calibrated_tablename, provisional_tablename, all_datetimes, watermark, sensor_ids=None):
+    """builds a single query that splices calibrated data (through its 
+    watermark) and provisional data (after it), with each row's `tier`.
+    """
+
+    tier_query = """
+        select 
+            q1.timestamp as ts,
+            (q1.data->>'key')::text as id,
+            (q1.data->'value'->>0)::float as val,
+            (q1.data->'value'->>1)::text as src,
+            %s as tier
+        from (
+            select 
+                id, 
+                timestamp, 
+                row_to_json(jsonb_each(data))::jsonb 
+            as data from {0} rg 
+            where (timestamp >= %s and timestamp <= %s){1}
+        ) q1
+    """
+
+    query = """
+        select * from (
+            {0}
+            union all
+            {1}
+        ) q2 {2} order by ts
+    """.format(
+        tier_query.format(calibrated_tablename, ""),
+        # provisional data only fills in after the calibrated data ends
+        tier_query.format(provisional_tablename, " and timestamp > coalesce(%s, '-infinity'::timestamptz)"),
+        "where id in %s" if sensor_ids else ""
+    )
+
+    query_params = [
+        STATUS_CALIBRATED, all_datetimes[0], all_datetimes[-1],
+        STATUS_REALTIME, all_datetimes[0], all_datetimes[-1], watermark
+    ]
+    if sensor_ids:
+        query_params.append(tuple(sensor_ids))
+
+    return query, query_params
+
+@Timer(name="query_pgdb_best_available", text="{name}: {:.4f}s")
+def query_pgdb_best_available(calibrated_model, provisional_model, sensor_ids, all_datetimes, watermark, timezone=TZ):
+    """query calibrated data where available and provisional data after the 
+    calibrated watermark, in one query. Rows are the same as `query_pgdb`'s 
+    plus a `tier` (calibrated or realtime).
+    """
+    query, query_params = _build_best_available_query(
+        calibrated_model._meta.db_table,
+        provisional_model._meta.db_table,
+        all_datetimes,
+        watermark,
+        sensor_ids
+    )
+    queryset = _query_pgdb(calibrated_model, query, query_params)
+    return [
+        dict(
+            ts=r.ts.astimezone(timezone).isoformat(),
+            id=str(r.id),
+            val=r.val,
+            src=r.src,
+            tier=r.tier
+        )
+        for r in queryset
+    ]
+
 # @retry(stop=(stop_after_attempt(5) | stop_after_delay(60)), wait=wait_random_exponential(multiplier=2, max=30), reraise=True)
 @Timer(name="query_pgdb", text="{name}: {:.4f}s")
 def query_pgdb(postgres_table_model, sensor_ids, all_datetimes, timezone=TZ):
@@ -471,6 +543,11 @@ def _minmax(i):
 
     return "{0}/{1}".format(start_dt, end_dt)
 
+def _has_tiers(query_results):
+    """are these results from the best-available query, with a tier per row?
+    """
+    return bool(query_results) and 'tier' in query_results[0]
+
 @Timer(name="aggregate_results_by_interval", text="{name}: {:.4f}s")
 def aggregate_results_by_interval(query_results, rollup):
     """aggregate the values in the query results based on the rollup args
@@ -495,6 +572,8 @@ def aggregate_results_by_interval(query_results, rollup):
             val=('val', _sumround), # sum the rainfall vales
             src=('src', _listset) # create a list of all rainfall sources included in the rollup
         )
+        if _has_tiers(query_results):
+            petl_aggs['tier'] = ('tier', _listset)
 
         t = etl\
             .fromdicts(query_results)\
@@ -536,6 +615,8 @@ def aggregate_results_by_interval(query_results, rollup):
             src=('src', _listset), # create a list of all rainfall sources included in the rollup
             ts=('ts', _minmax) # create a iso datetime range string from the min and max datetimes found
         )
+        if _has_tiers(query_results):
+            petl_aggs['tier'] = ('tier', _listset)
 
         t = etl\
             .fromdicts(query_results)\
@@ -583,51 +664,51 @@ def apply_zerofill(transformed_results, zerofill, dts):
             # return an empty table
             return [{k: None for k in RAINFALL_BASE_MODEL_REF.get_attributes().keys()}]
 
-def _format_as_geojson(results, geodata_model):
-    """joins the results to the corresponding geojson via the Django model.
+# the field that holds the sensor id, for each of the sensor geodata models
+GEOMODEL_ID_FIELDS = dict(Pixel='pixel_id', Gauge='web_id')
 
-    :param results: [description]
-    :type results: [type]
-    :param geodata_model: [description]
-    :type geodata_model: [type]
-    :return: [description]
-    :rtype: [type]
+def _get_sensor_geometries(geodata_model):
+    """the geometry of each sensor, as GeoJSON, by sensor id
     """
+    id_field = GEOMODEL_ID_FIELDS[geodata_model._meta.object_name]
+    return {
+        str(sensor_id): json.loads(geom.geojson)
+        for sensor_id, geom in geodata_model.objects.values_list(id_field, 'geom')
+        if geom is not None
+    }
 
-    # read the geojson into a PETL table object
-    # features_table = etl.fromdicts(fc.features).convert('id', str)
-
-    df = geodata_model.as_dataframe_using_drf_serializer(geodata_model.objects.all())
-
-    t = etl.fromdataframe(df)
-
-    # join the results to the geojson features, then shoehorn the results into the properties object of each feature
-    # put the ID into the id property of the feature
-    features = etl\
-        .fromdicts(results)\
-        .leftjoin(features_table, 'id')\
-        .sort(('ts', 'id'))\
-        .aggregate(key=('id', 'type', 'geometry'), aggregation=list, value=['src', 'val', 'ts'])\
-        .fieldmap(
-            {
-                'id':'id',
-                'type':'type',
-                'geometry':'geometry',
-                'properties': lambda rec: (
-                    dict(
-                        data=[dict(src=r[0],val=r[1],ts=r[2]) for r in rec.value],
-                        total=sum([r[1] for r in rec.value if r[1]])
-                    )
-                )
-            },
-            failonerror=True
-        ).dicts()
-
-    return geojson.FeatureCollection(features=list(features))
+def _format_as_geojson(results, geodata_model):
+    """joins the results to the corresponding sensor geometries via the Django
+    model: one feature per sensor, with its results (including any `tier`, for
+    best-available results) under `data` in the properties, and their total.
+
+    :param results: results grouped by sensor id (see `_groupby`)
+    :type results: list
+    :param geodata_model: Pixel or Gauge
+    :type geodata_model: PandasModelMixin
+    :return: a feature collection
+    :rtype: geojson.FeatureCollection
+    """
+    geometries = _get_sensor_geometries(geodata_model)
+
+    features = [
+        geojson.Feature(
+            id=r['id'],
+            geometry=geometries.get(str(r['id'])),
+            properties=dict(
+                data=r['data'],
+                total=sum([d['val'] for d in r['data'] if d.get('val')])
+            )
+        )
+        for r in results
+    ]
+
+    return geojson.FeatureCollection(features=features)
 
 def _format_teragon(results):
     """convert the query results (an array of dictionaries) to a cross-tab
-    with a metadata column for data source
+    with a metadata column for data source (and for the tier, for 
+    best-available results)
 
     TODO: this uses both PETL and Pandas to achieve the desired results; 
     pick one or the other
@@ -639,6 +720,7 @@ def _format_teragon(results):
     t2 = etl\
         .melt(t, key=['ts', 'id'])\
         .convert('id', lambda v: "{}-src".format(v), where=lambda r: r.variable == 'src')\
+        .convert('id', lambda v: "{}-tier".format(v), where=lambda r: r.variable == 'tier')\
         .convert('value', float, where=lambda r: r.variable == 'val')\
         .cutout('variable')\
         .sort(['ts', 'id'])
@@ -662,6 +744,33 @@ def _format_teragon(results):
     #return etl.fromdataframe(df2, include_index=True).rename('index', 'timestamp
     return df2.to_csv()
 
+def _format_as_arrays(results):
+    """convert the query results (an array of dictionaries) to a dense matrix:
+    a list of sensor ids, a list of timestamps, and a 2D array of values with 
+    one row per timestamp and one column per sensor id. No-data values (and 
+    any timestamp/sensor combinations missing from the results) are None.
+
+    The matrix is filled in a single pass over the results, so this avoids the 
+    intermediate tables used by the other formats.
+    """
+    ids = sorted(set(r['id'] for r in results if r['id'] is not None))
+    timestamps = sorted(set(r['ts'] for r in results if r['ts'] is not None))
+
+    columns = {v: i for i, v in enumerate(ids)}
+    rows = {v: i for i, v in enumerate(timestamps)}
+
+    values = [[None] * len(ids) for _ in timestamps]
+    for r in results:
+        if r['id'] is None or r['ts'] is None:
+            continue
+        values[rows[r['ts']]][columns[r['id']]] = r['val']
+
+    return dict(
+        ids=ids,
+        timestamps=timestamps,
+        values=values
+    )
+
 def _groupby(results, key='ts', sortby='id'):
 
     key_by_these = sorted(list(set(map((lambda r: r[key]), results))))
@@ -720,12 +829,9 @@ def format_results(results, f, geodata_model):
         results = _groupby(results, key='id', sortby='ts')
         return _format_as_geojson(results, geodata_model)
 
-    # ARRAYS format (2D table)
+    # ARRAYS format (dense matrix)
     elif f in F_ARRAYS:
-        # nested arrays
-        t = etl.fromdicts(results)
-        h = list(etl.header(t))
-        return list(etl.data(t)).insert(0,h)
+        return _format_as_arrays(results)
 
     elif f in F_CSV:
         return _format_teragon(results)
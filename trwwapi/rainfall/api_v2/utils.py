@@ -35,8 +35,31 @@ def datetime_range(dt_start, dt_end, delta):
             yield current
             current += delta
 
+def count_datetime_range(dt_start, dt_end, delta):
+    """the number of datetimes `datetime_range` would yield for the same args,
+    computed without enumerating them.
+    """
+    if dt_start == dt_end:
+        return 1
+    if dt_start > dt_end:
+        return 0
+    # ceiling division of the timedeltas
+    return -((dt_start - dt_end) // delta)
+
 def datetime_encoder(obj):
-    return json.loads(json.dumps(obj, cls=DatetimeStringEncoder))
+    """return a copy of obj where any datetime objects, at any depth within 
+    dicts, lists, and tuples, are converted to ISO-formatted datetime strings.
+
+    This walks the object directly rather than round-tripping it through the 
+    json module.
+    """
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, dict):
+        return {k: datetime_encoder(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [datetime_encoder(v) for v in obj]
+    return obj
 
 class DatetimeStringEncoder(json.JSONEncoder):
     """use to convert any values in a dict stored as datetime objects
@@ -49,4 +49,45 @@ def query_one_sensor_rollup_monthly(postgres_table_model, all_datetimes, sensor_
         for r in queryset
     ]
 
-    return rows
\ No newline at end of file
+    return rows
+
+def query_sensors_rollup_monthly(postgres_table_model, all_datetimes, sensor_ids):
+    """Builds the rainfall SQL for monthly totals for several sensors over a 
+    datetime range, in one query. 
+    """
+
+    tablename = postgres_table_model.objects.model._meta.db_table
+    
+    query = """
+        SELECT
+            s.id,
+            date_trunc('month', rr.timestamp) as ts,
+            sum((rr.data->s.id->0)::float) as val
+        from {0} rr
+        cross join unnest(%s::text[]) as s(id)
+        where (rr.timestamp >= %s and rr.timestamp <= %s)
+        group by s.id, ts
+        order by s.id, ts;
+    """.format(
+        tablename
+    )
+
+    query_params = [
+        [str(i) for i in sensor_ids],
+        all_datetimes[0],
+        all_datetimes[-1],
+    ]
+
+    queryset = postgres_table_model.objects.raw(query, query_params).iterator()
+
+    rows = [
+        dict(
+            ts=r.ts.astimezone(TZ).isoformat(),
+            id=str(r.id),
+            val=r.val,
+            src=""
+        )
+        for r in queryset
+    ]
+
+    return rows
@@ -5,3 +5,8 @@ class RainfallConfig(AppConfig):
     name = 'trwwapi.rainfall'
     label = 'rainfall'
     verbose_name = '3RWW Rainfall API'
+
+    def ready(self):
+        # the observations listener is started in the web workers (see 
+        # gunicorn.conf.py), not here
+        from . import signals
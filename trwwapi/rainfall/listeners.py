@@ -0,0 +1,107 @@
+"""listens for the notifications sent by the observation table triggers when
+rows are inserted or updated (however they got there: the ingestion service,
+the external pipeline, or by hand), and keeps this process's caches in step.
+The triggers advance the ingestion watermarks themselves.
+"""
+
+import json
+import logging
+import select
+import threading
+
+from dateutil.parser import parse
+from django.db import connection
+
+from ..common.config import OBSERVATIONS_NOTIFY_CHANNEL, OBSERVATIONS_LISTEN_TIMEOUT
+from .models import OBSERVATION_MODEL_LOOKUP
+from .selectors import invalidate_latest_observation_timestamps
+
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait before reconnecting after losing the database connection
+RECONNECT_DELAY = 30
+
+TABLE_TO_MODEL_LOOKUP = {
+    m._meta.db_table: m for m in OBSERVATION_MODEL_LOOKUP.values()
+}
+
+
+def handle_observations_notification(payload):
+    """act on a notification from the observation table triggers: clear this
+    process's cached summary of latest timestamps (which the conditional 
+    request ETags are derived from).
+
+    :param payload: JSON with table, op, start_dt, end_dt and rows
+    :type payload: str
+    """
+    notice = json.loads(payload)
+    model_class = TABLE_TO_MODEL_LOOKUP.get(notice['table'])
+    if model_class is None:
+        return
+
+    start_dt, end_dt = parse(notice['start_dt']), parse(notice['end_dt'])
+
+    invalidate_latest_observation_timestamps()
+
+    logger.debug("{0} {1} rows ({2} to {3})".format(
+        notice['table'], notice['rows'], start_dt, end_dt
+    ))
+
+
+class ObservationsListener(threading.Thread):
+    """background thread that LISTENs on the observations channel with its
+    own database connection, and handles notifications as they arrive.
+    """
+
+    def __init__(self, channel=OBSERVATIONS_NOTIFY_CHANNEL, timeout=OBSERVATIONS_LISTEN_TIMEOUT):
+        super().__init__(name="observations-listener", daemon=True)
+        self.channel = channel
+        self.timeout = timeout
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _listen(self):
+        # Django connections are per-thread, so this one is ours. Django
+        # runs in autocommit mode, so LISTEN takes effect immediately.
+        connection.ensure_connection()
+        with connection.cursor() as cursor:
+            cursor.execute("LISTEN {0}".format(self.channel))
+        pg_conn = connection.connection
+
+        while not self._stopped.is_set():
+            if select.select([pg_conn], [], [], self.timeout) == ([], [], []):
+                continue
+            pg_conn.poll()
+            while pg_conn.notifies:
+                notify = pg_conn.notifies.pop(0)
+                try:
+                    handle_observations_notification(notify.payload)
+                except Exception:
+                    logger.exception("Failed to handle observations notification: {0}".format(notify.payload))
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Observations listener lost its connection; reconnecting")
+                connection.close()
+                self._stopped.wait(RECONNECT_DELAY)
+        connection.close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+def start_observations_listener():
+    """start the listener for this process, if it isn't already running.
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            _listener = ObservationsListener()
+            _listener.start()
+    return _listener
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from time import perf_counter
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ...models import OBSERVATION_MODEL_LOOKUP
+from ...services import ingest_observations, observation_records_from_frame
+
+
+def _read_frame(path):
+    if path.suffix.lower() in ['.parquet', '.pq']:
+        # requires pyarrow or fastparquet
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def _chunks(records, size):
+    for i in range(0, len(records), size):
+        yield records[i:i + size]
+
+
+class Command(BaseCommand):
+    help = """Load historic observations from local CSV or Parquet exports in the
+    pipeline's long format (Timestamp, SID, Rainfall (in), Source), e.g., to
+    reload calibrated data. Files are converted to per-timestamp records and
+    loaded in parallel chunks through the ingestion service.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', choices=OBSERVATION_MODEL_LOOKUP.keys())
+        parser.add_argument('paths', nargs='+', help="CSV or Parquet files, or directories of them")
+        parser.add_argument('--workers', type=int, default=4, help="Number of chunks to load at once")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Timestamps per chunk")
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help='Replace the data for existing timestamps instead of merging into it'
+        )
+
+    def _files(self, paths):
+        for p in map(Path, paths):
+            if p.is_dir():
+                yield from sorted(f for f in p.iterdir() if f.suffix.lower() in ['.csv', '.parquet', '.pq'])
+            elif p.exists():
+                yield p
+            else:
+                raise CommandError("{0} does not exist".format(p))
+
+    def _load_chunk(self, model, records, merge):
+        # each worker thread gets its own connection; don't leave it open
+        try:
+            return ingest_observations(model, records, merge=merge)
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        model = OBSERVATION_MODEL_LOOKUP[options['source']]
+        merge = not options['replace']
+
+        rows = 0
+        started = perf_counter()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for path in self._files(options['paths']):
+                try:
+                    records = observation_records_from_frame(_read_frame(path))
+                except (ValueError, ImportError) as e:
+                    raise CommandError("{0}: {1}".format(path, e))
+                self.stdout.write("{0}: {1} timestamps".format(path.name, len(records)))
+
+                futures = [
+                    executor.submit(self._load_chunk, model, chunk, merge)
+                    for chunk in _chunks(records, options['chunk_size'])
+                ]
+                for future in as_completed(futures):
+                    result = future.result()
+                    rows += result.rows
+                    elapsed = perf_counter() - started
+                    self.stdout.write("  {0} rows loaded through {1} ({2:.0f} rows/s)".format(
+                        rows, result.end_dt, rows / elapsed if elapsed else 0
+                    ))
+
+        elapsed = perf_counter() - started
+        self.stdout.write(self.style.SUCCESS("Loaded {0} rows into {1} in {2:.1f}s".format(
+            rows, model._meta.object_name, elapsed
+        )))
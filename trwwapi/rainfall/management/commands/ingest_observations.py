@@ -0,0 +1,67 @@
+import json
+import sys
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ....common.config import INGEST_BATCH_SIZE
+from ...models import OBSERVATION_MODEL_LOOKUP
+from ...services import ingest_observations
+
+
+def _read_records(f):
+    """read observation records from a file containing either a JSON array
+    or JSON lines (one record per line)
+    """
+    first = f.read(1)
+    while first and first.isspace():
+        first = f.read(1)
+    if first == '[':
+        yield from json.loads(first + f.read())
+    elif first:
+        yield json.loads(first + f.readline())
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _batched(iterable, size):
+    it = iter(iterable)
+    batch = list(islice(it, size))
+    while batch:
+        yield batch
+        batch = list(islice(it, size))
+
+
+class Command(BaseCommand):
+    help = "Upsert observation records ({timestamp, data} objects, as a JSON array or JSON lines) into an observation table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', choices=OBSERVATION_MODEL_LOOKUP.keys())
+        parser.add_argument('path', help="Path to the records file, or - to read from stdin")
+        parser.add_argument(
+            '--replace',
+            action='store_true',
+            help='Replace the data for existing timestamps instead of merging into it'
+        )
+        parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        model = OBSERVATION_MODEL_LOOKUP[options['source']]
+
+        if options['path'] == '-':
+            f = sys.stdin
+        else:
+            try:
+                f = open(options['path'])
+            except OSError as e:
+                raise CommandError(e)
+
+        rows = 0
+        with f:
+            for batch in _batched(_read_records(f), options['batch_size']):
+                result = ingest_observations(model, batch, merge=not options['replace'])
+                rows += result.rows
+                self.stdout.write("{0} rows through {1}".format(rows, result.end_dt))
+
+        self.stdout.write(self.style.SUCCESS("Ingested {0} rows into {1}".format(rows, model._meta.object_name)))
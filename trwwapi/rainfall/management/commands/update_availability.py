@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ...models import OBSERVATION_MODEL_LOOKUP
+from ...services import update_sensor_availability
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-sensor availability index for observation tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'sources',
+            nargs='*',
+            choices=list(OBSERVATION_MODEL_LOOKUP.keys()),
+            help="Sources to rebuild (defaults to all of them)"
+        )
+
+    def handle(self, *args, **options):
+        for source in options['sources'] or OBSERVATION_MODEL_LOOKUP.keys():
+            model = OBSERVATION_MODEL_LOOKUP[source]
+            written = update_sensor_availability(model)
+            self.stdout.write("{0}: {1} sensor-months".format(model._meta.object_name, written))
+        self.stdout.write(self.style.SUCCESS("Availability index rebuilt"))
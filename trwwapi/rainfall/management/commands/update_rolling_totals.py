@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ...services import update_rtrr_rolling_totals
+
+
+class Command(BaseCommand):
+    help = "Bring the rolling-window RTRR rainfall totals up to the latest observation"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Recompute every window from scratch instead of updating incrementally'
+        )
+
+    def handle(self, *args, **options):
+        end_dt = update_rtrr_rolling_totals(full=options['full'])
+        if end_dt is None:
+            self.stdout.write("No RTRR observations; nothing to do.")
+        else:
+            self.stdout.write(self.style.SUCCESS("Rolling totals updated through {0}".format(end_dt)))
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainfall', '0013_rainfallreport'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rainfallevent',
+            name='end_dt',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
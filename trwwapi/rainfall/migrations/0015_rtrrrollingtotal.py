@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainfall', '0014_rainfallevent_end_dt_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RtrrRollingTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sensor_id', models.CharField(max_length=12)),
+                ('window_hours', models.IntegerField()),
+                ('total', models.FloatField()),
+                ('end_dt', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rtrrrollingtotal',
+            constraint=models.UniqueConstraint(fields=('sensor_id', 'window_hours'), name='rtrrrollingtotal_uniq_sensor_window_constraint'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:45
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainfall', '0015_rtrrrollingtotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('modified', models.DateTimeField(default=django.utils.timezone.now)),
+                ('table', models.CharField(max_length=64, unique=True)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('rows_ingested', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
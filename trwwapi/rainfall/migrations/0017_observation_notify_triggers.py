@@ -0,0 +1,67 @@
+from django.db import migrations
+
+
+# keep in sync with OBSERVATIONS_NOTIFY_CHANNEL in common/config.py
+CHANNEL = 'rainfall_observations'
+
+TABLES = [
+    'rainfall_garrobservation',
+    'rainfall_gaugeobservation',
+    'rainfall_rtrrobservation',
+    'rainfall_rtrgobservation',
+]
+
+# statement-level, so a batch of rows results in one notification, with the
+# extent of the timestamps that were written
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION rainfall_notify_observations() RETURNS trigger AS $$
+DECLARE
+    extent record;
+BEGIN
+    SELECT min(timestamp) AS start_dt, max(timestamp) AS end_dt, count(*) AS n
+    INTO extent FROM changed_rows;
+    IF extent.n > 0 THEN
+        PERFORM pg_notify(TG_ARGV[0], json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'start_dt', extent.start_dt,
+            'end_dt', extent.end_dt,
+            'rows', extent.n
+        )::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+DROP_FUNCTION = "DROP FUNCTION IF EXISTS rainfall_notify_observations();"
+
+# transition tables can't be used with multi-event triggers, so there is one
+# trigger per event
+CREATE_TRIGGER = """
+CREATE TRIGGER {table}_notify_{op} AFTER {op} ON {table}
+REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE rainfall_notify_observations('{channel}');
+"""
+
+DROP_TRIGGER = "DROP TRIGGER IF EXISTS {table}_notify_{op} ON {table};"
+
+
+def _trigger_sql(template):
+    return [
+        template.format(table=table, op=op, channel=CHANNEL)
+        for table in TABLES
+        for op in ['insert', 'update']
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainfall', '0016_ingestwatermark'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_FUNCTION, DROP_FUNCTION),
+        migrations.RunSQL(_trigger_sql(CREATE_TRIGGER), _trigger_sql(DROP_TRIGGER)),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainfall', '0017_observation_notify_triggers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorAvailability',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(max_length=64)),
+                ('sensor_id', models.CharField(max_length=12)),
+                ('month', models.DateField()),
+                ('first_dt', models.DateTimeField()),
+                ('last_dt', models.DateTimeField()),
+                ('intervals', models.IntegerField(default=0)),
+                ('nodata_intervals', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['table', 'sensor_id', 'month'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='sensoravailability',
+            constraint=models.UniqueConstraint(fields=('table', 'sensor_id', 'month'), name='sensoravailability_uniq_table_sensor_month_constraint'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+from importlib import import_module
+
+from django.db import migrations
+
+notify_triggers = import_module('trwwapi.rainfall.migrations.0017_observation_notify_triggers')
+
+
+# the IngestWatermark for each table is keyed by the model name
+TABLES = {
+    'rainfall_garrobservation': 'GarrObservation',
+    'rainfall_gaugeobservation': 'GaugeObservation',
+    'rainfall_rtrrobservation': 'RtrrObservation',
+    'rainfall_rtrgobservation': 'RtrgObservation',
+}
+
+# the triggers now also advance the table's watermark, once per statement and
+# in the writer's transaction, whatever wrote the rows. The listeners in the
+# web processes only need to clear their caches.
+CREATE_FUNCTION = """
+CREATE OR REPLACE FUNCTION rainfall_notify_observations() RETURNS trigger AS $$
+DECLARE
+    extent record;
+BEGIN
+    SELECT min(timestamp) AS start_dt, max(timestamp) AS end_dt, count(*) AS n
+    INTO extent FROM changed_rows;
+    IF extent.n > 0 THEN
+        INSERT INTO rainfall_ingestwatermark ("table", watermark, rows_ingested, created, modified)
+        VALUES (TG_ARGV[1], extent.end_dt, extent.n, now(), now())
+        ON CONFLICT ("table") DO UPDATE SET
+            watermark = GREATEST(rainfall_ingestwatermark.watermark, EXCLUDED.watermark),
+            rows_ingested = rainfall_ingestwatermark.rows_ingested + EXCLUDED.rows_ingested,
+            modified = EXCLUDED.modified;
+        PERFORM pg_notify(TG_ARGV[0], json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'start_dt', extent.start_dt,
+            'end_dt', extent.end_dt,
+            'rows', extent.n
+        )::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+CREATE_TRIGGER = """
+CREATE TRIGGER {table}_notify_{op} AFTER {op} ON {table}
+REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT EXECUTE PROCEDURE rainfall_notify_observations('{channel}', '{model}');
+"""
+
+
+def _trigger_sql(template):
+    return [
+        template.format(table=table, op=op, channel=notify_triggers.CHANNEL, model=model)
+        for table, model in TABLES.items()
+        for op in ['insert', 'update']
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainfall', '0018_sensoravailability'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            _trigger_sql(notify_triggers.DROP_TRIGGER),
+            notify_triggers._trigger_sql(notify_triggers.CREATE_TRIGGER)
+        ),
+        migrations.RunSQL(CREATE_FUNCTION, notify_triggers.CREATE_FUNCTION),
+        migrations.RunSQL(
+            _trigger_sql(CREATE_TRIGGER),
+            _trigger_sql(notify_triggers.DROP_TRIGGER)
+        ),
+    ]
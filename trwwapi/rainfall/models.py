@@ -75,7 +75,7 @@ class RainfallEvent(PandasModelMixin, TimestampedMixin):
     report_label = models.CharField(max_length=255)
     event_label = models.CharField(max_length=255)
     start_dt = models.DateTimeField()
-    end_dt = models.DateTimeField()
+    end_dt = models.DateTimeField(db_index=True)
     # TODO: add a report_document relate field for access to a report model w/ the PDFs
 
     @property
@@ -96,6 +96,71 @@ class RainfallEvent(PandasModelMixin, TimestampedMixin):
 
 
 
+class RtrrRollingTotal(models.Model):
+    """Rolling-window rainfall totals for each real-time radar pixel, for each
+    of the standard windows (ROLLING_TOTAL_WINDOWS, in hours). Each record is 
+    the total for the window ending at `end_dt`, which is the latest RTRR 
+    observation included.
+
+    These are maintained incrementally as new RTRR observations arrive (see 
+    `services.update_rtrr_rolling_totals`), so that totals for the standard 
+    windows are a single indexed lookup.
+    """
+
+    sensor_id = models.CharField(max_length=12)
+    window_hours = models.IntegerField()
+    total = models.FloatField()
+    end_dt = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['sensor_id', 'window_hours'], name='%(class)s_uniq_sensor_window_constraint')
+        ]
+
+    def __str__(self):
+        return "{0} ({1}h to {2})".format(self.sensor_id, self.window_hours, self.end_dt)
+
+
+class IngestWatermark(TimestampedMixin):
+    """Tracks ingestion into each of the observation tables: the latest 
+    observation timestamp ingested (the high-water mark), and a running count 
+    of rows written. `modified` is when the table last received data.
+    """
+
+    table = models.CharField(max_length=64, unique=True)
+    watermark = models.DateTimeField(null=True, blank=True)
+    rows_ingested = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "{0} ({1})".format(self.table, self.watermark)
+
+
+class SensorAvailability(models.Model):
+    """Monthly summary of the observations available for each sensor in each 
+    observation table: the first and last observation in the month, how many 
+    intervals have records, and how many of those are N/D. Months are in local
+    time. Maintained incrementally as observations are ingested (see 
+    `services.update_sensor_availability`).
+    """
+
+    table = models.CharField(max_length=64)
+    sensor_id = models.CharField(max_length=12)
+    month = models.DateField()
+    first_dt = models.DateTimeField()
+    last_dt = models.DateTimeField()
+    intervals = models.IntegerField(default=0)
+    nodata_intervals = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['table', 'sensor_id', 'month']
+        constraints = [
+            UniqueConstraint(fields=['table', 'sensor_id', 'month'], name='%(class)s_uniq_table_sensor_month_constraint')
+        ]
+
+    def __str__(self):
+        return "{0} {1} ({2:%Y-%m})".format(self.table, self.sensor_id, self.month)
+
+
 # TODO: create a class for managing and validating the contents of 
 # the RainfallObservationMeta data and metadata fields
 # @dataclass
@@ -134,4 +199,12 @@ MODELNAME_TO_GEOMODEL_LOOKUP = {
     RtrrObservation._meta.object_name: Pixel,
     GaugeObservation._meta.object_name: Gauge,
     RtrgObservation._meta.object_name: Gauge
+}
+
+# short names for the observation models, used by the ingestion tools
+OBSERVATION_MODEL_LOOKUP = {
+    'garr': GarrObservation,
+    'gauge': GaugeObservation,
+    'rtrr': RtrrObservation,
+    'rtrg': RtrgObservation
 }
\ No newline at end of file
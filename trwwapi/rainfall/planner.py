@@ -0,0 +1,136 @@
+"""estimates the cost of a request to the high-level rainfall API before any
+data is queried: how many records it touches, how big the response will be,
+and how long it will take. The estimate drives the size valve, which queue the
+job runs on, and is reported in the response meta.
+"""
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List
+
+from django.core.cache import cache
+
+from ..common.config import (
+    DELIMITER,
+    INTERVAL_HOURLY,
+    INTERVAL_DAILY,
+    INTERVAL_MONTHLY,
+    INTERVAL_SUM,
+    F_CSV,
+    F_GEOJSON,
+    F_ARRAYS,
+    PLANNER_BYTES_PER_RECORD,
+    PLANNER_GEOMETRY_BYTES,
+    PLANNER_RECORDS_PER_SECOND,
+    PLANNER_LARGE_REQUEST_SECONDS,
+    RAINFALL_DEFAULT_QUEUE,
+    RAINFALL_LARGE_QUEUE,
+    SENSOR_COUNT_CACHE_TTL
+)
+from .api_v2.core import parse_datetime_args
+from .api_v2.utils import count_datetime_range
+from .models import MODELNAME_TO_GEOMODEL_LOOKUP
+
+
+@dataclass
+class RequestPlan:
+    # the datetime range after adjusting for the rollup, and requested sensors
+    start_dt: datetime
+    end_dt: datetime
+    sensor_ids: List[str] = field(default_factory=list)
+    # 15-minute intervals in the range
+    interval_count: int = 0
+    # sensors included: those requested, or all of them for the model
+    sensor_count: int = 0
+    # records read from the database, and returned after the rollup
+    record_count: int = 0
+    output_records: int = 0
+    estimated_bytes: int = 0
+    estimated_seconds: float = 0
+    queue: str = RAINFALL_DEFAULT_QUEUE
+
+    def as_meta(self):
+        return dict(
+            intervals=self.interval_count,
+            sensors=self.sensor_count,
+            records_queried=self.record_count,
+            estimated_bytes=self.estimated_bytes,
+            estimated_seconds=round(self.estimated_seconds, 2),
+            queue=self.queue
+        )
+
+
+def get_sensor_count(model_class):
+    """number of sensors (pixels or gauges) for an observation model; cached.
+    """
+    geomodel = MODELNAME_TO_GEOMODEL_LOOKUP[model_class._meta.object_name]
+    return cache.get_or_set(
+        "trwwapi:sensor-count:{0}".format(geomodel._meta.object_name),
+        geomodel.objects.count,
+        SENSOR_COUNT_CACHE_TTL
+    )
+
+
+def count_output_intervals(start_dt, end_dt, rollup, interval_count):
+    """number of intervals per sensor in the response after the rollup
+    """
+    if rollup == INTERVAL_SUM:
+        return 1
+    if rollup == INTERVAL_HOURLY:
+        return count_datetime_range(start_dt, end_dt, timedelta(hours=1))
+    if rollup == INTERVAL_DAILY:
+        return count_datetime_range(start_dt, end_dt, timedelta(days=1))
+    if rollup == INTERVAL_MONTHLY:
+        return (end_dt.year - start_dt.year) * 12 + end_dt.month - start_dt.month + 1
+    return interval_count
+
+
+def _bytes_per_record(f):
+    f = (f or '').lower()
+    if f in F_CSV:
+        return PLANNER_BYTES_PER_RECORD['csv']
+    if f in F_GEOJSON:
+        return PLANNER_BYTES_PER_RECORD['geojson']
+    if f in F_ARRAYS:
+        return PLANNER_BYTES_PER_RECORD['arrays']
+    return PLANNER_BYTES_PER_RECORD['json']
+
+
+def plan_request(model_class, args):
+    """plan a request from its validated arguments (see
+    `serializers.parse_and_validate_args`).
+
+    :param model_class: the observation model being queried
+    :type model_class: RainfallObservationMeta
+    :param args: validated request arguments
+    :type args: dict
+    :rtype: RequestPlan
+    """
+    dts, interval_count = parse_datetime_args(args.get('start_dt'), args.get('end_dt'), args.get('rollup'))
+
+    sensor_ids = []
+    if args.get('sensor_ids'):
+        sensor_ids = [str(i) for i in args['sensor_ids'].split(DELIMITER)]
+    # no sensors means all of them
+    sensor_count = len(sensor_ids) if sensor_ids else get_sensor_count(model_class)
+
+    record_count = interval_count * sensor_count
+    output_records = count_output_intervals(dts[0], dts[1], args.get('rollup'), interval_count) * sensor_count
+
+    estimated_bytes = output_records * _bytes_per_record(args.get('f'))
+    if (args.get('f') or '').lower() in F_GEOJSON:
+        estimated_bytes += sensor_count * PLANNER_GEOMETRY_BYTES
+    estimated_seconds = record_count / PLANNER_RECORDS_PER_SECOND
+
+    return RequestPlan(
+        start_dt=dts[0],
+        end_dt=dts[1],
+        sensor_ids=sensor_ids,
+        interval_count=interval_count,
+        sensor_count=sensor_count,
+        record_count=record_count,
+        output_records=output_records,
+        estimated_bytes=estimated_bytes,
+        estimated_seconds=estimated_seconds,
+        queue=RAINFALL_LARGE_QUEUE if estimated_seconds > PLANNER_LARGE_REQUEST_SECONDS else RAINFALL_DEFAULT_QUEUE
+    )
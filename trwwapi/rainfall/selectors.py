@@ -1,23 +1,31 @@
 from datetime import datetime, timedelta
 import gc
+import hashlib
 import logging
 import pdb
 import objgraph
 
 from django.utils.timezone import localtime, now
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import models, connection
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers, get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import status
 from rest_framework.response import Response
 from marshmallow import ValidationError
 from dateutil import tz
 from django_rq import job, get_queue
+from rq.defaults import DEFAULT_RESULT_TTL
 
 
 from ..utils import DebugMessages, _parse_request
+from ..common.compression import get_accepted_encoding, compress_body
 from .api_v2.core import (
     parse_datetime_args,
     query_pgdb,
+    query_pgdb_best_available,
     aggregate_results_by_interval,
     apply_zerofill,
     format_results
@@ -32,7 +40,11 @@ from ..common.config import (
     INTERVAL_HOURLY,
     INTERVAL_MONTHLY,
     INTERVAL_SUM,
-    MAX_RECORDS
+    MAX_RECORDS,
+    LATEST_OBSERVATIONS_CACHE_TTL,
+    ROLLING_TOTAL_MAX_LAG,
+    RAINFALL_DEFAULT_QUEUE,
+    RAINFALL_LARGE_QUEUE
 )
 from .models import (
     RainfallEvent, 
@@ -40,8 +52,14 @@ from .models import (
     GaugeObservation,
     RtrgObservation,
     RtrrObservation,
+    RtrrRollingTotal,
+    SensorAvailability,
+    IngestWatermark,
+    Pixel,
     MODELNAME_TO_GEOMODEL_LOOKUP
 )
+from .spatial import get_pixel_index
+from .planner import plan_request
 from .serializers import (
     ResponseSchema,
     parse_and_validate_args
@@ -53,10 +71,15 @@ logger = logging.getLogger(__name__)
 # SELECTOR+WORKER FOR THE HIGH LEVEL API VIEWS
 
 @job
-def get_rainfall_data(postgres_table_model, raw_args=None):
+def get_rainfall_data(postgres_table_model, raw_args=None, provisional_model=None):
     """Generic function for handling GET or POST requests of any of the rainfall
     tables. Used for the high-level ReST API endpoints.
 
+    If a `provisional_model` is provided, then `postgres_table_model` is taken
+    to be the calibrated source: results are calibrated data where it's 
+    available, and provisional data after the calibrated watermark (the latest
+    calibrated timestamp), with a `tier` on each row.
+
     Modeled off of the handler.py script from the original serverless version 
     of this codebase.
     """
@@ -90,7 +113,7 @@ def get_rainfall_data(postgres_table_model, raw_args=None):
         # available data
         else:
             try:
-                last_data_point = postgres_table_model.objects.latest('timestamp')
+                last_data_point = (provisional_model or postgres_table_model).objects.latest('timestamp')
                 # print(last_data_point)
                 latest = raw_args['end_dt'] = localtime(last_data_point.timestamp, TZ)
                 before = latest - timedelta(hours=4)
@@ -154,15 +177,12 @@ def get_rainfall_data(postgres_table_model, raw_args=None):
     # here we figure out all possible datetimes and sensor ids. The combination of these
     # make up the primary keys in the database
     
-    # parse the datetime parameters into a complete list of all possible date times
-    # print("parse_datetime_args")
-    dts, interval_count = parse_datetime_args(args['start_dt'], args['end_dt'], args['rollup'])
-    # print(dts)
-
-    # parse sensor ID string to a list. if not provided, the subsequent query will return all sensors.
-    sensor_ids = []
-    if args['sensor_ids']:
-        sensor_ids = [str(i) for i in args['sensor_ids'].split(DELIMITER)]
+    # parse the datetime parameters into the range to be queried, parse the 
+    # sensor ID string to a list (if not provided, the subsequent query will
+    # return all sensors), and estimate what the request will cost
+    plan = plan_request(postgres_table_model, args)
+    dts = [plan.start_dt, plan.end_dt]
+    sensor_ids = plan.sensor_ids
 
 
     # SAFETY VALVE: kill the response if the query will return more than we can handle.
@@ -181,16 +201,17 @@ def get_rainfall_data(postgres_table_model, raw_args=None):
     #     args['rollup'] == INTERVAL_SUM and len(dts) > (4 * 24 * 366)
     # ]):
         # messages.add("The submitted request would generate a larger response than we can manage for you right now. Use one of the following combinations of rollup and datetime ranges: 15-minute: < 1 week; hourly < 1 month; daily: < 3 months; monthly: < 1 year; sum: < 1 year. Please either reduce the date/time range queried or increase the time interval for roll-up parameter.")
-    record_count = interval_count * len(sensor_ids)
-    # print(interval_count, len(sensor_ids))
-    print("record_count", record_count)
+    # (requests without sensor ids count all of the model's sensors)
+    record_count = plan.record_count
+    logger.debug("record_count {0}".format(record_count))
 
     if record_count > MAX_RECORDS:
         messages.add("The request is unfortunately a bit more than we can handle for you right now: this query would return {0:,} data points and we can handle ~{1:,} at the moment. Please reduce the date/time range.".format(record_count, MAX_RECORDS))
         response = ResponseSchema(
             status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
             request_args=args,
-            messages=messages.messages
+            messages=messages.messages,
+            meta=dict(plan=plan.as_meta())
         )
         return response.as_dict()
 
@@ -198,7 +219,16 @@ def get_rainfall_data(postgres_table_model, raw_args=None):
     # use parsed args and datetime list to query the database
     try:
         # print("query_pgdb")
-        results = query_pgdb(postgres_table_model, sensor_ids, dts)
+        if provisional_model:
+            results = query_pgdb_best_available(
+                postgres_table_model, 
+                provisional_model, 
+                sensor_ids, 
+                dts, 
+                get_latest_timestamp(postgres_table_model)
+            )
+        else:
+            results = query_pgdb(postgres_table_model, sensor_ids, dts)
     #print(results)
     
     except Exception as e:
@@ -244,7 +274,8 @@ def get_rainfall_data(postgres_table_model, raw_args=None):
                 status_code=status.HTTP_200_OK,
                 request_args=args,
                 response_data=response_data,
-                messages=messages.messages
+                messages=messages.messages,
+                meta=dict(plan=plan.as_meta())
             )
             #return Response(response.as_dict(), status=status.HTTP_200_OK)
             #return response.as_dict()
@@ -255,7 +286,8 @@ def get_rainfall_data(postgres_table_model, raw_args=None):
         response = ResponseSchema(
             status_code=status.HTTP_200_OK,
             request_args=args,
-            messages=messages.messages
+            messages=messages.messages,
+            meta=dict(plan=plan.as_meta())
         )
         
     
@@ -264,11 +296,14 @@ def get_rainfall_data(postgres_table_model, raw_args=None):
     return response.as_dict()
 
 
-def handle_request_for(rainfall_model, request, *args, **kwargs):
+def handle_request_for(rainfall_model, request, *args, provisional_model=None, **kwargs):
     """Helper function that handles the routing of requests through 
     get_rainfall_data to a job queue. Returns responses with a 
     URL to the job results. Responsible for forming the shape, but not content, 
     of the response.
+
+    With a `provisional_model`, the rainfall_model is treated as the calibrated
+    source, and the provisional one fills in after it (see get_rainfall_data).
     """
     logger.debug("STARTING handle_request_for")
     logger.debug(objgraph.show_growth())
@@ -281,9 +316,7 @@ def handle_request_for(rainfall_model, request, *args, **kwargs):
     # then we check for the job in the queue and return its status
     if 'jobid' in kwargs.keys():
 
-        q = get_queue()
-        #queued_job_ids = q.job_ids
-        job = q.fetch_job(kwargs['jobid'])
+        job = fetch_rainfall_job(kwargs['jobid'])
         # print("fetched job", job)
 
         # if that job exists then we return the status and results, if any
@@ -305,6 +338,12 @@ def handle_request_for(rainfall_model, request, *args, **kwargs):
             # or failure)
             if job.result:
 
+                # finished results don't change, so if we've already rendered
+                # (and compressed) this one, send that back as-is.
+                cached_response = _get_cached_job_response(request, job, job_url)
+                if cached_response is not None:
+                    return cached_response
+
                 # mash up job metadata with any that comes from the 
                 # completed task
                 meta = job.result['meta']
@@ -322,6 +361,9 @@ def handle_request_for(rainfall_model, request, *args, **kwargs):
                     response_data=job.result['data'],
                     meta=meta
                 )
+
+                if job_status == 'finished':
+                    return _cache_job_response(request, job, job_url, response)
             else:
                 # if there is no result, we return with an updated status 
                 # but nothing else will change
@@ -352,17 +394,24 @@ def handle_request_for(rainfall_model, request, *args, **kwargs):
     # and a URL for checking on the job status
     else:
         logger.debug("This is a new request.")
-        job = get_rainfall_data.delay(rainfall_model, raw_args)
+        # if we can, estimate the cost of the request up front, so expensive 
+        # ones go to their own queue
+        plan = _plan_new_request(rainfall_model, raw_args)
+        q = get_queue(plan.queue if plan else RAINFALL_DEFAULT_QUEUE)
+        job = q.enqueue(get_rainfall_data, rainfall_model, raw_args, provisional_model=provisional_model)
         job_url = "{0}{1}/".format(request.build_absolute_uri(request.path), job.id)
+        meta = {
+            "jobId": job.id,
+            "jobUrl": job_url
+        }
+        if plan:
+            meta['plan'] = plan.as_meta()
         response = ResponseSchema(
             # queued, started, deferred, finished, or failed
             request_args=raw_args,
             status_message=job.get_status(),
             messages=['running job {0}'.format(job.id)],
-            meta={
-                "jobId": job.id,
-                "jobUrl": job_url
-            }
+            meta=meta
         )
 
         # return redirect(job_url)
@@ -370,6 +419,111 @@ def handle_request_for(rainfall_model, request, *args, **kwargs):
         gc.collect()
         return Response(response.as_dict(), status=status.HTTP_200_OK)
 
+def fetch_rainfall_job(job_id):
+    """fetch a job from whichever of the rainfall queues it was put on
+    """
+    for queue_name in [RAINFALL_DEFAULT_QUEUE, RAINFALL_LARGE_QUEUE]:
+        job = get_queue(queue_name).fetch_job(job_id)
+        if job:
+            return job
+    return None
+
+def _plan_new_request(model_class, raw_args):
+    """plan a new request from its raw arguments. Returns None if that can't be 
+    done before the job runs (e.g., invalid args, or no dates given, in which 
+    case the job picks defaults).
+    """
+    try:
+        args = parse_and_validate_args(dict(raw_args))
+    except (ValidationError, KeyError):
+        return None
+    if not (args.get('start_dt') or args.get('end_dt')):
+        return None
+    return plan_request(model_class, args)
+
+def _job_response_cache_keys(request, job, job_url):
+    """cache keys for the ETag and the body of a rendered job result. Rendered 
+    bodies vary by the job URL embedded in the response meta and by the 
+    content-encoding used; the ETag is that of the uncompressed body.
+    """
+    base_key = "trwwapi:job-response:{0}:{1}".format(
+        job.id,
+        hashlib.md5(job_url.encode()).hexdigest()
+    )
+    return (
+        "{0}:etag".format(base_key),
+        "{0}:{1}".format(base_key, get_accepted_encoding(request) or 'identity')
+    )
+
+def _job_http_response(request, body, status_code, etag):
+    """build a plain Django HttpResponse around an already rendered (and 
+    possibly compressed) job result body.
+    """
+    encoding = get_accepted_encoding(request)
+    http_response = HttpResponse(
+        body, 
+        status=status_code, 
+        content_type=request.accepted_renderer.media_type
+    )
+    if encoding:
+        http_response['Content-Encoding'] = encoding
+        # the ETag identifies the uncompressed representation
+        http_response['ETag'] = "W/{0}".format(etag)
+    else:
+        http_response['ETag'] = etag
+    patch_vary_headers(http_response, ('Accept-Encoding',))
+    return http_response
+
+def _get_cached_job_response(request, job, job_url):
+    """get the pre-rendered, pre-compressed body of a finished job from Redis, 
+    if available. Only used for JSON responses (not the browsable API).
+
+    If the client already has this result (i.e., If-None-Match matches the 
+    result's ETag on a GET or HEAD request), returns a 304 instead.
+    """
+    if request.accepted_renderer.format != 'json':
+        return None
+
+    etag_key, body_key = _job_response_cache_keys(request, job, job_url)
+    etag, body = get_queue().connection.mget(etag_key, body_key)
+    if etag is None:
+        return None
+    
+    etag = quote_etag(etag.decode())
+    if request.method in ('GET', 'HEAD'):
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+    if body is None:
+        return None
+    return _job_http_response(request, body, status.HTTP_200_OK, etag)
+
+def _cache_job_response(request, job, job_url, response):
+    """render and compress the response for a finished job, and store the body
+    and its ETag (a hash of the rendered result) in Redis alongside the job 
+    result, so that repeated polls skip the rendering and compression steps. 
+    Returns the response to be sent.
+    """
+    if request.accepted_renderer.format != 'json':
+        return Response(response.as_dict(), status=response.status_code)
+
+    rendered = request.accepted_renderer.render(
+        response.as_dict(), 
+        request.accepted_media_type
+    )
+    etag = hashlib.md5(rendered).hexdigest()
+    body = compress_body(rendered, get_accepted_encoding(request))
+
+    ttl = job.result_ttl if job.result_ttl and job.result_ttl > 0 else DEFAULT_RESULT_TTL
+    etag_key, body_key = _job_response_cache_keys(request, job, job_url)
+    pipe = get_queue().connection.pipeline()
+    pipe.set(etag_key, etag, ex=ttl)
+    pipe.set(body_key, body, ex=ttl)
+    pipe.execute()
+
+    return _job_http_response(request, body, response.status_code, quote_etag(etag))
+
 # ------------------------------------------------------------------------------
 # SELECTORS
 
@@ -392,6 +546,107 @@ def _get_latest(model_class, timestamp_field="timestamp"):
     except (model_class.DoesNotExist, AttributeError):
         return None
 
+# the tables (and timestamp fields) included in the latest observations summary
+LATEST_OBSERVATION_SOURCES = [
+    ("calibrated-radar", GarrObservation, "timestamp"),
+    ("calibrated-gauge", GaugeObservation, "timestamp"),
+    ("realtime-radar", RtrrObservation, "timestamp"),
+    ("realtime-gauge", RtrgObservation, "timestamp"),
+    ("rainfall-events", RainfallEvent, "start_dt"),
+]
+LATEST_OBSERVATIONS_CACHE_KEY = "trwwapi:latest-observation-timestamps"
+INGEST_WATERMARKS_CACHE_KEY = "trwwapi:ingest-watermarks"
+
+def get_latest_observation_timestamps():
+    """gets the latest timestamp for each of the rainfall observation tables,
+    and the latest start of a rainfall event.
+
+    This is done in a single round-trip, selecting only the max of each 
+    (indexed) timestamp field. The result is cached for a short time; 
+    ingestion of new observations invalidates it.
+    """
+    summary = cache.get(LATEST_OBSERVATIONS_CACHE_KEY)
+    if summary is not None:
+        return summary
+
+    query = "select {0}".format(", ".join([
+        "(select max({0}) from {1})".format(
+            connection.ops.quote_name(timestamp_field),
+            connection.ops.quote_name(model_class._meta.db_table)
+        )
+        for _, model_class, timestamp_field in LATEST_OBSERVATION_SOURCES
+    ]))
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        row = cursor.fetchone()
+
+    summary = {
+        key: latest 
+        for (key, _, _), latest in zip(LATEST_OBSERVATION_SOURCES, row)
+    }
+    cache.set(LATEST_OBSERVATIONS_CACHE_KEY, summary, LATEST_OBSERVATIONS_CACHE_TTL)
+    return summary
+
+def invalidate_latest_observation_timestamps():
+    """clear the cached summary of latest observation timestamps, and the 
+    cached ingest watermarks. Call this whenever observations are added or
+    changed.
+    """
+    cache.delete_many([LATEST_OBSERVATIONS_CACHE_KEY, INGEST_WATERMARKS_CACHE_KEY])
+
+def get_latest_timestamp(model_class, timestamp_field="timestamp"):
+    """gets just the latest value of timestamp_field from the model's table,
+    using an aggregate query instead of loading the whole record. Returns a
+    datetime, or None if the table is empty.
+
+    For the tables in the latest observations summary, this reads from the 
+    (cached) summary instead.
+    """
+    for key, source_model, source_field in LATEST_OBSERVATION_SOURCES:
+        if model_class is source_model and timestamp_field == source_field:
+            return get_latest_observation_timestamps()[key]
+    return model_class.objects.aggregate(latest=models.Max(timestamp_field))['latest']
+
+def get_ingest_watermarks():
+    """gets the `IngestWatermark` of each observation table: when it last 
+    received data (including corrections to rows already there), the 
+    watermark, and the rows ingested. Cached along with the latest timestamps,
+    and invalidated with them.
+
+    :return: modified, watermark, and rows_ingested for each table that has a
+        watermark, keyed on the model's object name
+    :rtype: dict
+    """
+    watermarks = cache.get(INGEST_WATERMARKS_CACHE_KEY)
+    if watermarks is not None:
+        return watermarks
+
+    watermarks = {
+        table: dict(modified=modified, watermark=watermark, rows_ingested=rows_ingested)
+        for table, modified, watermark, rows_ingested in IngestWatermark.objects\
+            .values_list('table', 'modified', 'watermark', 'rows_ingested')
+    }
+    cache.set(INGEST_WATERMARKS_CACHE_KEY, watermarks, LATEST_OBSERVATIONS_CACHE_TTL)
+    return watermarks
+
+def get_ingest_versions():
+    """identifies the current state of each observation table from its 
+    ingest watermark (see `get_ingest_watermarks`). Unlike the latest 
+    timestamps, this changes when existing rows are rewritten.
+
+    :return: a version string for each table that has a watermark, keyed on 
+        the model's object name
+    :rtype: dict
+    """
+    return {
+        table: "{0}|{1}|{2}".format(
+            w['modified'].isoformat() if w['modified'] else "",
+            w['watermark'].isoformat() if w['watermark'] else "",
+            w['rows_ingested']
+        )
+        for table, w in get_ingest_watermarks().items()
+    }
+
 def get_latest_garrobservation():
     return _get_latest(GarrObservation)
 
@@ -407,6 +662,17 @@ def get_latest_rtrgobservation():
 def get_latest_rainfallevent():
     return _get_latest(RainfallEvent, 'start_dt')
 
+def get_pixel_ids_for_point(point):
+    """get the ids of the rainfall pixels containing a point, using the 
+    in-memory pixel index. The point may be a GEOS Point in any spatial 
+    reference system (it's transformed to that of the pixels if needed), or a
+    shapely Point already in the pixels' spatial reference system.
+    """
+    srid = getattr(point, 'srid', None)
+    if srid and srid != Pixel.geom.field.srid:
+        point = point.transform(Pixel.geom.field.srid, clone=True)
+    return get_pixel_index().lookup(point.x, point.y)
+
 def get_rainfall_total_for(postgres_table_model, sensor_ids, back_to: timedelta):
 
     end_dt = localtime(now(), TZ)
@@ -417,3 +683,68 @@ def get_rainfall_total_for(postgres_table_model, sensor_ids, back_to: timedelta)
         return round(sum(x['val'] for x in rows if x['val']), 1)
     else:
         return None
+
+def get_rtrr_rolling_total_for(sensor_ids, back_to: timedelta):
+    """get the total rainfall for the sensors over the window from the 
+    precomputed rolling totals. Returns None if there isn't a rolling total for 
+    that window, or if the totals have fallen too far behind to stand in for 
+    a query against the observations.
+    """
+
+    window_hours, remainder = divmod(back_to.total_seconds(), 3600)
+    if remainder:
+        return None
+
+    rows = list(
+        RtrrRollingTotal.objects\
+            .filter(sensor_id__in=sensor_ids, window_hours=int(window_hours))\
+            .values_list('total', 'end_dt')
+    )
+    if not rows:
+        return None
+    
+    oldest = min(end_dt for _, end_dt in rows)
+    if now() - oldest > timedelta(minutes=ROLLING_TOTAL_MAX_LAG):
+        return None
+
+    return round(sum(total for total, _ in rows), 1)
+
+def get_sensor_availability(model_class, sensor_ids=None, by_month=False):
+    """summarize the observations available for each sensor of an observation
+    model: first and last observation, and the number of intervals with records
+    and with N/D. Optionally includes the monthly breakdown. Read from the 
+    availability index, so this doesn't touch the observations themselves.
+
+    :param model_class: one of the observation models
+    :type model_class: RainfallObservationMeta
+    :param sensor_ids: limit to these sensors, defaults to None (all sensors)
+    :type sensor_ids: list, optional
+    :param by_month: include the monthly summaries, defaults to False
+    :type by_month: bool, optional
+    :rtype: list of dicts
+    """
+    qs = SensorAvailability.objects.filter(table=model_class._meta.object_name)
+    if sensor_ids:
+        qs = qs.filter(sensor_id__in=sensor_ids)
+
+    summaries = list(
+        qs.order_by()\
+            .values('sensor_id')\
+            .annotate(
+                first_observation=models.Min('first_dt'),
+                last_observation=models.Max('last_dt'),
+                total_intervals=models.Sum('intervals'),
+                total_nodata_intervals=models.Sum('nodata_intervals'),
+                months=models.Count('id')
+            )\
+            .order_by('sensor_id')
+    )
+
+    if by_month:
+        monthly = {}
+        for row in qs.values('sensor_id', 'month', 'first_dt', 'last_dt', 'intervals', 'nodata_intervals'):
+            monthly.setdefault(row.pop('sensor_id'), []).append(row)
+        for summary in summaries:
+            summary['by_month'] = monthly.get(summary['sensor_id'], [])
+
+    return summaries
@@ -1,4 +1,5 @@
 import json
+from functools import lru_cache
 from django.conf import settings
 from rest_framework import serializers
 from rest_framework_gis.serializers import GeoFeatureModelSerializer 
@@ -25,7 +26,7 @@ from ..common.config import (
 )
 from .api_v2.utils import datetime_encoder, dt_parser
 
-from .models import GarrObservation, GaugeObservation, RtrrObservation, RtrgObservation, RainfallEvent, Pixel, Gauge
+from .models import GarrObservation, GaugeObservation, RtrrObservation, RtrgObservation, RainfallEvent, Pixel, Gauge, IngestWatermark
 
 from rest_framework import serializers
 
@@ -65,6 +66,33 @@ class RtrgObservationSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+@lru_cache(maxsize=None)
+def projected_observation_serializer(serializer_class):
+    """Get a version of an observation serializer that reads the `data` field
+    from the `projected_data` annotation (i.e., sensor values projected from the
+    JSON in the database), so that the deferred `data` field is never loaded.
+    """
+    class ProjectedObservationSerializer(serializer_class):
+        data = serializers.JSONField(source='projected_data', read_only=True)
+
+    ProjectedObservationSerializer.__name__ = ProjectedObservationSerializer.__qualname__ = "Projected{0}".format(serializer_class.__name__)
+    return ProjectedObservationSerializer
+
+
+class IngestObservationSerializer(serializers.Serializer):
+    """validates observation records submitted for ingestion. `data` maps 
+    sensor ids to a [value, metadata] array, as in the observation models.
+    """
+    timestamp = serializers.DateTimeField()
+    data = serializers.DictField(child=serializers.ListField(), allow_empty=False)
+
+
+class IngestWatermarkSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngestWatermark
+        fields = ("table", "watermark", "rows_ingested", "modified")
+
+
 class RainfallEventSerializer(serializers.ModelSerializer):
     class Meta:
         model = RainfallEvent
@@ -0,0 +1,443 @@
+"""write-side operations on the rainfall tables: things that get run when new
+observations arrive, rather than in response to a data request.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import csv
+import io
+import json
+import logging
+
+from dateutil.parser import parse
+import pandas as pd
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils.timezone import is_naive, make_aware, localtime, now
+
+from ..common.config import (
+    ROLLING_TOTAL_WINDOWS, 
+    TZ,
+    TZ_STRING,
+    RAINFALL_NODATA_STRING,
+    TIMESTAMP_FIELD,
+    ID_FIELD,
+    RAINFALL_FIELD,
+    SOURCE_FIELD
+)
+from .models import RtrrObservation, RtrrRollingTotal, IngestWatermark, SensorAvailability
+from .signals import observations_ingested
+
+
+logger = logging.getLogger(__name__)
+
+
+# sums each sensor's values across the observation rows in (start, end]
+_WINDOW_SUMS_SQL = """
+    SELECT e.key AS sensor_id, sum(coalesce((e.value->>0)::float, 0)) AS val
+    FROM {obs_table} o, jsonb_each(o.data) e
+    WHERE o.timestamp > %(start)s AND o.timestamp <= %(end)s
+    GROUP BY e.key
+"""
+
+_RECOMPUTE_SQL = """
+    INSERT INTO {rt_table} (sensor_id, window_hours, total, end_dt)
+    SELECT w.sensor_id, %(window_hours)s, w.val, %(end)s
+    FROM ({window_sums}) w
+""".format(rt_table="{rt_table}", window_sums=_WINDOW_SUMS_SQL)
+
+_ADVANCE_SQL = """
+    UPDATE {rt_table} SET end_dt = %(end)s WHERE window_hours = %(window_hours)s
+"""
+
+# added: rows that entered the window; dropped: rows that fell out of it
+_APPLY_DELTA_SQL = """
+    WITH added AS ({added}), dropped AS ({dropped})
+    INSERT INTO {rt_table} (sensor_id, window_hours, total, end_dt)
+    SELECT
+        coalesce(a.sensor_id, d.sensor_id),
+        %(window_hours)s,
+        coalesce(a.val, 0) - coalesce(d.val, 0),
+        %(end)s
+    FROM added a FULL OUTER JOIN dropped d ON a.sensor_id = d.sensor_id
+    ON CONFLICT (sensor_id, window_hours) DO UPDATE
+    SET total = greatest({rt_table}.total + excluded.total, 0), end_dt = excluded.end_dt
+""".format(
+    rt_table="{rt_table}",
+    added=_WINDOW_SUMS_SQL.replace("%(start)s", "%(prev_end)s"),
+    dropped=_WINDOW_SUMS_SQL\
+        .replace("%(start)s", "%(prev_start)s")\
+        .replace("%(end)s", "%(start)s")
+)
+
+
+def _recompute_window(cursor, tables, window_hours, end_dt):
+    cursor.execute(
+        "DELETE FROM {rt_table} WHERE window_hours = %(window_hours)s".format(**tables),
+        dict(window_hours=window_hours)
+    )
+    cursor.execute(
+        _RECOMPUTE_SQL.format(**tables),
+        dict(window_hours=window_hours, start=end_dt - timedelta(hours=window_hours), end=end_dt)
+    )
+
+
+def _advance_window(cursor, tables, window_hours, prev_end_dt, end_dt):
+    window = timedelta(hours=window_hours)
+    cursor.execute(
+        _ADVANCE_SQL.format(**tables),
+        dict(window_hours=window_hours, end=end_dt)
+    )
+    cursor.execute(
+        _APPLY_DELTA_SQL.format(**tables),
+        dict(
+            window_hours=window_hours,
+            prev_start=prev_end_dt - window,
+            start=end_dt - window,
+            prev_end=prev_end_dt,
+            end=end_dt
+        )
+    )
+
+
+# transaction-level advisory lock held while the rolling totals are updated, so
+# concurrent updates (several workers, back-to-back ingests, the management 
+# command) take turns rather than applying the same delta twice
+_ROLLING_TOTALS_LOCK_ID = 3793415
+
+
+def update_rtrr_rolling_totals(changed_since=None, full=False):
+    """bring the rolling-window RTRR totals up to the latest RTRR observation.
+
+    For each window, only the observations that entered the window (since the
+    last update) are added and only those that fell out of it are subtracted,
+    so a routine update touches a handful of rows rather than the whole window.
+    Updates are serialized with an advisory lock, so each delta is applied once.
+    A window is recomputed from scratch if:
+
+    * `full` is True
+    * it has never been computed, or the last update is older than the window
+    * `changed_since` (the earliest timestamp of any observations that were
+    inserted or revised) falls at or before the last update, i.e., data
+    already counted in the totals may have changed.
+
+    :param changed_since: earliest timestamp of new or revised observations, defaults to None
+    :type changed_since: datetime, optional
+    :param full: force a full recompute, defaults to False
+    :type full: bool, optional
+    :return: the end timestamp of the totals, or None if there are no observations
+    :rtype: datetime
+    """
+
+    tables = dict(
+        obs_table=RtrrObservation._meta.db_table,
+        rt_table=RtrrRollingTotal._meta.db_table
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # the totals and where they end up to are only read once it's our turn
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [_ROLLING_TOTALS_LOCK_ID])
+
+        end_dt = RtrrObservation.objects.aggregate(latest=Max('timestamp'))['latest']
+        if end_dt is None:
+            return None
+
+        last_updates = dict(
+            RtrrRollingTotal.objects\
+                .values('window_hours')\
+                .annotate(end_dt=Max('end_dt'))\
+                .values_list('window_hours', 'end_dt')
+        )
+
+        for window_hours in ROLLING_TOTAL_WINDOWS:
+            prev_end_dt = last_updates.get(window_hours)
+
+            recompute = full \
+                or prev_end_dt is None \
+                or end_dt - prev_end_dt >= timedelta(hours=window_hours) \
+                or (changed_since is not None and changed_since <= prev_end_dt)
+
+            if recompute:
+                logger.debug("recomputing {0}h rolling totals through {1}".format(window_hours, end_dt))
+                _recompute_window(cursor, tables, window_hours, end_dt)
+            elif end_dt > prev_end_dt:
+                logger.debug("advancing {0}h rolling totals from {1} to {2}".format(window_hours, prev_end_dt, end_dt))
+                _advance_window(cursor, tables, window_hours, prev_end_dt, end_dt)
+
+    return end_dt
+
+
+# ------------------------------------------------------------------------------
+# SENSOR AVAILABILITY
+
+# summarizes the months (in local time) and sensors affected, and upserts the
+# summaries in one statement; summaries for those months and sensors that no
+# longer have any observations are removed. An interval is N/D if it has no 
+# value. The sensor filter is skipped when sensor_ids is null.
+_UPSERT_AVAILABILITY_SQL = """
+    WITH summary AS (
+        SELECT
+            e.key AS sensor_id,
+            date_trunc('month', o.timestamp AT TIME ZONE %(tz)s)::date AS month,
+            min(o.timestamp) AS first_dt,
+            max(o.timestamp) AS last_dt,
+            count(*) AS intervals,
+            count(*) FILTER (WHERE e.value->>0 IS NULL OR e.value->>1 = %(nodata)s) AS nodata_intervals
+        FROM {obs_table} o, jsonb_each(o.data) e
+        WHERE o.timestamp >= %(start)s AND o.timestamp < %(end)s
+            AND (%(sensor_ids)s::text[] IS NULL OR e.key = ANY(%(sensor_ids)s::text[]))
+        GROUP BY e.key, month
+    ), upserted AS (
+        INSERT INTO {avail_table} ("table", sensor_id, month, first_dt, last_dt, intervals, nodata_intervals)
+        SELECT %(table)s, sensor_id, month, first_dt, last_dt, intervals, nodata_intervals
+        FROM summary
+        ON CONFLICT ("table", sensor_id, month) DO UPDATE SET
+            first_dt = EXCLUDED.first_dt,
+            last_dt = EXCLUDED.last_dt,
+            intervals = EXCLUDED.intervals,
+            nodata_intervals = EXCLUDED.nodata_intervals
+        RETURNING 1
+    ), removed AS (
+        DELETE FROM {avail_table} a
+        WHERE a."table" = %(table)s 
+            AND a.month >= %(start_month)s AND a.month < %(end_month)s
+            AND (%(sensor_ids)s::text[] IS NULL OR a.sensor_id = ANY(%(sensor_ids)s::text[]))
+            AND NOT EXISTS (
+                SELECT 1 FROM summary s WHERE s.sensor_id = a.sensor_id AND s.month = a.month
+            )
+    )
+    SELECT count(*) FROM upserted
+"""
+
+
+def _month_start(dt):
+    local = localtime(dt, TZ)
+    return TZ.localize(datetime(local.year, local.month, 1))
+
+
+def _next_month_start(dt):
+    local = localtime(dt, TZ)
+    year, month = (local.year + 1, 1) if local.month == 12 else (local.year, local.month + 1)
+    return TZ.localize(datetime(year, month, 1))
+
+
+def update_sensor_availability(model_class, start_dt=None, end_dt=None, sensor_ids=None):
+    """update the monthly sensor availability summaries for an observation 
+    table, for the months touched by [start_dt, end_dt] (e.g., the extent of 
+    a batch of ingested observations) and, if given, only the sensors in 
+    sensor_ids. Without a range, the whole table is summarized. Summaries are
+    upserted, so concurrent updates of the same months don't conflict.
+
+    :param model_class: one of the observation models
+    :type model_class: RainfallObservationMeta
+    :param sensor_ids: the sensors to update, defaults to all of them
+    :type sensor_ids: list, optional
+    :return: number of sensor-month summaries written
+    :rtype: int
+    """
+
+    if sensor_ids is not None and not sensor_ids:
+        return 0
+
+    if start_dt is None or end_dt is None:
+        extent = model_class.objects.aggregate(start_dt=Min('timestamp'), end_dt=Max('timestamp'))
+        start_dt, end_dt = start_dt or extent['start_dt'], end_dt or extent['end_dt']
+        if start_dt is None:
+            return 0
+
+    start, end = _month_start(start_dt), _next_month_start(end_dt)
+    sql_args = dict(
+        table=model_class._meta.object_name,
+        start=start,
+        end=end,
+        start_month=start.date(),
+        end_month=end.date(),
+        sensor_ids=[str(i) for i in sensor_ids] if sensor_ids else None,
+        tz=TZ_STRING,
+        nodata=RAINFALL_NODATA_STRING
+    )
+    tables = dict(
+        avail_table=SensorAvailability._meta.db_table,
+        obs_table=model_class._meta.db_table
+    )
+
+    with connection.cursor() as cursor:
+        cursor.execute(_UPSERT_AVAILABILITY_SQL.format(**tables), sql_args)
+        return cursor.fetchone()[0]
+
+
+# ------------------------------------------------------------------------------
+# INGESTION
+
+@dataclass
+class IngestResult:
+    table: str
+    rows: int = 0
+    start_dt: datetime = None
+    end_dt: datetime = None
+    watermark: datetime = None
+
+
+# observation records are COPY'd into a temporary staging table, then upserted
+# into the observation table in a single statement. seq lets the last record 
+# win when a batch contains the same timestamp more than once.
+_STAGING_TABLE = "_rainfall_ingest_staging"
+
+_CREATE_STAGING_SQL = """
+    CREATE TEMPORARY TABLE {staging} (
+        seq bigserial, 
+        timestamp timestamptz NOT NULL, 
+        data jsonb NOT NULL
+    )
+"""
+
+_COPY_STAGING_SQL = "COPY {staging} (timestamp, data) FROM STDIN WITH (FORMAT csv)"
+
+# merging keeps any sensors already recorded at a timestamp that aren't in the 
+# new record; replacing overwrites the record's data outright
+_UPSERT_DATA = dict(
+    merge="{table}.data || excluded.data",
+    replace="excluded.data"
+)
+
+_UPSERT_SQL = """
+    INSERT INTO {table} (timestamp, data)
+    SELECT DISTINCT ON (s.timestamp) s.timestamp, s.data
+    FROM {staging} s
+    ORDER BY s.timestamp, s.seq DESC
+    ON CONFLICT (timestamp) DO UPDATE SET data = {data}
+"""
+
+_STAGING_EXTENT_SQL = "SELECT min(timestamp), max(timestamp) FROM {staging}"
+
+_STAGING_SENSORS_SQL = "SELECT DISTINCT jsonb_object_keys(data) FROM {staging}"
+
+_DROP_STAGING_SQL = "DROP TABLE {staging}"
+
+
+def _parse_timestamp(value):
+    dt = value if isinstance(value, datetime) else parse(value)
+    if is_naive(dt):
+        dt = make_aware(dt, TZ)
+    return dt
+
+
+def _records_to_csv(records):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for record in records:
+        writer.writerow([
+            _parse_timestamp(record['timestamp']).isoformat(),
+            json.dumps(record['data'])
+        ])
+    buf.seek(0)
+    return buf
+
+
+def observation_records_from_frame(df):
+    """convert a long-format table of observations (one row per sensor per 
+    timestamp, using the pipeline's field names) to observation records for 
+    `ingest_observations`: one record per timestamp, with the sensor values 
+    as `{sensor id: [value, source]}`. Values that aren't numbers (e.g., 
+    "N/D") become nulls. Records are returned in timestamp order.
+
+    :param df: table with TIMESTAMP_FIELD, ID_FIELD, RAINFALL_FIELD and (optionally) SOURCE_FIELD columns
+    :type df: pandas.DataFrame
+    :rtype: list of dicts
+    """
+
+    missing = {TIMESTAMP_FIELD, ID_FIELD, RAINFALL_FIELD}.difference(df.columns)
+    if missing:
+        raise ValueError("Missing column(s): {0}".format(", ".join(sorted(missing))))
+
+    values = pd.to_numeric(df[RAINFALL_FIELD], errors='coerce')
+    values = values.astype(object).where(values.notna(), None)
+    if SOURCE_FIELD in df.columns:
+        sources = df[SOURCE_FIELD].astype(object).where(df[SOURCE_FIELD].notna(), None)
+    else:
+        sources = pd.Series([None] * len(df), index=df.index, dtype=object)
+
+    frame = pd.DataFrame({
+        'ts': df[TIMESTAMP_FIELD],
+        'id': df[ID_FIELD].astype(str),
+        'obs': [[v, src] for v, src in zip(values, sources)]
+    })
+
+    records = []
+    for ts, group in frame.groupby('ts', sort=True):
+        if isinstance(ts, pd.Timestamp):
+            ts = ts.to_pydatetime()
+        records.append(dict(timestamp=ts, data=dict(zip(group['id'], group['obs']))))
+    return records
+
+
+def ingest_observations(model_class, records, merge=True):
+    """upsert a batch of observation records into an observation table, and 
+    let any subscribers (caches, rollups) know about it.
+
+    Records are dictionaries with `timestamp` and `data` keys, matching the 
+    shape of the observation models (see `RainfallObservationMeta`). Naive 
+    timestamps are assumed to be local time. The batch is loaded with COPY 
+    and upserted on timestamp in one statement, which advances the table's 
+    `IngestWatermark` (by trigger). The `observations_ingested` signal is sent 
+    once the transaction commits; its receivers queue the rollups (rolling 
+    totals, availability) for a worker.
+
+    :param model_class: one of the observation models
+    :type model_class: RainfallObservationMeta
+    :param records: observation records
+    :type records: iterable of dicts
+    :param merge: merge the data with any existing record for the same timestamp, 
+        rather than replacing it, defaults to True
+    :type merge: bool, optional
+    :return: summary of what was ingested
+    :rtype: IngestResult
+    """
+
+    result = IngestResult(table=model_class._meta.object_name)
+
+    buf = _records_to_csv(records)
+    if not buf.getvalue():
+        return result
+
+    sql_args = dict(
+        table=model_class._meta.db_table,
+        staging=_STAGING_TABLE
+    )
+    sql_args['data'] = _UPSERT_DATA['merge' if merge else 'replace'].format(**sql_args)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(_CREATE_STAGING_SQL.format(**sql_args))
+            cursor.copy_expert(_COPY_STAGING_SQL.format(**sql_args), buf)
+            cursor.execute(_UPSERT_SQL.format(**sql_args))
+            result.rows = cursor.rowcount
+            cursor.execute(_STAGING_EXTENT_SQL.format(**sql_args))
+            result.start_dt, result.end_dt = cursor.fetchone()
+            # replacing records can drop sensors that aren't in the batch, so
+            # then every sensor may have changed
+            sensor_ids = None
+            if merge:
+                cursor.execute(_STAGING_SENSORS_SQL.format(**sql_args))
+                sensor_ids = [r[0] for r in cursor.fetchall()]
+            cursor.execute(_DROP_STAGING_SQL.format(**sql_args))
+
+        # advanced by the observation table triggers (see migration 0019)
+        result.watermark = IngestWatermark.objects\
+            .filter(table=result.table)\
+            .values_list('watermark', flat=True)\
+            .first()
+
+        transaction.on_commit(lambda: observations_ingested.send(
+            sender=model_class,
+            start_dt=result.start_dt,
+            end_dt=result.end_dt,
+            rows=result.rows,
+            sensor_ids=sensor_ids
+        ))
+
+    logger.info("ingested {0} {1} rows ({2} to {3})".format(
+        result.rows, result.table, result.start_dt, result.end_dt
+    ))
+
+    return result
@@ -0,0 +1,41 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver, Signal
+from django_rq import get_queue
+
+from ..common.config import RAINFALL_DEFAULT_QUEUE
+from .models import Pixel, RtrrObservation
+from .spatial import invalidate_pixel_index
+from .selectors import invalidate_latest_observation_timestamps
+
+
+# sent by services.ingest_observations once a batch of observations has been
+# committed, with the observation model as the sender. Receivers also get 
+# `start_dt` and `end_dt` (the extent of the batch), `rows`, and `sensor_ids`
+# (the sensors in the batch, or None if any sensor may have changed).
+observations_ingested = Signal()
+
+
+@receiver([post_save, post_delete], sender=Pixel)
+def refresh_pixel_index(sender, **kwargs):
+    invalidate_pixel_index()
+
+
+@receiver(observations_ingested)
+def refresh_latest_observations(sender, **kwargs):
+    invalidate_latest_observation_timestamps()
+
+
+# the rollups below can take a while, so they are queued for a worker rather 
+# than run in the ingest request
+
+@receiver(observations_ingested, sender=RtrrObservation)
+def refresh_rolling_totals(sender, start_dt=None, **kwargs):
+    # services imports this module for the signal, so import it here
+    from .services import update_rtrr_rolling_totals
+    get_queue(RAINFALL_DEFAULT_QUEUE).enqueue(update_rtrr_rolling_totals, changed_since=start_dt)
+
+
+@receiver(observations_ingested)
+def refresh_sensor_availability(sender, start_dt=None, end_dt=None, sensor_ids=None, **kwargs):
+    from .services import update_sensor_availability
+    get_queue(RAINFALL_DEFAULT_QUEUE).enqueue(update_sensor_availability, sender, start_dt, end_dt, sensor_ids)
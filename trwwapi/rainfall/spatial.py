@@ -0,0 +1,138 @@
+"""spatial.py
+
+in-memory spatial indexing of the rainfall sensor geometries
+
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import geopandas as gpd
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.prepared import prep
+from django_rq import get_queue
+from redis.exceptions import RedisError
+
+from ..common.config import PIXEL_INDEX_MAX_AGE, PIXEL_INDEX_VERSION_KEY
+from .models import Pixel
+
+
+logger = logging.getLogger(__name__)
+
+
+class PixelGridIndex():
+    """Resolves a location to the rainfall pixel(s) that contain it, without a 
+    database round-trip.
+
+    The pixels are a fixed ~1km grid, so each pixel is assigned to a cell of a 
+    regular grid (derived from the pixels' own bounds) by its centroid. A 
+    lookup is then some arithmetic to find the cell, and a single 
+    point-in-polygon test against that cell's pixel. Where that doesn't pan 
+    out--e.g., for irregular pixels at the edge of the grid--it falls back to 
+    an R-tree query over all pixel geometries.
+
+    Coordinates are expected to be in the pixels' spatial reference system.
+    """
+
+    def __init__(self, pixel_ids, geometries):
+
+        self.pixel_ids = list(pixel_ids)
+        self.geometries = gpd.GeoSeries(list(geometries))
+        self.prepared = [prep(g) for g in self.geometries]
+
+        self.cells = defaultdict(list)
+        if len(self.pixel_ids) > 0:
+            bounds = self.geometries.bounds
+            # the grid cell size is that of a typical pixel
+            self.cell_width = float(np.median(bounds['maxx'] - bounds['minx']))
+            self.cell_height = float(np.median(bounds['maxy'] - bounds['miny']))
+            self.origin = (float(bounds['minx'].min()), float(bounds['miny'].min()))
+            for i, centroid in enumerate(self.geometries.centroid):
+                self.cells[self._cell(centroid.x, centroid.y)].append(i)
+
+    def _cell(self, x, y):
+        return (
+            int((x - self.origin[0]) // self.cell_width),
+            int((y - self.origin[1]) // self.cell_height)
+        )
+
+    def lookup(self, x, y):
+        """get the ids of the pixels containing the point at x, y. Returns an 
+        empty list if there are none.
+        """
+        if len(self.pixel_ids) == 0:
+            return []
+
+        point = Point(x, y)
+
+        # fast path: test the pixel(s) in the grid cell
+        hits = [
+            self.pixel_ids[i] for i in self.cells.get(self._cell(x, y), [])
+            if self.prepared[i].contains(point)
+        ]
+        if hits:
+            return hits
+
+        # fallback: query the spatial index
+        return [
+            self.pixel_ids[i] for i in 
+            self.geometries.sindex.query(point, predicate='within')
+        ]
+
+    @classmethod
+    def from_database(cls):
+        rows = Pixel.objects.values_list('pixel_id', 'geom')
+        return cls(
+            [pixel_id for pixel_id, _ in rows],
+            [wkb.loads(bytes(geom.wkb)) for _, geom in rows]
+        )
+
+
+_pixel_index = None
+_pixel_index_built = None
+_pixel_index_version = None
+_pixel_index_lock = threading.Lock()
+
+def get_pixel_index_version():
+    """get the shared version of the pixels from Redis (None if they have 
+    never changed, or Redis can't be reached).
+    """
+    try:
+        return get_queue().connection.get(PIXEL_INDEX_VERSION_KEY)
+    except RedisError:
+        logger.warning("Couldn't get the pixel index version; using the current index")
+        return _pixel_index_version
+
+def get_pixel_index():
+    """get the (process-wide) pixel index, building it from the database if 
+    it hasn't been built yet, the pixels have changed since (in any process; 
+    see `invalidate_pixel_index`), or it is more than PIXEL_INDEX_MAX_AGE 
+    seconds old.
+    """
+    global _pixel_index, _pixel_index_built, _pixel_index_version
+    version = get_pixel_index_version()
+    with _pixel_index_lock:
+        if _pixel_index is None \
+            or version != _pixel_index_version \
+            or time.monotonic() - _pixel_index_built > PIXEL_INDEX_MAX_AGE:
+            # the version is read before building, so a change made while 
+            # building is picked up by the next lookup
+            _pixel_index = PixelGridIndex.from_database()
+            _pixel_index_built = time.monotonic()
+            _pixel_index_version = version
+        return _pixel_index
+
+def invalidate_pixel_index():
+    """bump the shared pixel version, so that the index is rebuilt on next use
+    in every process, and drop this process's index.
+    """
+    global _pixel_index
+    try:
+        get_queue().connection.incr(PIXEL_INDEX_VERSION_KEY)
+    except RedisError:
+        logger.exception("Couldn't bump the pixel index version; other processes will rebuild within PIXEL_INDEX_MAX_AGE")
+    with _pixel_index_lock:
+        _pixel_index = None
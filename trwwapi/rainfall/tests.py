@@ -1,16 +1,40 @@
-from django.test import SimpleTestCase
-
+from django.test import SimpleTestCase, RequestFactory
+
+import csv
+from datetime import timedelta
+import io
+import json
+from unittest import mock
+import pandas as pd
 from dateutil.parser import parse
+from shapely.geometry import box
+from rest_framework.request import Request
 
 from .api_v2.core import (
     parse_datetime_args, 
     _minmax,
-    _rollup_date
+    _rollup_date,
+    _build_best_available_query,
+    aggregate_results_by_interval,
+    format_results
 )
-from .api_v2.utils import dt_parser
+from .api_v2.utils import dt_parser, datetime_encoder, datetime_range, count_datetime_range
+from .spatial import PixelGridIndex
+from . import spatial
+from .planner import plan_request, count_output_intervals
+from .selectors import handle_request_for, get_rainfall_data, get_ingest_versions, invalidate_latest_observation_timestamps
+from .models import GarrObservation, RtrrObservation
+from .signals import observations_ingested
+from .listeners import handle_observations_notification
+from .views import GarrObservationViewset, parse_page_size
+from .services import _records_to_csv, observation_records_from_frame, _month_start, _next_month_start, update_rtrr_rolling_totals
+from .management.commands.ingest_observations import _read_records
+from ..common.renderers import FastJSONRenderer
 from ..common.config import (
     TZ, TZI, TZ_STRING, TZINFOS, 
-    INTERVAL_15MIN, INTERVAL_HOURLY, INTERVAL_DAILY, INTERVAL_SUM
+    TIMESTAMP_FIELD, ID_FIELD, RAINFALL_FIELD, SOURCE_FIELD,
+    INTERVAL_15MIN, INTERVAL_HOURLY, INTERVAL_DAILY, INTERVAL_MONTHLY, INTERVAL_SUM,
+    RAINFALL_DEFAULT_QUEUE, RAINFALL_LARGE_QUEUE, MAX_RECORDS
 )
 
 # def test_rainfall_garr_response(client):
@@ -168,4 +192,404 @@ class TestRequestDatetimeParamParsing(SimpleTestCase):
 
     def test_rollup_other(self):
         r = _rollup_date("2020-04-17T11:18:00-04:00", INTERVAL_15MIN)
-        self.assertEqual("2020-04-17T11:18:00-04:00", r)
\ No newline at end of file
+        self.assertEqual("2020-04-17T11:18:00-04:00", r)
+
+
+class TestResultFormatting(SimpleTestCase):
+    """Tests for the output formats applied to query results in 
+    `core.format_results`
+    """
+
+    def setUp(self):
+        self.results = [
+            dict(ts="2020-04-07T11:15:00-04:00", id="123", val=0.1, src="R"),
+            dict(ts="2020-04-07T11:15:00-04:00", id="456", val=None, src="N/D"),
+            dict(ts="2020-04-07T11:00:00-04:00", id="456", val=0.3, src="R"),
+        ]
+
+    def test_arrays_shape(self):
+        r = format_results(self.results, 'arrays', None)
+        self.assertEqual(r['ids'], ["123", "456"])
+        self.assertEqual(r['timestamps'], ["2020-04-07T11:00:00-04:00", "2020-04-07T11:15:00-04:00"])
+        self.assertEqual(len(r['values']), 2)
+        self.assertTrue(all(len(row) == 2 for row in r['values']))
+
+    def test_arrays_values_and_nodata(self):
+        r = format_results(self.results, 'arrays', None)
+        self.assertEqual(r['values'], [[None, 0.3], [0.1, None]])
+
+    def test_arrays_empty(self):
+        r = format_results([], 'arrays', None)
+        self.assertEqual(r, dict(ids=[], timestamps=[], values=[]))
+
+
+class TestResponseEncoding(SimpleTestCase):
+    """Tests for encoding request args and responses to JSON
+    """
+
+    def test_datetime_encoder_nested(self):
+        args = {
+            "start_dt": parse("2020-04-07T11:00:00-04:00"),
+            "rollup": "hourly",
+            "dts": [parse("2020-04-07T12:00:00-04:00")]
+        }
+        self.assertEqual(
+            datetime_encoder(args),
+            {
+                "start_dt": "2020-04-07T11:00:00-04:00",
+                "rollup": "hourly",
+                "dts": ["2020-04-07T12:00:00-04:00"]
+            }
+        )
+
+    def test_fast_json_renderer_datetimes(self):
+        data = {"args": {"start_dt": parse("2020-04-07T11:00:00-04:00")}, "data": [{"val": 0.1}]}
+        rendered = json.loads(FastJSONRenderer().render(data))
+        self.assertEqual(rendered["args"]["start_dt"], "2020-04-07T11:00:00-04:00")
+        self.assertEqual(rendered["data"], [{"val": 0.1}])
+
+
+class TestPixelGridIndex(SimpleTestCase):
+    """Tests for the in-memory point-to-pixel lookup
+    """
+
+    def setUp(self):
+        # a 3x3 grid of unit pixels, plus a narrow, irregular pixel along the 
+        # right edge of the grid
+        ids = ["{0}{1}".format(c, r) for c in range(3) for r in range(3)]
+        geoms = [box(c, r, c + 1, r + 1) for c in range(3) for r in range(3)]
+        self.index = PixelGridIndex(ids + ["edge"], geoms + [box(3, 0, 3.2, 3)])
+
+    def test_lookup_in_grid(self):
+        self.assertEqual(self.index.lookup(1.5, 2.5), ["12"])
+
+    def test_lookup_irregular_edge(self):
+        self.assertEqual(self.index.lookup(3.1, 0.5), ["edge"])
+
+    def test_lookup_outside(self):
+        self.assertEqual(self.index.lookup(-5, -5), [])
+
+    def test_lookup_empty_index(self):
+        self.assertEqual(PixelGridIndex([], []).lookup(0.5, 0.5), [])
+
+    @mock.patch.object(spatial, '_pixel_index', None)
+    @mock.patch.object(spatial, '_pixel_index_version', None)
+    def test_rebuilt_when_version_changes(self):
+        with mock.patch.object(spatial.PixelGridIndex, 'from_database', side_effect=lambda: self.index) as from_database, \
+            mock.patch.object(spatial, 'get_pixel_index_version', side_effect=[b"1", b"1", b"2"]):
+            for _ in range(3):
+                spatial.get_pixel_index()
+        # built once for version 1, and again after another process bumped it
+        self.assertEqual(from_database.call_count, 2)
+
+
+class TestIngestRecords(SimpleTestCase):
+    """Tests for preparing observation records for ingestion
+    """
+
+    def test_records_to_csv(self):
+        buf = _records_to_csv([
+            dict(timestamp="2020-04-07T11:00:00-04:00", data={"123": [0.1, "R"]}),
+            dict(timestamp="2020-04-07T11:15:00", data={"123": [0.2, "R"]}),
+        ])
+        rows = list(csv.reader(buf))
+        self.assertEqual(rows[0], ["2020-04-07T11:00:00-04:00", '{"123": [0.1, "R"]}'])
+        # naive timestamps are local time
+        self.assertEqual(rows[1][0], "2020-04-07T11:15:00-04:00")
+
+    def test_records_to_csv_empty(self):
+        self.assertEqual(_records_to_csv([]).getvalue(), "")
+
+    def test_read_records_json_array_and_lines(self):
+        records = [
+            dict(timestamp="2020-04-07T11:00:00-04:00", data={"123": [0.1, "R"]}),
+            dict(timestamp="2020-04-07T11:15:00-04:00", data={"123": [0.2, "R"]}),
+        ]
+        as_array = io.StringIO(json.dumps(records))
+        as_lines = io.StringIO("\n".join(json.dumps(r) for r in records) + "\n")
+        self.assertEqual(list(_read_records(as_array)), records)
+        self.assertEqual(list(_read_records(as_lines)), records)
+
+    def test_records_from_long_frame(self):
+        df = pd.DataFrame({
+            TIMESTAMP_FIELD: ["2020-04-07T11:15:00-04:00", "2020-04-07T11:00:00-04:00", "2020-04-07T11:00:00-04:00"],
+            ID_FIELD: [123, 123, 456],
+            RAINFALL_FIELD: ["0.2", "0.1", "N/D"],
+            SOURCE_FIELD: ["R", "R", "N/D"]
+        })
+        records = observation_records_from_frame(df)
+        self.assertEqual(records, [
+            dict(timestamp="2020-04-07T11:00:00-04:00", data={"123": [0.1, "R"], "456": [None, "N/D"]}),
+            dict(timestamp="2020-04-07T11:15:00-04:00", data={"123": [0.2, "R"]}),
+        ])
+
+    def test_records_from_frame_missing_columns(self):
+        with self.assertRaises(ValueError):
+            observation_records_from_frame(pd.DataFrame({TIMESTAMP_FIELD: [], ID_FIELD: []}))
+
+
+class TestConditionalRequests(SimpleTestCase):
+    """Tests for the ETags of the low-level observation viewsets
+    """
+
+    def _etag(self, version):
+        request = RequestFactory().get('/rainfall/v2/garr/')
+        with mock.patch('trwwapi.rainfall.views.get_latest_timestamp', return_value=parse("2020-04-07T11:00:00-04:00")), \
+            mock.patch('trwwapi.rainfall.views.get_ingest_versions', return_value={"GarrObservation": version}):
+            return GarrObservationViewset()._get_etag(request)
+
+    def test_etag_changes_with_corrections(self):
+        # the latest timestamp is the same, but the table was written to
+        self.assertEqual(self._etag("a"), self._etag("a"))
+        self.assertNotEqual(self._etag("a"), self._etag("b"))
+
+    def test_last_modified_includes_corrections(self):
+        latest, written = parse("2020-04-07T11:00:00-04:00"), parse("2020-04-08T09:00:00-04:00")
+        request = RequestFactory().get('/rainfall/v2/garr/')
+        with mock.patch('trwwapi.rainfall.views.get_latest_timestamp', return_value=latest), \
+            mock.patch('trwwapi.rainfall.views.get_ingest_watermarks', return_value={"GarrObservation": dict(modified=written)}):
+            self.assertEqual(GarrObservationViewset()._get_last_modified(request), written)
+        with mock.patch('trwwapi.rainfall.views.get_latest_timestamp', return_value=latest), \
+            mock.patch('trwwapi.rainfall.views.get_ingest_watermarks', return_value={}):
+            self.assertEqual(GarrObservationViewset()._get_last_modified(request), latest)
+
+    def test_ingest_versions_cached_with_latest_timestamps(self):
+        modified = parse("2020-04-08T09:00:00-04:00")
+        rows = [("GarrObservation", modified, parse("2020-04-07T11:00:00-04:00"), 10)]
+        invalidate_latest_observation_timestamps()
+        with mock.patch('trwwapi.rainfall.selectors.IngestWatermark') as model:
+            model.objects.values_list.return_value = rows
+            first = get_ingest_versions()
+            self.assertEqual(get_ingest_versions(), first)
+            model.objects.values_list.assert_called_once()
+
+            # and invalidated along with them
+            invalidate_latest_observation_timestamps()
+            get_ingest_versions()
+            self.assertEqual(model.objects.values_list.call_count, 2)
+        invalidate_latest_observation_timestamps()
+        self.assertTrue(first["GarrObservation"].startswith(modified.isoformat()))
+
+
+class TestProjectedPageSize(SimpleTestCase):
+    """Tests for parsing page sizes for projected observation pages
+    """
+
+    def test_page_size_capped(self):
+        self.assertEqual(parse_page_size("50", 100), 50)
+        self.assertEqual(parse_page_size("500", 100), 100)
+
+    def test_page_size_invalid(self):
+        for value in ["0", "-5", "abc", ""]:
+            with self.assertRaises(ValueError):
+                parse_page_size(value, 100)
+
+
+class TestIngestSignals(SimpleTestCase):
+    """Tests for the work done when observations are ingested
+    """
+
+    def test_rollups_are_queued(self):
+        start_dt, end_dt = parse("2020-04-07T11:00:00-04:00"), parse("2020-04-07T12:00:00-04:00")
+        with mock.patch('trwwapi.rainfall.signals.invalidate_latest_observation_timestamps'), \
+            mock.patch('trwwapi.rainfall.signals.get_queue') as get_queue:
+            observations_ingested.send(sender=RtrrObservation, start_dt=start_dt, end_dt=end_dt, rows=5, sensor_ids=["123"])
+        queued = {c.args[0].__name__: c for c in get_queue.return_value.enqueue.call_args_list}
+        self.assertEqual(sorted(queued.keys()), ["update_rtrr_rolling_totals", "update_sensor_availability"])
+        # availability is only updated for the sensors in the batch
+        self.assertEqual(
+            queued["update_sensor_availability"].args[1:],
+            (RtrrObservation, start_dt, end_dt, ["123"])
+        )
+
+    def test_notification_only_clears_cache(self):
+        payload = json.dumps(dict(
+            table=RtrrObservation._meta.db_table, op='INSERT', rows=5,
+            start_dt="2020-04-07T11:00:00-04:00", end_dt="2020-04-07T12:00:00-04:00"
+        ))
+        # the triggers advance the watermark; every web worker's listener
+        # receives the notification, so it mustn't write anything
+        with mock.patch('trwwapi.rainfall.listeners.invalidate_latest_observation_timestamps') as invalidate:
+            handle_observations_notification(payload)
+        invalidate.assert_called_once_with()
+
+    def test_rolling_totals_read_under_lock(self):
+        end_dt = parse("2020-04-07T12:00:00-04:00")
+        db = mock.MagicMock()
+        cursor = db.connection.cursor.return_value.__enter__.return_value
+        db.obs.objects.aggregate.return_value = dict(latest=end_dt)
+        db.totals.objects.values.return_value.annotate.return_value.values_list.return_value = [
+            (w, end_dt - timedelta(minutes=15)) for w in (24, 48, 168)
+        ]
+        with mock.patch('trwwapi.rainfall.services.connection', db.connection), \
+            mock.patch('trwwapi.rainfall.services.transaction'), \
+            mock.patch('trwwapi.rainfall.services.RtrrObservation', db.obs), \
+            mock.patch('trwwapi.rainfall.services.RtrrRollingTotal', db.totals):
+            self.assertEqual(update_rtrr_rolling_totals(), end_dt)
+
+        # the lock is taken before the end of the totals and the latest
+        # observation are read
+        calls = [c[0] for c in db.mock_calls]
+        lock = calls.index('connection.cursor().__enter__().execute')
+        self.assertIn('pg_advisory_xact_lock', cursor.execute.call_args_list[0].args[0])
+        self.assertLess(lock, calls.index('obs.objects.aggregate'))
+        self.assertLess(lock, calls.index('totals.objects.values'))
+
+
+class TestRequestPlanner(SimpleTestCase):
+    """Tests for estimating the cost of high-level API requests
+    """
+
+    def test_count_matches_datetime_range(self):
+        delta = timedelta(minutes=15)
+        for start, end in [
+            ("2020-04-07T11:00:00-04:00", "2020-04-07T11:00:00-04:00"),
+            ("2020-04-07T11:00:00-04:00", "2020-04-07T11:10:00-04:00"),
+            ("2020-04-07T11:00:00-04:00", "2020-04-07T13:00:00-04:00"),
+            ("2020-04-07T11:05:00-04:00", "2020-04-09T13:00:00-04:00"),
+        ]:
+            start, end = parse(start), parse(end)
+            self.assertEqual(
+                count_datetime_range(start, end, delta), 
+                len(list(datetime_range(start, end, delta)))
+            )
+
+    def test_output_intervals(self):
+        start, end = parse("2020-04-07T00:00:00-04:00"), parse("2020-05-09T00:00:00-04:00")
+        self.assertEqual(count_output_intervals(start, end, INTERVAL_SUM, 3072), 1)
+        self.assertEqual(count_output_intervals(start, end, INTERVAL_DAILY, 3072), 32)
+        self.assertEqual(count_output_intervals(start, end, INTERVAL_MONTHLY, 3072), 2)
+
+    def test_plan_with_sensors(self):
+        args = dict(
+            start_dt=parse("2020-04-07T11:00:00-04:00"), 
+            end_dt=parse("2020-04-07T13:00:00-04:00"), 
+            rollup=INTERVAL_HOURLY,
+            sensor_ids="123,456,789", 
+            f="csv"
+        )
+        plan = plan_request(GarrObservation, args)
+        self.assertEqual(plan.sensor_ids, ["123", "456", "789"])
+        self.assertEqual(plan.interval_count, 8)
+        self.assertEqual(plan.record_count, 24)
+        self.assertEqual(plan.output_records, 6)
+        self.assertEqual(plan.queue, RAINFALL_DEFAULT_QUEUE)
+
+    def _large_request_args(self):
+        # ~2 months of 15-minute data for 100 pixels: over the large request
+        # threshold, but under the size valve
+        return dict(
+            start_dt="2020-01-01T00:00:00-05:00", 
+            end_dt="2020-03-01T00:00:00-05:00", 
+            rollup=INTERVAL_SUM,
+            pixels=",".join(str(i) for i in range(100))
+        )
+
+    def test_plan_large_request(self):
+        args = self._large_request_args()
+        plan = plan_request(GarrObservation, dict(
+            start_dt=parse(args['start_dt']), 
+            end_dt=parse(args['end_dt']),
+            rollup=args['rollup'],
+            sensor_ids=args['pixels']
+        ))
+        self.assertEqual(plan.queue, RAINFALL_LARGE_QUEUE)
+        self.assertLessEqual(plan.record_count, MAX_RECORDS)
+
+    def test_large_request_end_to_end(self):
+        request = Request(RequestFactory().get('/rainfall/v3/pixel/historic/', self._large_request_args()))
+        with mock.patch('trwwapi.rainfall.selectors.get_queue') as get_queue:
+            response = handle_request_for(GarrObservation, request)
+        get_queue.assert_called_once_with(RAINFALL_LARGE_QUEUE)
+        self.assertEqual(response.data['meta']['plan']['queue'], RAINFALL_LARGE_QUEUE)
+
+        # the job it queued runs rather than being turned away by the valve
+        job_func, model_class, raw_args = get_queue.return_value.enqueue.call_args.args
+        with mock.patch('trwwapi.rainfall.selectors.query_pgdb', return_value=[]) as query_pgdb:
+            result = job_func(model_class, raw_args)
+        query_pgdb.assert_called_once()
+        self.assertEqual(result['status_code'], 200)
+
+
+class TestSensorAvailabilityMonths(SimpleTestCase):
+    """Tests for the (local time) month boundaries used by the availability index
+    """
+
+    def test_month_bounds_local_time(self):
+        # just after midnight UTC on May 1 is still April locally
+        dt = parse("2020-05-01T02:00:00+00:00")
+        self.assertEqual(_month_start(dt).isoformat(), "2020-04-01T00:00:00-04:00")
+        self.assertEqual(_next_month_start(dt).isoformat(), "2020-05-01T00:00:00-04:00")
+
+    def test_month_bounds_year_end(self):
+        dt = parse("2020-12-15T12:00:00-05:00")
+        self.assertEqual(_month_start(dt).isoformat(), "2020-12-01T00:00:00-05:00")
+        self.assertEqual(_next_month_start(dt).isoformat(), "2021-01-01T00:00:00-05:00")
+
+
+class TestBestAvailableQuery(SimpleTestCase):
+    """Tests for splicing calibrated and provisional data
+    """
+
+    def test_query_params_line_up(self):
+        dts = [parse("2020-04-07T11:00:00-04:00"), parse("2020-04-07T13:00:00-04:00")]
+        watermark = parse("2020-04-07T12:00:00-04:00")
+        query, params = _build_best_available_query("garr", "rtrr", dts, watermark, ["123"])
+        self.assertEqual(query.count("%s"), len(params))
+        self.assertIn("union all", query)
+        self.assertEqual(params[-2], watermark)
+        self.assertEqual(params[-1], ("123",))
+
+    def test_tiers_survive_rollup(self):
+        results = [
+            dict(ts="2020-04-07T11:45:00-04:00", id="123", val=0.1, src="G", tier="calibrated"),
+            dict(ts="2020-04-07T12:15:00-04:00", id="123", val=0.2, src="R", tier="realtime"),
+        ]
+        rolled = aggregate_results_by_interval(results, INTERVAL_SUM)
+        self.assertEqual(len(rolled), 1)
+        self.assertEqual(sorted(rolled[0]['tier'].split(", ")), ["calibrated", "realtime"])
+
+
+class TestBestAvailableFormats(SimpleTestCase):
+    """Tests for the output formats of best-available (spliced) requests
+    """
+
+    rows = [
+        dict(ts="2020-04-07T11:45:00-04:00", id="123", val=0.1, src="G", tier="calibrated"),
+        dict(ts="2020-04-07T12:15:00-04:00", id="123", val=0.2, src="R", tier="realtime"),
+        dict(ts="2020-04-07T12:15:00-04:00", id="456", val=0.3, src="R", tier="realtime"),
+    ]
+
+    def _get(self, f):
+        raw_args = dict(
+            start_dt="2020-04-07T11:45:00-04:00", 
+            end_dt="2020-04-07T12:15:00-04:00",
+            rollup="15-minute",
+            pixels="123,456",
+            f=f
+        )
+        with mock.patch('trwwapi.rainfall.selectors.query_pgdb_best_available', return_value=list(self.rows)), \
+            mock.patch('trwwapi.rainfall.selectors.get_latest_timestamp', return_value=parse("2020-04-07T12:00:00-04:00")), \
+            mock.patch('trwwapi.rainfall.api_v2.core._get_sensor_geometries', return_value={"123": box(0, 0, 1, 1).__geo_interface__}):
+            return get_rainfall_data(GarrObservation, raw_args, provisional_model=RtrrObservation)
+
+    def test_csv(self):
+        response = self._get("csv")
+        rows = list(csv.DictReader(io.StringIO(response.data)))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['123-tier'], "calibrated")
+        self.assertEqual(rows[1]['123-tier'], "realtime")
+        self.assertEqual(rows[1]['456-src'], "R")
+        self.assertEqual(float(rows[1]['456']), 0.3)
+
+    def test_geojson(self):
+        response = self._get("geojson")
+        features = {f['id']: f for f in response['data']['features']}
+        self.assertEqual(
+            [d['tier'] for d in features["123"]['properties']['data']], 
+            ["calibrated", "realtime"]
+        )
+        self.assertAlmostEqual(features["123"]['properties']['total'], 0.3)
+        self.assertEqual(features["123"]['geometry']['type'], "Polygon")
+        # sensors without a geometry are still included
+        self.assertIsNone(features["456"]['geometry'])
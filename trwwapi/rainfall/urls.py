@@ -9,6 +9,9 @@ from .views import (
     RainfallGaugeApiView, 
     RainfallRtrrApiView, 
     RainfallRtrgApiView, 
+    RainfallBestAvailablePixelApiView,
+    ObservationIngestApiView,
+    SensorAvailabilityApiView,
     # get_latest_observation_timestamps_summary
     GarrObservationViewset, 
     GaugeObservationViewset, 
@@ -66,6 +69,9 @@ urlpatterns = [
     # path('v2/pixel/raw/<str:jobid>/', RainfallRtrrApiView.as_view()),
     # path('v2/radar/realtime/<str:jobid>/',  RainfallRtrrApiView.as_view()),
     # path('v2/radar/raw/<str:jobid>/',  RainfallRtrrApiView.as_view()),
+    # GARR + RTRR
+    path('v2/pixel/best/', RainfallBestAvailablePixelApiView.as_view()),
+    path('v2/pixel/best/<str:jobid>/', RainfallBestAvailablePixelApiView.as_view()),
     # GAUGE
     path('v2/gauge/historic/', RainfallGaugeApiView.as_view()),
     # path('v2/gauge/calibrated/', RainfallGaugeApiView.as_view()),
@@ -77,6 +83,16 @@ urlpatterns = [
     path('v2/gauge/realtime/<str:jobid>/', RainfallRtrgApiView.as_view()),
     # path('v2/gauge/raw/<str:jobid>/', RainfallRtrgApiView.as_view()),
 
+    # --------------------------
+    # ingestion
+
+    path('v2/ingest/<str:source>/', ObservationIngestApiView.as_view()),
+
+    # --------------------------
+    # data availability
+
+    path('v2/availability/<str:source>/', SensorAvailabilityApiView.as_view()),
+
     # --------------------------
     # custom routes (for function-based views)
     # path('v2/latest-observations/', LatestObservationTimestampsSummary.as_view({'get': 'list'})),
@@ -1,21 +1,30 @@
+from dataclasses import asdict
 from datetime import timedelta
+import hashlib
 # from django.contrib.auth.models import User, Group
 from django.utils.safestring import mark_safe
 from django.conf import settings
 from django_filters import filters
 from django.contrib.gis.geos import Point
+from django.db import connection
+from django.db.models import JSONField
+from django.db.models.expressions import RawSQL
 from django.shortcuts import render
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.generics import GenericAPIView
-from rest_framework import viewsets, permissions, routers
+from rest_framework import viewsets, permissions, routers, status
 from rest_framework.decorators import api_view
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
 from django_filters.rest_framework import FilterSet, DjangoFilterBackend
 
 
 
-from ..common.config import TZI
+from ..common.config import TZI, DELIMITER
+from ..common.renderers import get_high_volume_renderer_classes
 # from .api_v2.config import TZI
 
 from .serializers import (
@@ -23,17 +32,23 @@ from .serializers import (
     GaugeObservationSerializer, 
     RtrrObservationSerializer, 
     RtrgObservationSerializer,
-    RainfallEventSerializer
+    RainfallEventSerializer,
+    IngestObservationSerializer,
+    IngestWatermarkSerializer,
+    projected_observation_serializer
 )
 from .selectors import (
     handle_request_for,
-    get_latest_garrobservation,
-    get_latest_gaugeobservation,
-    get_latest_rainfallevent,
-    get_latest_rtrgobservation,
-    get_latest_rtrrobservation,
-    get_rainfall_total_for
+    get_latest_timestamp,
+    get_latest_observation_timestamps,
+    get_ingest_versions,
+    get_ingest_watermarks,
+    get_pixel_ids_for_point,
+    get_rainfall_total_for,
+    get_rtrr_rolling_total_for,
+    get_sensor_availability
 )
+from .services import ingest_observations
 from .models import (
     GarrObservation, 
     GaugeObservation, 
@@ -41,7 +56,9 @@ from .models import (
     RtrgObservation,
     RainfallEvent, 
     Pixel, 
-    Gauge
+    Gauge,
+    IngestWatermark,
+    OBSERVATION_MODEL_LOOKUP
 )
 
 
@@ -70,48 +87,88 @@ class ApiDefaultRouter(routers.DefaultRouter):
 # HIGH-LEVEL API VIEWS
 # these are the views that do the work for us
 
-class RainfallGaugeApiView(GenericAPIView):
-    """Rain Gauge data, fully QA/QC'd and provided by 3RWW + ALCOSAN.
+class RainfallApiView(GenericAPIView):
+    """Base view for the high-level rainfall API endpoints. New requests for 
+    data are submitted via POST. The resulting job URL can be polled with 
+    either POST or GET.
     """
 
-    # def get(self, request, *args, **kwargs):
-    #     return handle_request_for(GaugeObservation, request, *args, **kwargs)
+    rainfall_model = None
+    # if set, rainfall_model is the calibrated source and this fills in after it
+    provisional_model = None
+    renderer_classes = get_high_volume_renderer_classes()
+
+    def get(self, request, *args, **kwargs):
+        # GET is only supported for checking on an existing job
+        if 'jobid' not in kwargs.keys():
+            return self.http_method_not_allowed(request, *args, **kwargs)
+        return handle_request_for(self.rainfall_model, request, *args, provisional_model=self.provisional_model, **kwargs)
 
     def post(self, request, *args, **kwargs):
-        return handle_request_for(GaugeObservation, request, *args, **kwargs)
+        return handle_request_for(self.rainfall_model, request, *args, provisional_model=self.provisional_model, **kwargs)
 
 
-class RainfallGarrApiView(GenericAPIView):
-    """Gauge-Adjusted Radar Rainfall Data. Radar-based rainfall estimated calibrated with rain gauges, interpolated to 1km pixels. Historic data only. Provided by Vieux Associates.
+class RainfallGaugeApiView(RainfallApiView):
+    """Rain Gauge data, fully QA/QC'd and provided by 3RWW + ALCOSAN.
     """
+    rainfall_model = GaugeObservation
 
-    # def get(self, request, *args, **kwargs):
-    #     return handle_request_for(GarrObservation, request, *args, **kwargs)
 
-    def post(self, request, *args, **kwargs):
-        return handle_request_for(GarrObservation, request, *args, **kwargs)
+class RainfallGarrApiView(RainfallApiView):
+    """Gauge-Adjusted Radar Rainfall Data. Radar-based rainfall estimated calibrated with rain gauges, interpolated to 1km pixels. Historic data only. Provided by Vieux Associates.
+    """
+    rainfall_model = GarrObservation
 
 
-class RainfallRtrrApiView(GenericAPIView):
+class RainfallRtrrApiView(RainfallApiView):
     """Real-time Radar Rainfall data. Provided through Vieux Associates. Data is provisional and has not be through a QA/QC process.
     """        
+    rainfall_model = RtrrObservation
 
-    # def get(self, request, *args, **kwargs):
-    #     return handle_request_for(RtrrObservation, request, *args, **kwargs)
 
-    def post(self, request, *args, **kwargs):
-        return handle_request_for(RtrrObservation, request, *args, **kwargs)
+class RainfallBestAvailablePixelApiView(RainfallApiView):
+    """Best-available radar rainfall data: calibrated, gauge-adjusted radar rainfall where it's available, and real-time radar rainfall (provisional) after that, from a single request. Each record's `tier` says which one it is.
+    """
+    rainfall_model = GarrObservation
+    provisional_model = RtrrObservation
 
 
-class RainfallRtrgApiView(GenericAPIView):
+class RainfallRtrgApiView(RainfallApiView):
     """Real-time Rain Gauge data. Provided through Datawise. Data is provisional and has not be through a QA/QC process.
     """    
+    rainfall_model = RtrgObservation
 
-    # def get(self, request, *args, **kwargs):
-    #     return handle_request_for(RtrgObservation, request, *args, **kwargs)
 
-    def post(self, request, *args, **kwargs):
-        return handle_request_for(RtrgObservation, request, *args, **kwargs)
+class ObservationIngestApiView(APIView):
+    """Bulk ingestion of observations (admin only). POST a list of records, 
+    each with a `timestamp` and `data` (sensor ids mapped to [value, metadata]),
+    to upsert them into the table for the source (garr, gauge, rtrr, rtrg). 
+    Data for existing timestamps is merged unless `?replace=true`. GET returns 
+    the table's ingestion watermark.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def _get_model(self, source):
+        try:
+            return OBSERVATION_MODEL_LOOKUP[source]
+        except KeyError:
+            raise NotFound("Unknown source '{0}'. Use one of: {1}".format(source, ", ".join(OBSERVATION_MODEL_LOOKUP.keys())))
+
+    def get(self, request, source):
+        model = self._get_model(source)
+        wm = IngestWatermark.objects.filter(table=model._meta.object_name).first()
+        if wm is None:
+            wm = IngestWatermark(table=model._meta.object_name, modified=None)
+        return Response(IngestWatermarkSerializer(wm).data)
+
+    def post(self, request, source):
+        model = self._get_model(source)
+        serializer = IngestObservationSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        replace = request.query_params.get('replace', 'false').lower() in ['true', '1', 'yes']
+        result = ingest_observations(model, serializer.validated_data, merge=not replace)
+        return Response(asdict(result), status=status.HTTP_201_CREATED)
 
 
 # -------------------------------------------------------------------
@@ -119,16 +176,165 @@ class RainfallRtrgApiView(GenericAPIView):
 # These return paginated data from the tables in the database as-is.
 # They show up in the django-rest-framework's explorable API pages.
 
-class PixelResultsSetPagination(PageNumberPagination):
-    page_size = 1
+def get_projected_sensor_ids(request):
+    """parse the sensor ids from the `sensors` query parameter, used to project
+    the observation `data` field down to selected sensors. Returns an empty 
+    list if not provided.
+    """
+    if request is None:
+        return []
+    return [
+        i.strip() for i in request.query_params.get('sensors', '').split(DELIMITER) 
+        if i.strip()
+    ]
+
+def parse_page_size(value, max_page_size):
+    """parse a requested page size: a positive integer, capped at 
+    max_page_size. Raises ValueError for anything else.
+    """
+    page_size = int(value)
+    if page_size <= 0:
+        raise ValueError("page size must be a positive integer")
+    return min(page_size, max_page_size)
+
+class ObservationCursorPagination(CursorPagination):
+    """Keyset pagination over the (unique, indexed) observation timestamp. 
+    Pages are fetched by filtering on the timestamp in the (opaque) cursor 
+    rather than with an OFFSET, and there is no COUNT(*), so paging deep into 
+    the table costs the same as getting the first page.
+
+    When the request projects the data down to selected sensors (`?sensors=`), 
+    rows are much smaller and so pages can be larger: up to 
+    `projected_max_values` sensor values per page.
+    """
+    ordering = '-timestamp'
     page_size_query_param = 'page_size'
+    projected_page_size = 96
+    projected_max_values = 100000
+
+    def get_page_size(self, request):
+        sensor_ids = get_projected_sensor_ids(request)
+        if not sensor_ids:
+            return super().get_page_size(request)
+
+        max_page_size = max(1, self.projected_max_values // len(sensor_ids))
+        try:
+            return parse_page_size(
+                request.query_params[self.page_size_query_param],
+                max_page_size
+            )
+        except (KeyError, ValueError):
+            return min(self.projected_page_size, max_page_size)
+
+class PixelCursorPagination(ObservationCursorPagination):
+    # full pixel records are large, so unprojected pages are small
+    page_size = 1
     max_page_size = 3
 
-class GaugeResultsSetPagination(PageNumberPagination):
+class GaugeCursorPagination(ObservationCursorPagination):
     page_size = 5
-    page_size_query_param = 'page_size'
     max_page_size = 10
 
+class RainfallEventCursorPagination(CursorPagination):
+    """Keyset pagination over the (indexed) end of rainfall events. Event end 
+    times aren't guaranteed to be unique, so the id breaks ties to keep the 
+    ordering stable.
+    """
+    ordering = ('-end_dt', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+class ConditionalRequestMixin():
+    """Adds ETag and Last-Modified headers to a viewset's list and retrieve
+    responses, and returns 304 Not Modified when the client's copy is current. 
+    
+    Both are derived from the latest value of `conditional_timestamp_field` in
+    the viewset's table, so checking for changes costs a single aggregate query
+    on an indexed field rather than a full response. So that corrections to 
+    existing rows (which don't move the latest timestamp) count as changes, 
+    the ETag also includes the table's ingest version, and Last-Modified is 
+    the later of the latest timestamp and when the table was last written to.
+    """
+
+    conditional_timestamp_field = 'timestamp'
+
+    def _get_latest_timestamp(self, request, *args, **kwargs):
+        # memoized on the request, since both the ETag and Last-Modified use it
+        if not hasattr(request, '_latest_timestamp'):
+            request._latest_timestamp = get_latest_timestamp(
+                self.queryset.model, 
+                self.conditional_timestamp_field
+            )
+        return request._latest_timestamp
+
+    def _get_last_modified(self, request, *args, **kwargs):
+        latest = self._get_latest_timestamp(request)
+        written = get_ingest_watermarks().get(self.queryset.model._meta.object_name, {}).get('modified')
+        return max([dt for dt in [latest, written] if dt is not None], default=None)
+
+    def _get_etag(self, request, *args, **kwargs):
+        latest = self._get_latest_timestamp(request)
+        version = get_ingest_versions().get(self.queryset.model._meta.object_name, "")
+        # the same data may be represented differently depending on the 
+        # query string (e.g., pages) and the renderer (Accept header)
+        return hashlib.md5("|".join([
+            latest.isoformat() if latest else "",
+            version,
+            request.get_full_path(),
+            request.META.get('HTTP_ACCEPT', '')
+        ]).encode()).hexdigest()
+
+    def _conditional(self, view_func):
+        return condition(
+            etag_func=self._get_etag, 
+            last_modified_func=self._get_last_modified
+        )(view_func)
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(super().list)(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(super().retrieve)(request, *args, **kwargs)
+
+
+class SensorProjectionMixin():
+    """Lets clients get values for only selected sensors from an observation 
+    viewset with `?sensors=<id>,<id>,...`. 
+    
+    The projection happens in the database: the `data` field is deferred and 
+    only the requested keys are pulled out of the JSON, so the full record 
+    never comes over the wire.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        sensor_ids = get_projected_sensor_ids(getattr(self, 'request', None))
+        if sensor_ids:
+            data_column = "{0}.{1}".format(
+                connection.ops.quote_name(queryset.model._meta.db_table),
+                connection.ops.quote_name('data')
+            )
+            queryset = queryset\
+                .defer('data')\
+                .annotate(projected_data=RawSQL(
+                    """(
+                        select coalesce(jsonb_object_agg(k, {0} -> k), '{{}}'::jsonb) 
+                        from unnest(%s::text[]) as k 
+                        where {0} ? k
+                    )""".format(data_column),
+                    (sensor_ids,),
+                    output_field=JSONField()
+                ))
+        return queryset
+
+    def get_serializer_class(self):
+        serializer_class = super().get_serializer_class()
+        if get_projected_sensor_ids(getattr(self, 'request', None)):
+            return projected_observation_serializer(serializer_class)
+        return serializer_class
+
+
 class RainfallEventFilter(FilterSet):
     event_after = filters.DateFilter(field_name="start_dt", lookup_expr="gte")
     event_before = filters.DateFilter(field_name="end_dt", lookup_expr="lte")
@@ -137,20 +343,23 @@ class RainfallEventFilter(FilterSet):
         model = RainfallEvent
         fields = ['event_label', 'start_dt', 'end_dt']
 
-class RainfallEventViewset(viewsets.ReadOnlyModelViewSet):
+class RainfallEventViewset(ConditionalRequestMixin, viewsets.ReadOnlyModelViewSet):
     """
     Get a lists of rainfall event time periods in Allegheny County since 2000. Events are identified by Vieux Associates; more detail on each event is provided in Vieux's monthly report to 3 Rivers Wet Weather. Please note that the list is not comprehensive.
     """
 
     queryset = RainfallEvent.objects.all()
     serializer_class = RainfallEventSerializer
+    # events are edited in place, so use their modification time
+    conditional_timestamp_field = 'modified'
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     lookup_field = 'event_label'
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RainfallEventFilter
+    pagination_class = RainfallEventCursorPagination
 
 
-class GarrObservationViewset(viewsets.ReadOnlyModelViewSet):
+class GarrObservationViewset(ConditionalRequestMixin, SensorProjectionMixin, viewsets.ReadOnlyModelViewSet):
     """
     Get calibrated, gauge-adjusted radar rainfall observations for 15-minute time intervals. Data created by Vieux Associates for 3 Rivers Wet Weather from available NEXRAD and local rain gauges.
     """    
@@ -158,10 +367,10 @@ class GarrObservationViewset(viewsets.ReadOnlyModelViewSet):
     serializer_class  = GarrObservationSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     lookup_field = 'timestamp'
-    pagination_class = PixelResultsSetPagination
+    pagination_class = PixelCursorPagination
 
 
-class GaugeObservationViewset(viewsets.ReadOnlyModelViewSet):
+class GaugeObservationViewset(ConditionalRequestMixin, SensorProjectionMixin, viewsets.ReadOnlyModelViewSet):
     """
     Get QA/QC'd rainfall gauge observations for 15-minute time intervals. Data captured by 3 Rivers Wet Weather and ALCOSAN.
     """
@@ -169,9 +378,9 @@ class GaugeObservationViewset(viewsets.ReadOnlyModelViewSet):
     serializer_class  = GaugeObservationSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     lookup_field='timestamp'
-    pagination_class = GaugeResultsSetPagination
+    pagination_class = GaugeCursorPagination
 
-class RtrrObservationViewset(viewsets.ReadOnlyModelViewSet):
+class RtrrObservationViewset(ConditionalRequestMixin, SensorProjectionMixin, viewsets.ReadOnlyModelViewSet):
     """
     Get real-time radar rainfall observations for 15-minute time intervals. Data captured by Vieux Associates from NEXRAD radar in Moon Township, PA for 3 Rivers Wet Weather. Please note that this data is provisional.
     """  
@@ -179,9 +388,9 @@ class RtrrObservationViewset(viewsets.ReadOnlyModelViewSet):
     serializer_class  = RtrrObservationSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     lookup_field='timestamp'
-    pagination_class = PixelResultsSetPagination
+    pagination_class = PixelCursorPagination
 
-class RtrgbservationViewset(viewsets.ReadOnlyModelViewSet):
+class RtrgbservationViewset(ConditionalRequestMixin, SensorProjectionMixin, viewsets.ReadOnlyModelViewSet):
     """
     Get real-time rainfall gauge observations for 15-minute time intervals. Data captured by 3 Rivers Wet Weather and Datawise. Please note that this data is provisional and that observations may be missing due to technical/transmission difficulties.
     """
@@ -189,27 +398,49 @@ class RtrgbservationViewset(viewsets.ReadOnlyModelViewSet):
     serializer_class  = RtrgObservationSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     lookup_field='timestamp'
-    pagination_class = GaugeResultsSetPagination
+    pagination_class = GaugeCursorPagination
 
 # -------------------------------------------------------------------
 # HELPER VIEWS
 # These provide helpers for specific use cases
 
+def _get_latest_observation_timestamps(request, *args, **kwargs):
+    # memoized on the request, since the ETag, Last-Modified, and response 
+    # all use it
+    if not hasattr(request, '_latest_observation_timestamps'):
+        request._latest_observation_timestamps = get_latest_observation_timestamps()
+    return request._latest_observation_timestamps
+
+def _latest_observation_timestamps_etag(request, *args, **kwargs):
+    raw_summary = _get_latest_observation_timestamps(request)
+    # the ingest versions change with corrections to existing rows too
+    versions = get_ingest_versions()
+    return hashlib.md5("|".join([
+        "{0}={1}".format(k, v.isoformat() if v is not None else "")
+        for k, v in raw_summary.items()
+    ] + [
+        "{0}={1}".format(k, versions[k]) for k in sorted(versions.keys())
+    ] + [request.META.get('HTTP_ACCEPT', '')]).encode()).hexdigest()
+
+def _latest_observation_timestamps_last_modified(request, *args, **kwargs):
+    raw_summary = _get_latest_observation_timestamps(request)
+    # corrections to existing rows don't move the latest timestamps
+    written = [w['modified'] for w in get_ingest_watermarks().values()]
+    return max([v for v in list(raw_summary.values()) + written if v is not None], default=None)
+
 # @api_view(['GET'])
 # def get_latest_observation_timestamps_summary(request):
 class LatestObservationTimestampsSummary(viewsets.ReadOnlyModelViewSet):
     
+    @method_decorator(condition(
+        etag_func=_latest_observation_timestamps_etag,
+        last_modified_func=_latest_observation_timestamps_last_modified
+    ))
     def list(self, request, format=None):
-        raw_summary = {
-            "calibrated-radar": get_latest_garrobservation(),
-            "calibrated-gauge": get_latest_gaugeobservation(),
-            "realtime-radar": get_latest_rtrrobservation(),
-            "realtime-gauge": get_latest_rtrgobservation(),
-            "rainfall-events": get_latest_rainfallevent(),
-        }
+        raw_summary = _get_latest_observation_timestamps(request)
 
         summary = {
-            k: v.timestamp.astimezone(TZI).isoformat() if v is not None else None
+            k: v.astimezone(TZI).isoformat() if v is not None else None
             for k, v in 
             raw_summary.items()
         }
@@ -217,6 +448,23 @@ class LatestObservationTimestampsSummary(viewsets.ReadOnlyModelViewSet):
         return Response(summary)
 
 
+class SensorAvailabilityApiView(APIView):
+    """Where data exists for each sensor of a source (garr, gauge, rtrr, rtrg): 
+    the first and last observation, and the number of intervals recorded and 
+    the number of those that are N/D. Limit to specific sensors with 
+    `?sensors=`; add `?by_month=true` for the monthly breakdown.
+    """
+
+    def get(self, request, source):
+        try:
+            model = OBSERVATION_MODEL_LOOKUP[source]
+        except KeyError:
+            raise NotFound("Unknown source '{0}'. Use one of: {1}".format(source, ", ".join(OBSERVATION_MODEL_LOOKUP.keys())))
+
+        by_month = request.query_params.get('by_month', 'false').lower() in ['true', '1', 'yes']
+        return Response(get_sensor_availability(model, get_projected_sensor_ids(request), by_month))
+
+
 def _get_myrain_for(request, back_to: timedelta, back_to_text: str):
     text ="That didn't work."
 
@@ -227,12 +475,14 @@ def _get_myrain_for(request, back_to: timedelta, back_to_text: str):
     if all([lat, lng]):
 
         p = Point(float(lng), float(lat)) #, srid=srid if srid else 4326)
-        p.srid = srid if srid else 4326
-        pixels = Pixel.objects.filter(geom__contains=p)
+        p.srid = int(srid) if srid else 4326
+        pixel_ids = get_pixel_ids_for_point(p)
 
-        if len(list(pixels)) > 0:
+        if len(pixel_ids) > 0:
 
-            total = get_rainfall_total_for(RtrrObservation, [pixel.pixel_id for pixel in pixels], timedelta(days=2))
+            total = get_rtrr_rolling_total_for(pixel_ids, back_to)
+            if total is None:
+                total = get_rainfall_total_for(RtrrObservation, pixel_ids, back_to)
 
             if total:
                 text = """According to 3 Rivers Wet Weather, your location received approximately {0} inches of rainfall {1}.""".format(total, back_to_text)
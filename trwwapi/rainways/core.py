@@ -1,28 +1,54 @@
 """Rainways core logic
 """
 
+import hashlib
+import json
+import threading
 from typing import List, Tuple
-from dataclasses import field
+from dataclasses import dataclass, field
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from time import perf_counter
 
 from marshmallow_dataclass import dataclass as mdc
 import requests
-import rasterio
-from rasterio import mask as rasterio_mask
 import geopandas as gpd
+import pandas as pd
 import numpy as np
 import petl as etl
 from codetiming import Timer
+from shapely.ops import transform as shapely_transform
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.geometry.polygon import orient
+from django_rq import get_queue
 from dateutil.relativedelta import relativedelta
+from django.db import connection
 
-from ..rainfall.api_v3.core import query_one_sensor_rollup_monthly
+from ..rainfall.api_v3.core import query_one_sensor_rollup_monthly, query_sensors_rollup_monthly
+from ..rainfall.selectors import get_pixel_ids_for_point
 from ..rainfall.models import (
     RtrrObservation, 
     Pixel
 )
 from ..common.config import (
     RAINWAYS_DEFAULT_CRS, 
-    RAINWAYS_RESOURCES # TODO: replace with database query
+    RAINWAYS_RESOURCES, # TODO: replace with database query
+    RAINWAYS_MIRRORED_LAYERS,
+    RAINWAYS_RASTER_LAYERS,
+    RAINWAYS_STAGE_TIMEOUT,
+    RAINWAYS_JOB_STAGE_TIMEOUT,
+    RAINWAYS_RESULT_CACHE_TOLERANCE,
+    RAINWAYS_RESULT_CACHE_TTL
+)
+from .feature_cache import get_features_for_bbox
+from .rasters import raster_pool, read_masked_window
+from .zonal import zonal_stats
+from .overlay import intersection_areas
+from .selectors import (
+    get_mirrored_resources,
+    get_mirrored_features,
+    clip_and_dissolve_mirrored_features,
+    get_layer_versions
 )
 
 
@@ -39,6 +65,29 @@ class RasterSummaryStat:
     max: float = None
     avg: float = None
     std: float = None
+    count: int = None
+    percentiles: dict = None
+    histogram: dict = None
+    # index of the AOI feature summarized, or None for the whole AOI
+    feature: int = None
+
+
+@dataclass
+class StageResult:
+    """what an analysis stage produced: values to add to the analysis results
+    (by result field, or for a batch by feature and then field), messages, and
+    whether it failed. Stages return these rather than updating the analysis,
+    so a stage that runs past its timeout can't change the results.
+    """
+    results: dict = field(default_factory=dict)
+    messages: List[str] = field(default_factory=list)
+    failed: bool = False
+
+
+class StageCancelled(Exception):
+    """raised by a stage that the analysis has stopped waiting for, at its 
+    next check (see `RwCore.check_cancelled`)
+    """
 
 
 @mdc
@@ -53,11 +102,47 @@ class RwPublicResult:
     rainfall: List[dict] = field(default_factory=list)
 
 
+def _start_ring_at_lowest(coords):
+    coords = list(coords)[:-1]
+    i = coords.index(min(coords))
+    return coords[i:] + coords[:i]
+
+
+def normalize_polygons(geom):
+    """a normalized form of a (multi)polygon, so that the same area drawn
+    differently compares equal: rings are oriented (exterior 
+    counter-clockwise, holes clockwise) and start at their lowest vertex, and
+    holes and the parts of multipolygons are sorted. Other geometries are 
+    returned as is.
+
+    Shapely 2 has `normalize` for this; the locked Shapely (1.7) does not.
+    """
+    if isinstance(geom, MultiPolygon):
+        parts = [normalize_polygons(p) for p in geom.geoms]
+        return MultiPolygon(sorted(parts, key=lambda p: list(p.exterior.coords)))
+    if not isinstance(geom, Polygon) or geom.is_empty:
+        return geom
+    geom = orient(geom, 1.0)
+    return Polygon(
+        _start_ring_at_lowest(geom.exterior.coords),
+        sorted([_start_ring_at_lowest(r.coords) for r in geom.interiors])
+    )
+
+
 class RwCore():
     
     def __init__(self) -> None:
         self.status = 'success'
         self.messages = []
+        # set when the analysis stops waiting on its stages
+        self.cancelled = threading.Event()
+
+    def check_cancelled(self):
+        """stop a stage (before its next query or read) if the analysis is no
+        longer waiting for it
+        """
+        if self.cancelled.is_set():
+            raise StageCancelled()
 
     def clip_cog(
         self, 
@@ -85,12 +170,10 @@ class RwCore():
             # open the COG (see https://rasterio.readthedocs.io/en/latest/topics/vsi.html#aws-s3)
             # (note that internally rasterio uses boto3, which expects AWS access credentials
             # to be available in the environment if the object or bucket is not public.)
-            with rasterio.open(cog_on_s3) as src:
-                # read just the geometry of the input geojson features
-                # shapes = [f["geometry"] for f in geojson_dict['features']]
-                shapes = list(clipping_mask_gdf.geometry)
-                # read the raster data in using rasterio's mask function
-                arr, out_transform = rasterio_mask.mask(src, shapes, crop=True, filled=False)
+            # The dataset is reused across requests (see rasters.RasterPool).
+            with raster_pool.dataset(cog_on_s3) as src:
+                # read the part of the raster that overlaps the clipping geometry
+                arr = read_masked_window(src, list(clipping_mask_gdf.geometry))
 
             return True, arr
         except Exception as e:
@@ -101,69 +184,56 @@ class RwCore():
         feature_layer_query_url: str,
         feature_layer_fields: list,
         clipping_mask_gdf: gpd.GeoDataFrame,
-        clipping_mask_bbox: list,
-        in_epsg_code: int = 4326,
         out_epsg_code: int = RAINWAYS_DEFAULT_CRS,
-        geometry_field: str = "geometry"
+        geometry_field: str = "geometry",
+        area_only: bool = False
         ) -> Tuple[bool, gpd.GeoDataFrame]:
         """[summary]
 
-        Args:
-
-            feature_layer_query_url
-            geojson_dict (dict):
-
         Args:
             feature_layer_query_url (str): URL to the Esri feature layer query endpoint, e.g., ending with .../FeatureServer/0/query
+            feature_layer_fields (list): list of fields to return from the feature layer and use for the dissolve.
             clipping_mask_gdf (dict): clipping geometry as a geodataframe
-            clipping_mask_bbox (list): bounding box coordinates of the clipping geometry
-            in_epsg_code (int, optional): [description]. Defaults to RAINWAYS_DEFAULT_CRS.
             out_epsg_code (int, optional): [description]. Defaults to RAINWAYS_DEFAULT_CRS.
-            feature_layer_fields (list): list of fields to return from the feature layer and use for the. Defaults to "*" (all field).
+            area_only (bool, optional): only return the area of each group, not its geometry (faster). Defaults to False.
         """
 
+        # reproject the clipping mask if it's not already what it needs to be 
+        # (as a copy: the mask is shared with the other analysis stages)
+        if not clipping_mask_gdf.crs.is_exact_same(out_epsg_code):
+            clipping_mask_gdf = clipping_mask_gdf.to_crs(epsg=out_epsg_code)
+
         # First, filter: use the bounding box to find features in the service 
         # that overlap our geojson. This speeds things up by limiting the 
         # number of features we have to request over the wire for the 
-        # intersect / clipping.
-
-
-        overlapping_target_features = requests.get(
-            feature_layer_query_url,
-            params=dict(
-                where="1=1",
-                outFields=",".join([str(f) for f in feature_layer_fields]),
-                returnGeometry='true',
-                geometry=','.join([str(x) for x in clipping_mask_bbox]),
-                inSR=in_epsg_code,
-                geometryType='esriGeometryEnvelope',
-                spatialRel='esriSpatialRelIntersects',
-                outSR=out_epsg_code,
-                f='geojson'
+        # intersect / clipping. Features are cached by tile, so overlapping
+        # and neighbouring AOIs reuse them (see feature_cache).
+        try:
+            overlapping_target_features = get_features_for_bbox(
+                feature_layer_query_url,
+                feature_layer_fields,
+                list(clipping_mask_gdf.total_bounds),
+                epsg_code=out_epsg_code
             )
-        ) # this returns a requests.Response object
-        # print(overlapping_target_features.json())
-        if 'error' in overlapping_target_features.json().keys():
-            return False, overlapping_target_features.json()
-
-        # load the geojson into a geodataframe
-        # with fiona.BytesCollection(bytes(overlapping_target_features.content)) as f:
-        #     overlapping_target_features_gdf = gpd.GeoDataFrame\
-        #         .from_features(f, crs=f.crs)\
-        #         .set_geometry('geometry', inplace=True)
+        except (requests.RequestException, ValueError) as e:
+            return False, dict(error=dict(message=str(e), details=[]))
+        self.check_cancelled()
 
         overlapping_target_features_gdf = gpd.GeoDataFrame\
             .from_features(
-                overlapping_target_features.json(), 
+                overlapping_target_features, 
                 crs=out_epsg_code
             )
-        # print(overlapping_target_features_gdf)
-            #.set_geometry('geometry', inplace=True)
 
-        # reproject the clipping mask if it's not already what it needs to be
-        if not clipping_mask_gdf.crs.is_exact_same(out_epsg_code):
-            clipping_mask_gdf.to_crs(epsg=out_epsg_code, inplace=True)
-        # print(clipping_mask_gdf)
+        if area_only:
+            # sum the areas of the clipped features, without dissolving them
+            if overlapping_target_features_gdf.empty:
+                return True, pd.DataFrame(columns=list(feature_layer_fields) + ['area', 'area_pct'])
+            return True, intersection_areas(
+                clipping_mask_gdf[[geometry_field]],
+                overlapping_target_features_gdf,
+                feature_layer_fields
+            )
 
         # Overlay the two dataframes and dissolve on the fields specified
         dissolved = gpd\
@@ -181,6 +251,8 @@ class RwCore():
 
 class RwPublicAnalysis(RwCore):
 
+    result_cache_prefix = "aoi-result"
+
     def __init__(
         self, 
         aoi_geojson, 
@@ -219,108 +291,245 @@ class RwPublicAnalysis(RwCore):
         # instantiate a results dataclass
         self.results = RwPublicResult()
 
-    @Timer(name="rwpub__soil_summary", text="{name}: {:.4f}s")
-    def soil_summary(self):
+        # seconds taken by each stage of the analysis
+        self.timings = {}
 
-        success, result = self.clip_and_dissolve_esri_feature_layer(
-            feature_layer_query_url=RAINWAYS_RESOURCES['soils'],
-            feature_layer_fields=['SOIL_HYDRO'],
-            clipping_mask_gdf=self.aoi_gdf,
-            clipping_mask_bbox=self.aoi_bbox,
-            in_epsg_code=self.aoi_gdf_epsg
-        )
-        if success:
-            # post-process the dataframe; add additional field
-            t = etl\
-                .fromdataframe(result)\
-                .cutout('geometry')\
-                .addfield('area_acres', lambda r: r['area'] * 0.00002295682)
-
-            # convert to list of dictionaries
-            results = list(etl.dicts(t))
-            
-            self.results.soils.extend(results)
+        # the locally mirrored feature layers, looked up once and shared by 
+        # the stages
+        self._mirrored_resources = None
+        self._mirrored_resources_lock = threading.Lock()
 
-            return results
+    def mirrored_resource(self, layer):
+        """the Resource for a layer's local mirror, or None if it hasn't been 
+        mirrored
+        """
+        with self._mirrored_resources_lock:
+            if self._mirrored_resources is None:
+                self._mirrored_resources = get_mirrored_resources()
+        return self._mirrored_resources.get(layer)
 
-        else:
-            
-            self.status = 'failed'
-            messages = result['error']['details'] + result['message']
-            self.messages.extend(messages)
+    def aoi_area(self):
+        """area of the AOI, in square units of RAINWAYS_DEFAULT_CRS
+        """
+        return float(self.aoi_gdf.to_crs(epsg=RAINWAYS_DEFAULT_CRS).area.sum())
+
+    def summary(self):
+        """the results, messages and metadata of the analysis, as returned by
+        the API
+        """
+        return dict(
+            data=RwPublicResult.Schema().dump(self.results),
+            status=self.status,
+            messages=self.messages,
+            meta={"count": len(self.aoi_gdf.index), "timings": self.timings}
+        )
 
+    def result_cache_key(self):
+        """cache key for the results of analyzing this AOI with the current 
+        versions of the layers. The AOI's features are reprojected, snapped 
+        to RAINWAYS_RESULT_CACHE_TOLERANCE and normalized (ring orientation 
+        and starting vertex), so the same area drawn again gets the same key.
+        """
+        tolerance = RAINWAYS_RESULT_CACHE_TOLERANCE
+        snap = lambda x, y, z=None: (np.round(np.asarray(x) / tolerance) * tolerance, np.round(np.asarray(y) / tolerance) * tolerance)
+        geoms = [
+            normalize_polygons(shapely_transform(snap, g)).wkb_hex
+            for g in self.aoi_gdf.to_crs(epsg=RAINWAYS_DEFAULT_CRS).geometry
+        ]
+        # the rainfall summary covers the last six whole months
+        month = datetime.now().strftime("%Y-%m")
+        digest = hashlib.sha256(json.dumps(
+            dict(geoms=geoms, layers=get_layer_versions(), month=month),
+            sort_keys=True
+        ).encode()).hexdigest()
+        return "trwwapi:rainways:{0}:{1}".format(self.result_cache_prefix, digest)
+
+    def get_cached_summary(self, key=None):
+        payload = get_queue().connection.get(key or self.result_cache_key())
+        if payload is None:
             return None
+        summary = json.loads(payload)
+        summary['meta']['cached'] = True
+        return summary
 
-    @Timer(name="rwpub__sustain_summary", text="{name}: {:.4f}s")
-    def sustain_summary(self):
-        success, result = self.clip_and_dissolve_esri_feature_layer(
-            feature_layer_query_url=RAINWAYS_RESOURCES['sustain'],
-            feature_layer_fields=['GI_Type'],
-            clipping_mask_gdf=self.aoi_gdf,
-            clipping_mask_bbox=self.aoi_bbox,
-            in_epsg_code=self.aoi_gdf_epsg
+    def cache_summary(self, summary, key=None):
+        """cache the summary of a successful analysis
+        """
+        if summary['status'] != 'success':
+            return
+        get_queue().connection.set(
+            key or self.result_cache_key(),
+            json.dumps(summary, default=str),
+            ex=RAINWAYS_RESULT_CACHE_TTL
         )
-        if success:
-            # post-process the dataframe; add additional field
-            t = etl\
-                .fromdataframe(result)\
-                .cutout('geometry')\
-                .addfield('area_acres', lambda r: r['area'] * 0.00002295682)
-
-            # convert to list of dictionaries
-            results = list(etl.dicts(t))
-            
-            self.results.sustain.extend(results)
 
-            return results
+    def run_cached(self, timeout=RAINWAYS_STAGE_TIMEOUT):
+        """get the summary of the analysis from the cache, or run the analysis
+        and cache its summary.
 
-        else:
-            self.status = 'failed'
-            messages = result['error']['details'] + result['message']
-            self.messages.extend(messages)
-
-            return None
-
-    @Timer(name="rwpub__slope_summary", text="{name}: {:.4f}s")
-    def slope_summary(self):
+        :rtype: dict
+        """
+        key = self.result_cache_key()
+        summary = self.get_cached_summary(key)
+        if summary is None:
+            self.run(timeout=timeout)
+            summary = self.summary()
+            self.cache_summary(summary, key)
+        return summary
+
+    def _run_stage(self, stage):
+        started = perf_counter()
+        try:
+            result = stage()
+            return round(perf_counter() - started, 4), result
+        finally:
+            # stages run in their own threads, which have their own db connections
+            connection.close()
+
+    def stages(self):
+        return dict(
+            rasters=self.raster_summary,
+            soils=self.soil_summary,
+            sustain=self.sustain_summary,
+            rainfall=self.rainfall_summary
+        )
 
-        success, result = self.clip_cog(
-            cog_on_s3=RAINWAYS_RESOURCES['slope'],
+    def apply_stage_result(self, result):
+        for name, values in result.results.items():
+            getattr(self.results, name).extend(values)
+
+    def run(self, timeout=RAINWAYS_STAGE_TIMEOUT):
+        """run all of the analysis stages concurrently, and wait for them to 
+        complete. Each stage is dominated by I/O (feature service queries, 
+        COG reads, a database query) so latency is that of the slowest stage 
+        rather than the sum of them. Stages that raise or don't finish within 
+        `timeout` seconds are reported in the messages; the results of the 
+        others are kept. Only the stages that complete in time contribute to
+        the results, which are assembled here from what they return.
+
+        A stage that times out is abandoned, not stopped: it carries on in its
+        thread until its next `check_cancelled`, where it gives up (closing 
+        its database connection). A query or read already under way runs to
+        completion first.
+        """
+        stages = self.stages()
+
+        executor = ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix="rainways")
+        futures = {
+            name: executor.submit(self._run_stage, stage) 
+            for name, stage in stages.items()
+        }
+        deadline = perf_counter() + timeout
+
+        for name, future in futures.items():
+            try:
+                seconds, result = future.result(timeout=max(0, deadline - perf_counter()))
+            except FutureTimeoutError:
+                self.status = 'failed'
+                self.messages.append("The {0} analysis did not complete within {1} seconds.".format(name, timeout))
+                continue
+            except Exception as e:
+                self.status = 'failed'
+                self.messages.append("The {0} analysis failed: {1}".format(name, e))
+                continue
+
+            self.timings[name] = seconds
+            if result is None:
+                continue
+            if result.failed:
+                self.status = 'failed'
+            self.messages.extend(result.messages)
+            self.apply_stage_result(result)
+
+        # don't wait on any stages that timed out, but have them stop
+        self.cancelled.set()
+        executor.shutdown(wait=False)
+
+        return self.results
+
+    def clip_and_dissolve_layer(self, layer):
+        """clip and dissolve one of the feature layers in RAINWAYS_MIRRORED_LAYERS
+        with the AOI. Uses the local mirror of the layer if there is one, 
+        otherwise queries the feature service.
+        """
+        self.check_cancelled()
+        field = RAINWAYS_MIRRORED_LAYERS[layer]
+        resource = self.mirrored_resource(layer)
+        if resource is not None:
+            return True, clip_and_dissolve_mirrored_features(resource, field, self.aoi_gdf, area_only=True)
+
+        return self.clip_and_dissolve_esri_feature_layer(
+            feature_layer_query_url=RAINWAYS_RESOURCES[layer],
+            feature_layer_fields=[field],
             clipping_mask_gdf=self.aoi_gdf,
-            reproj_mask_to=3857
+            area_only=True
         )
 
-        if success:
+    def _layer_summary(self, layer):
+        success, result = self.clip_and_dissolve_layer(layer)
+        if not success:
+            messages = [result['error'].get('message')] + result['error'].get('details', [])
+            return StageResult(messages=[m for m in messages if m], failed=True)
 
-            results = RasterSummaryStat(
-                avg=result.mean(),
-                max=result.max(),
-                min=result.min()
-            )
+        # post-process the dataframe; add additional field
+        t = etl\
+            .fromdataframe(result)\
+            .addfield('area_acres', lambda r: r['area'] * 0.00002295682)
 
-            self.results.slope.append(results)
+        # convert to list of dictionaries
+        return StageResult(results={layer: list(etl.dicts(t))})
 
-            return results
+    @Timer(name="rwpub__soil_summary", text="{name}: {:.4f}s")
+    def soil_summary(self):
+        return self._layer_summary('soils')
 
-        else:
-            self.status = 'failed'
-            self.messages.append(result)
+    @Timer(name="rwpub__sustain_summary", text="{name}: {:.4f}s")
+    def sustain_summary(self):
+        return self._layer_summary('sustain')
+
+    @Timer(name="rwpub__raster_summary", text="{name}: {:.4f}s")
+    def raster_summary(self):
+        """zonal statistics for the raster layers (slope, and elevation if 
+        available), for the whole AOI and, if it has several features, for 
+        each feature; computed from a single read of each raster, plus any 
+        precomputed cell summaries for large AOIs.
+        """
+        zones = self.aoi_gdf[['geometry']]
+        features = [None]
+        if len(self.aoi_gdf) > 1:
+            whole = gpd.GeoDataFrame(geometry=[self.aoi_gdf.unary_union], crs=self.aoi_gdf.crs)
+            zones = pd.concat([whole, zones], ignore_index=True)
+            features.extend(range(len(self.aoi_gdf)))
+
+        layers = [l for l in ['slope', 'elev'] if l in RAINWAYS_RASTER_LAYERS.keys()]
+        self.check_cancelled()
+        try:
+            # large AOIs use precomputed summaries where they can
+            stats = zonal_stats(zones, layers, precomputed=True)
+        except Exception as e:
+            return StageResult(messages=[str(e)], failed=True)
 
+        return StageResult(results={
+            layer: [RasterSummaryStat(feature=f, **s) for f, s in zip(features, layer_stats)]
+            for layer, layer_stats in stats.items()
+        })
 
     @Timer(name="rwpub__rainfall_summary", text="{name}: {:.4f}s")
     def rainfall_summary(self):
 
         # get the centroid of all provided geometry in the same coordinate system as the pixels
-        pt = self.aoi_gdf.to_crs(epsg=Pixel.geom.field.srid).unary_union.centroid.wkt
+        pt = self.aoi_gdf.to_crs(epsg=Pixel.geom.field.srid).unary_union.centroid
 
         # use it to find the overlapping containing radar rainfall pixel
-        try:
-            sensor_id = Pixel.objects.get(geom__contains=pt).pixel_id
-        except Pixel.DoesNotExist as e:
-            self.status = 'failed'
-            self.messages.extend([str(e), "Radar rainfall data is not available for for this location from 3RWW."])
-            return None
+        pixel_ids = get_pixel_ids_for_point(pt)
+        if not pixel_ids:
+            return StageResult(
+                messages=["No radar rainfall pixel contains this location.", "Radar rainfall data is not available for for this location from 3RWW."],
+                failed=True
+            )
+        sensor_id = pixel_ids[0]
 
+        self.check_cancelled()
         try:
             # get datetimes for the last six months
             end_dt = datetime.now().replace(day=1,hour=0,minute=0, second=0,microsecond=0)
@@ -331,9 +540,159 @@ class RwPublicAnalysis(RwCore):
                 [start_dt, end_dt], 
                 sensor_id
             )
-            self.results.rainfall.extend(results)
-            return results
+            return StageResult(results=dict(rainfall=results))
         except RtrrObservation.DoesNotExist as e:
-            self.status = 'failed'
-            self.messages.extend([str(e), "Radar rainfall data is not available for for this location from 3RWW."])
-            return None
\ No newline at end of file
+            return StageResult(
+                messages=[str(e), "Radar rainfall data is not available for for this location from 3RWW."],
+                failed=True
+            )
+
+
+class RwBatchAnalysis(RwPublicAnalysis):
+    """the public AOI analysis for each feature of a FeatureCollection (e.g., 
+    a set of sewersheds). Rather than analyzing each feature on its own, each 
+    stage works on all of them at once: each feature layer is fetched once 
+    for the extent of all of the features and overlaid with all of them in a 
+    single operation, each raster is read once, and rainfall is queried once 
+    for all of the pixels.
+    """
+
+    result_cache_prefix = "aoi-batch-result"
+
+    def __init__(self, aoi_geojson, **kwargs) -> None:
+        super().__init__(aoi_geojson, **kwargs)
+        self.aoi_gdf = self.aoi_gdf.reset_index(drop=True)
+        # results for each feature, in order
+        self.results = [RwPublicResult() for _ in range(len(self.aoi_gdf))]
+
+    def stages(self):
+        return dict(
+            rasters=self.batch_raster_summary,
+            soils=lambda: self.batch_layer_summary('soils'),
+            sustain=lambda: self.batch_layer_summary('sustain'),
+            rainfall=self.batch_rainfall_summary
+        )
+
+    def apply_stage_result(self, result):
+        for zone, by_name in result.results.items():
+            for name, values in by_name.items():
+                getattr(self.results[zone], name).extend(values)
+
+    def summary(self):
+        features = self.aoi_geojson.get('features', [])
+        return dict(
+            data=dict(features=[
+                dict(
+                    feature=i,
+                    id=features[i].get('id') if i < len(features) else None,
+                    **RwPublicResult.Schema().dump(r)
+                )
+                for i, r in enumerate(self.results)
+            ]),
+            status=self.status,
+            messages=self.messages,
+            meta={"count": len(self.aoi_gdf.index), "timings": self.timings}
+        )
+
+    def _layer_features(self, layer, bbox):
+        """features of a layer within a bounding box (in RAINWAYS_DEFAULT_CRS), 
+        from the local mirror if there is one, otherwise the feature service
+        """
+        self.check_cancelled()
+        field = RAINWAYS_MIRRORED_LAYERS[layer]
+        resource = self.mirrored_resource(layer)
+        if resource is not None:
+            return get_mirrored_features(resource, field, bbox)
+        return gpd.GeoDataFrame.from_features(
+            get_features_for_bbox(RAINWAYS_RESOURCES[layer], [field], bbox),
+            crs=RAINWAYS_DEFAULT_CRS
+        )
+
+    @Timer(name="rwbatch__layer_summary", text="{name}: {:.4f}s")
+    def batch_layer_summary(self, layer):
+        field = RAINWAYS_MIRRORED_LAYERS[layer]
+        zones = self.aoi_gdf[['geometry']].to_crs(epsg=RAINWAYS_DEFAULT_CRS)
+
+        features = self._layer_features(layer, list(zones.total_bounds))
+        if features.empty:
+            return None
+        self.check_cancelled()
+
+        # one overlay for all of the features, with areas by feature and field
+        areas = intersection_areas(zones, features, [field], zones=True)
+        areas['area_acres'] = areas['area'] * 0.00002295682
+
+        return StageResult(results={
+            zone: {layer: rows.drop(columns='zone').to_dict('records')}
+            for zone, rows in areas.groupby('zone')
+        })
+
+    @Timer(name="rwbatch__raster_summary", text="{name}: {:.4f}s")
+    def batch_raster_summary(self):
+        layers = [l for l in ['slope', 'elev'] if l in RAINWAYS_RASTER_LAYERS.keys()]
+        self.check_cancelled()
+        stats = zonal_stats(self.aoi_gdf[['geometry']], layers, precomputed=True)
+        results = {}
+        for layer, layer_stats in stats.items():
+            for zone, zone_stats in enumerate(layer_stats):
+                results.setdefault(zone, {})[layer] = [RasterSummaryStat(**zone_stats)]
+        return StageResult(results=results)
+
+    @Timer(name="rwbatch__rainfall_summary", text="{name}: {:.4f}s")
+    def batch_rainfall_summary(self):
+        # the pixel containing the centroid of each feature
+        centroids = self.aoi_gdf.to_crs(epsg=RAINWAYS_DEFAULT_CRS).centroid.to_crs(epsg=Pixel.geom.field.srid)
+        pixel_ids = []
+        messages = []
+        for zone, pt in enumerate(centroids):
+            ids = get_pixel_ids_for_point(pt)
+            pixel_ids.append(ids[0] if ids else None)
+            if not ids:
+                messages.append("No radar rainfall pixel contains feature {0}.".format(zone))
+
+        # as with a single AOI, a feature without a pixel fails the analysis
+        failed = bool(messages)
+
+        sensor_ids = sorted(set(p for p in pixel_ids if p))
+        if not sensor_ids:
+            return StageResult(messages=messages, failed=failed)
+
+        # monthly totals for the last six months, for all of the pixels at once
+        self.check_cancelled()
+        end_dt = datetime.now().replace(day=1,hour=0,minute=0, second=0,microsecond=0)
+        start_dt = end_dt + relativedelta(months=-6)
+        rows = query_sensors_rollup_monthly(RtrrObservation, [start_dt, end_dt], sensor_ids)
+
+        by_sensor = {}
+        for row in rows:
+            by_sensor.setdefault(row['id'], []).append(row)
+
+        return StageResult(
+            results={
+                zone: dict(rainfall=by_sensor.get(pixel_id, []))
+                for zone, pixel_id in enumerate(pixel_ids)
+            },
+            messages=messages,
+            failed=failed
+        )
+
+
+def analyze_aoi(aoi_geojson, timeout=RAINWAYS_JOB_STAGE_TIMEOUT):
+    """run the public AOI analysis as a queued job.
+
+    :return: the analysis summary (see `RwPublicAnalysis.summary`)
+    :rtype: dict
+    """
+    analysis = RwPublicAnalysis(aoi_geojson)
+    return analysis.run_cached(timeout=timeout)
+
+
+def analyze_aoi_batch(aoi_geojson, timeout=RAINWAYS_JOB_STAGE_TIMEOUT):
+    """run the public AOI analysis for each feature of a FeatureCollection, as 
+    a queued job.
+
+    :return: the analysis summary (see `RwBatchAnalysis.summary`)
+    :rtype: dict
+    """
+    analysis = RwBatchAnalysis(aoi_geojson)
+    return analysis.run_cached(timeout=timeout)
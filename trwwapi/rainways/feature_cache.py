@@ -0,0 +1,177 @@
+"""caches features from the external feature services used in Rainways
+analysis, by tile. An AOI's bounding box is snapped to a fixed grid; the
+features for each tile are fetched once and kept in Redis, and the features
+for an AOI are assembled from its tiles. Repeat and neighbouring analyses
+skip the feature service entirely. Tiles that aren't cached yet are fetched
+together, in one query for the extent of all of them, and the features are
+split into tiles locally.
+"""
+
+import hashlib
+import json
+import math
+import zlib
+from datetime import datetime, timezone
+
+from django_rq import get_queue
+from shapely.geometry import shape
+
+from ..common.config import (
+    RAINWAYS_DEFAULT_CRS,
+    RAINWAYS_FEATURE_TILE_SIZE,
+    RAINWAYS_FEATURE_TILE_TTL,
+    RAINWAYS_FEATURE_TILE_MAX
+)
+from .services import fetch_feature_layer
+
+
+def tiles_for_bbox(bbox, tile_size=RAINWAYS_FEATURE_TILE_SIZE):
+    """grid tiles (column, row) that cover a bounding box
+
+    :param bbox: [minx, miny, maxx, maxy], in the tile CRS
+    :type bbox: list
+    :rtype: list
+    """
+    minx, miny, maxx, maxy = bbox
+    return [
+        (col, row)
+        for col in range(math.floor(minx / tile_size), math.floor(maxx / tile_size) + 1)
+        for row in range(math.floor(miny / tile_size), math.floor(maxy / tile_size) + 1)
+    ]
+
+
+def tile_bounds(tile, tile_size=RAINWAYS_FEATURE_TILE_SIZE):
+    col, row = tile
+    return [col * tile_size, row * tile_size, (col + 1) * tile_size, (row + 1) * tile_size]
+
+
+def _tile_key(feature_layer_query_url, feature_layer_fields, epsg_code, tile_size, tile):
+    layer = hashlib.md5(json.dumps(
+        [feature_layer_query_url, sorted(feature_layer_fields), epsg_code, tile_size]
+    ).encode()).hexdigest()
+    return "trwwapi:rainways:feature-tile:{0}:{1}:{2}".format(layer, *tile)
+
+
+def _envelope_query(bbox, feature_layer_fields, epsg_code):
+    return dict(
+        outFields=",".join([str(f) for f in feature_layer_fields]),
+        geometry=",".join([str(x) for x in bbox]),
+        inSR=epsg_code,
+        geometryType='esriGeometryEnvelope',
+        spatialRel='esriSpatialRelIntersects'
+    )
+
+
+def _feature_id(feature):
+    if feature.get('id') is not None:
+        return feature['id']
+    return json.dumps(feature, sort_keys=True)
+
+
+def _tiles_for_feature(feature, tile_size):
+    """the tiles that a feature's bounding box overlaps
+    """
+    if not feature.get('geometry'):
+        return []
+    return tiles_for_bbox(shape(feature['geometry']).bounds, tile_size)
+
+
+def _fetch_tiles(feature_layer_query_url, feature_layer_fields, tiles, epsg_code, tile_size):
+    """fetch the features for several tiles with a single (paged) query for
+    the extent of all of them, and split them into tiles by their bounding
+    boxes.
+
+    :return: the features for each tile
+    :rtype: dict
+    """
+    bounds = [tile_bounds(t, tile_size) for t in tiles]
+    extent = [
+        min(b[0] for b in bounds),
+        min(b[1] for b in bounds),
+        max(b[2] for b in bounds),
+        max(b[3] for b in bounds)
+    ]
+    by_tile = {t: [] for t in tiles}
+    for feature in fetch_feature_layer(
+        feature_layer_query_url,
+        out_epsg_code=epsg_code,
+        **_envelope_query(extent, feature_layer_fields, epsg_code)
+    ):
+        for tile in _tiles_for_feature(feature, tile_size):
+            if tile in by_tile:
+                by_tile[tile].append(feature)
+    return by_tile
+
+
+def get_features_for_bbox(
+    feature_layer_query_url,
+    feature_layer_fields,
+    bbox,
+    epsg_code=RAINWAYS_DEFAULT_CRS,
+    tile_size=RAINWAYS_FEATURE_TILE_SIZE
+    ):
+    """get the features from a feature layer that intersect a bounding box,
+    as a GeoJSON FeatureCollection in `epsg_code`, using cached tiles where
+    available and fetching (and caching) the rest. Features that span several
+    tiles are only included once.
+
+    Each cached tile records where and when its features came from; the
+    FeatureCollection's `properties` list that provenance for the tiles used.
+
+    :param bbox: [minx, miny, maxx, maxy], in `epsg_code`
+    :type bbox: list
+    :rtype: dict
+    """
+    tiles = tiles_for_bbox(bbox, tile_size)
+
+    # too big an area to be worth caching
+    if len(tiles) > RAINWAYS_FEATURE_TILE_MAX:
+        features = list(fetch_feature_layer(
+            feature_layer_query_url,
+            out_epsg_code=epsg_code,
+            **_envelope_query(bbox, feature_layer_fields, epsg_code)
+        ))
+        return dict(type="FeatureCollection", features=features, properties=dict(tiles=[]))
+
+    conn = get_queue().connection
+    keys = [_tile_key(feature_layer_query_url, feature_layer_fields, epsg_code, tile_size, t) for t in tiles]
+    cached = conn.mget(keys)
+
+    missing = [tile for tile, payload in zip(tiles, cached) if payload is None]
+    fetched = {}
+    if missing:
+        fetched = _fetch_tiles(feature_layer_query_url, feature_layer_fields, missing, epsg_code, tile_size)
+    fetched_at = datetime.now(timezone.utc).isoformat()
+
+    tile_sets = []
+    pipe = conn.pipeline()
+    for tile, key, payload in zip(tiles, keys, cached):
+        if payload is not None:
+            tile_sets.append(json.loads(zlib.decompress(payload)))
+            continue
+        tile_set = dict(
+            href=feature_layer_query_url,
+            fields=list(feature_layer_fields),
+            tile=list(tile),
+            bbox=tile_bounds(tile, tile_size),
+            epsg=epsg_code,
+            fetched=fetched_at,
+            features=fetched[tile]
+        )
+        pipe.set(key, zlib.compress(json.dumps(tile_set).encode()), ex=RAINWAYS_FEATURE_TILE_TTL)
+        tile_sets.append(tile_set)
+    pipe.execute()
+
+    features = {}
+    for tile_set in tile_sets:
+        for feature in tile_set['features']:
+            features.setdefault(_feature_id(feature), feature)
+
+    return dict(
+        type="FeatureCollection",
+        features=list(features.values()),
+        properties=dict(tiles=[
+            {k: v for k, v in t.items() if k != 'features'}
+            for t in tile_sets
+        ])
+    )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from ....common.config import RAINWAYS_MIRRORED_LAYERS
+from ...services import mirror_feature_layer
+
+
+class Command(BaseCommand):
+    help = "Mirror the external Rainways feature layers into the local database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'layers',
+            nargs='*',
+            choices=list(RAINWAYS_MIRRORED_LAYERS.keys()),
+            help="Layers to mirror (defaults to all of them)"
+        )
+
+    def handle(self, *args, **options):
+        for layer in options['layers'] or RAINWAYS_MIRRORED_LAYERS.keys():
+            resource, count = mirror_feature_layer(layer)
+            self.stdout.write("{0}: {1} features from {2}".format(layer, count, resource.href))
+        self.stdout.write(self.style.SUCCESS("Rainways layers mirrored"))
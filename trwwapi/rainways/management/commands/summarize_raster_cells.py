@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from ....common.config import RAINWAYS_RASTER_LAYERS, RAINWAYS_CELL_GRIDS
+from ...services import summarize_raster_cells
+
+
+class Command(BaseCommand):
+    help = "Precompute summaries of the Rainways raster layers for each grid cell"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'layers',
+            nargs='*',
+            choices=[k for k, v in RAINWAYS_RASTER_LAYERS.items() if 'range' in v],
+            help="Layers to summarize (defaults to all of them)"
+        )
+        parser.add_argument(
+            '--grid',
+            action='append',
+            choices=RAINWAYS_CELL_GRIDS,
+            help="Grids to summarize for (defaults to all of them)"
+        )
+
+    def handle(self, *args, **options):
+        layers = options['layers'] or [k for k, v in RAINWAYS_RASTER_LAYERS.items() if 'range' in v]
+        for grid in options['grid'] or RAINWAYS_CELL_GRIDS:
+            count = summarize_raster_cells(layers, grid)
+            self.stdout.write("{0}: {1} cells".format(grid, count))
+        self.stdout.write(self.style.SUCCESS("Raster cell summaries updated"))
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:56
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainways', '0003_auto_20210413_1633'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirroredFeature',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attributes', models.JSONField(default=dict)),
+                ('geom', django.contrib.gis.db.models.fields.MultiPolygonField(srid=2272)),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='features', to='rainways.resource')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:03
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rainways', '0004_mirroredfeature'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RasterCellSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('layer', models.CharField(max_length=64)),
+                ('grid', models.CharField(max_length=16)),
+                ('cell', models.CharField(max_length=32)),
+                ('geom', django.contrib.gis.db.models.fields.PolygonField(srid=2272)),
+                ('count', models.BigIntegerField(default=0)),
+                ('sum', models.FloatField(default=0)),
+                ('sum_sq', models.FloatField(default=0)),
+                ('min', models.FloatField(null=True)),
+                ('max', models.FloatField(null=True)),
+                ('histogram', models.JSONField(default=list)),
+            ],
+            options={
+                'unique_together': {('layer', 'grid', 'cell')},
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.db.models import (
+    JSONField,
     CharField,
     URLField,
     TextField,
@@ -8,12 +9,13 @@ from django.db.models import (
     ForeignKey,
     ManyToManyField
 )
-from django.contrib.gis.db.models import PolygonField
+from django.contrib.gis.db.models import PolygonField, MultiPolygonField
 from django.contrib.gis.db.models.functions import Envelope
 
 from taggit.managers import TaggableManager
 
 from ..common.mixins import TimestampedMixin
+from ..common.config import RAINWAYS_DEFAULT_CRS
 
 
 class Collection(TimestampedMixin):
@@ -49,4 +51,55 @@ class Resource(TimestampedMixin):
     tags = TaggableManager(blank=True)
 
     def __str__(self) -> str:
-        return " | ".join([i for i in [self.title, self.href] if i is not None])
\ No newline at end of file
+        return " | ".join([i for i in [self.title, self.href] if i is not None])
+
+
+class MirroredFeature(models.Model):
+    """A feature copied from an external feature layer Resource, so that 
+    Rainways analysis can clip the layer in the database rather than querying 
+    the layer over HTTP for every request. See the mirror_rainways_layers 
+    command.
+    """
+
+    resource = ForeignKey(Resource, on_delete=models.CASCADE, related_name='features')
+    attributes = JSONField(default=dict)
+    geom = MultiPolygonField(srid=RAINWAYS_DEFAULT_CRS)
+
+    def __str__(self) -> str:
+        return "{0} ({1})".format(self.resource, self.pk)
+
+
+class RasterCellSummary(models.Model):
+    """Summary of a raster layer (see RAINWAYS_RASTER_LAYERS) within one cell 
+    of a grid, precomputed so that Rainways analysis of large AOIs only has 
+    to read the raster near the AOI's boundary. Holds the moments and a 
+    fixed-range histogram rather than final statistics, so that cells can be 
+    combined. See the summarize_raster_cells command.
+    """
+
+    layer = CharField(max_length=64)
+    grid = CharField(max_length=16)
+    cell = CharField(max_length=32)
+    geom = PolygonField(srid=RAINWAYS_DEFAULT_CRS)
+    count = models.BigIntegerField(default=0)
+    sum = models.FloatField(default=0)
+    sum_sq = models.FloatField(default=0)
+    min = models.FloatField(null=True)
+    max = models.FloatField(null=True)
+    histogram = JSONField(default=list)
+
+    class Meta:
+        unique_together = ('layer', 'grid', 'cell')
+
+    def moments(self):
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            sum_sq=self.sum_sq,
+            min=self.min,
+            max=self.max,
+            histogram=self.histogram
+        )
+
+    def __str__(self) -> str:
+        return "{0} {1} {2}".format(self.layer, self.grid, self.cell)
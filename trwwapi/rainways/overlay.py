@@ -0,0 +1,68 @@
+"""area summaries of polygon layers within AOIs.
+
+An overlay followed by a dissolve builds unioned geometries for every group,
+when all Rainways reports is their area. Here, the layer's features are
+prefiltered with its spatial index, only the candidate pairs are intersected
+(in one vectorized operation), and the areas of the pieces are summed by
+group. Inputs are never modified.
+"""
+
+import geopandas as gpd
+import pandas as pd
+
+
+def intersection_areas(
+    mask_gdf: gpd.GeoDataFrame,
+    features_gdf: gpd.GeoDataFrame,
+    by: list,
+    zones: bool = False
+    ) -> pd.DataFrame:
+    """area of the features within the mask, summed by the values of the
+    fields in `by`, and as a proportion of the total. Areas are in the
+    (squared) units of the features' CRS, which the mask is reprojected to.
+
+    :param mask_gdf: clipping geometries
+    :type mask_gdf: gpd.GeoDataFrame
+    :param features_gdf: features to clip, with the fields in `by`
+    :type features_gdf: gpd.GeoDataFrame
+    :param by: fields to group the areas by
+    :type by: list
+    :param zones: summarize each row of the mask separately (in a `zone`
+        column, with the row's position), rather than the mask as a whole
+    :type zones: bool, optional
+    :return: the fields in `by` (and `zone`), area and area_pct
+    :rtype: pd.DataFrame
+    """
+    columns = (['zone'] if zones else []) + list(by) + ['area', 'area_pct']
+
+    if not mask_gdf.crs.is_exact_same(features_gdf.crs):
+        mask_gdf = mask_gdf.to_crs(features_gdf.crs)
+    mask = mask_gdf.geometry.reset_index(drop=True)
+    if not zones:
+        # overlapping mask geometries shouldn't count an area twice
+        mask = gpd.GeoSeries([mask.unary_union], crs=mask.crs)
+
+    # candidate (mask, feature) pairs whose geometries intersect. The locked
+    # geopandas (0.9) only takes an array of geometries in `query_bulk`, which
+    # later versions fold into `query`
+    sindex = features_gdf.sindex
+    query_bulk = getattr(sindex, 'query_bulk', sindex.query)
+    mask_idx, feature_idx = query_bulk(mask, predicate='intersects')
+    if len(mask_idx) == 0:
+        return pd.DataFrame(columns=columns)
+
+    pieces = gpd.GeoSeries(mask.values[mask_idx], crs=mask.crs)\
+        .intersection(gpd.GeoSeries(features_gdf.geometry.values[feature_idx], crs=mask.crs), align=False)
+
+    areas = pd.DataFrame(features_gdf[list(by)].values[feature_idx], columns=list(by))
+    areas['zone'] = mask_idx
+    areas['area'] = pieces.area.values
+
+    group = ['zone'] + list(by)
+    summed = areas\
+        .groupby(group, as_index=False, sort=True)['area']\
+        .sum()
+    summed = summed[summed['area'] > 0].reset_index(drop=True)
+    summed['area_pct'] = summed['area'] / summed.groupby('zone')['area'].transform('sum')
+
+    return summed[columns]
@@ -0,0 +1,101 @@
+"""reads rasters (e.g., the slope COG on S3) for Rainways analysis.
+
+Opening a remote COG means a connection, a header fetch, and reading the
+overviews and tile index before any data is read, so datasets are kept open
+and reused across requests: each process keeps a small pool of handles per
+raster (a GDAL dataset can only be read by one thread at a time). Reads are
+limited to the window that overlaps the clipping geometry, so only those
+internal tiles are fetched, and GDAL's block and remote-file caches (sized by
+the RAINWAYS_GDAL_CACHEMAX and RAINWAYS_VSI_CACHE_SIZE settings) keep
+recently read tiles in memory.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+import numpy as np
+import rasterio
+from rasterio import mask as rasterio_mask
+from django.conf import settings
+
+from ..common.config import RAINWAYS_RASTER_HANDLE_MAX_AGE
+
+
+def raster_env_options():
+    """GDAL configuration used when opening and reading rasters
+    """
+    return dict(
+        GDAL_CACHEMAX=settings.RAINWAYS_GDAL_CACHEMAX,
+        VSI_CACHE=True,
+        VSI_CACHE_SIZE=settings.RAINWAYS_VSI_CACHE_SIZE * 1024 * 1024,
+        # a COG is a single file; don't list the bucket looking for sidecars
+        GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+        CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif,.tiff',
+        GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES',
+        GDAL_HTTP_MULTIPLEX='YES'
+    )
+
+
+class RasterPool():
+    """idle dataset handles for each raster, shared by the threads in a
+    process. A handle is used by one thread at a time, and is closed rather
+    than reused once it is older than `max_age` seconds.
+    """
+
+    def __init__(self, max_age=RAINWAYS_RASTER_HANDLE_MAX_AGE):
+        self.max_age = max_age
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, path):
+        with self._lock:
+            idle = self._idle.setdefault(path, [])
+            while idle:
+                src, opened = idle.pop()
+                if not src.closed and monotonic() - opened < self.max_age:
+                    return src, opened
+                src.close()
+        return rasterio.open(path), monotonic()
+
+    def _checkin(self, path, src, opened):
+        with self._lock:
+            self._idle.setdefault(path, []).append((src, opened))
+
+    @contextmanager
+    def dataset(self, path):
+        with rasterio.Env(**raster_env_options()):
+            src, opened = self._checkout(path)
+            try:
+                yield src
+            except Exception:
+                # don't put back a handle that may be in a bad state
+                src.close()
+                raise
+            else:
+                self._checkin(path, src, opened)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for src, _ in idle:
+                    src.close()
+            self._idle = {}
+
+
+raster_pool = RasterPool()
+
+
+def read_masked_window(src, shapes) -> np.ma.MaskedArray:
+    """read the cells of an open dataset that fall within the shapes (which
+    must be in the dataset's CRS), masking everything else. Only the window
+    that covers the shapes is read.
+
+    :return: array of shape (bands, rows, cols)
+    :rtype: np.ma.MaskedArray
+    """
+    # True for cells outside the shapes
+    outside, _, window = rasterio_mask.raster_geometry_mask(src, shapes, crop=True)
+    arr = src.read(window=window, masked=True)
+    arr.mask = np.ma.getmaskarray(arr) | outside
+    return arr
@@ -0,0 +1,200 @@
+"""read-side queries for Rainways analysis
+"""
+
+from collections import defaultdict
+
+import geopandas as gpd
+import pandas as pd
+from shapely import wkb
+from django.contrib.gis.geos import MultiPolygon
+from django.db import connection
+from django.db.models import Exists, Max, OuterRef
+
+from ..common.config import (
+    RAINWAYS_DEFAULT_CRS,
+    RAINWAYS_RESOURCES,
+    RAINWAYS_MIRRORED_LAYERS,
+    RAINWAYS_RASTER_LAYERS,
+    RAINWAYS_CELL_GRIDS,
+    RAINWAYS_RESULT_CACHE_VERSION
+)
+from .models import Resource, MirroredFeature, RasterCellSummary
+
+
+def get_mirrored_resources():
+    """get the Resources for the layers in RAINWAYS_MIRRORED_LAYERS that have
+    been mirrored locally (see `services.mirror_feature_layer`), in one query.
+
+    :return: Resource by layer name
+    :rtype: dict
+    """
+    by_href = {
+        resource.href: resource
+        for resource in Resource.objects.filter(
+            Exists(MirroredFeature.objects.filter(resource=OuterRef('pk'))),
+            href__in=[RAINWAYS_RESOURCES[l] for l in RAINWAYS_MIRRORED_LAYERS.keys()]
+        )
+    }
+    return {
+        layer: by_href[RAINWAYS_RESOURCES[layer]]
+        for layer in RAINWAYS_MIRRORED_LAYERS.keys()
+        if RAINWAYS_RESOURCES[layer] in by_href
+    }
+
+
+def get_mirrored_features(resource: Resource, feature_layer_field: str, bbox: list) -> gpd.GeoDataFrame:
+    """the features of a mirrored layer that overlap a bounding box, with one
+    of their attributes
+
+    :param bbox: [minx, miny, maxx, maxy], in RAINWAYS_DEFAULT_CRS
+    :type bbox: list
+    :rtype: gpd.GeoDataFrame
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT attributes ->> %s, ST_AsBinary(geom)
+            FROM {0}
+            WHERE resource_id = %s
+                AND geom && ST_MakeEnvelope(%s, %s, %s, %s, %s)
+        """.format(connection.ops.quote_name(MirroredFeature._meta.db_table)), 
+        [feature_layer_field, resource.pk] + list(bbox) + [RAINWAYS_DEFAULT_CRS])
+        rows = cursor.fetchall()
+
+    return gpd.GeoDataFrame(
+        {feature_layer_field: [r[0] for r in rows]},
+        geometry=[wkb.loads(bytes(r[1])) for r in rows],
+        crs=RAINWAYS_DEFAULT_CRS
+    )
+
+
+def clip_and_dissolve_mirrored_features(
+    resource: Resource,
+    feature_layer_field: str,
+    clipping_mask_gdf: gpd.GeoDataFrame,
+    out_epsg_code: int = RAINWAYS_DEFAULT_CRS,
+    area_only: bool = False
+    ) -> gpd.GeoDataFrame:
+    """the database equivalent of `RwCore.clip_and_dissolve_esri_feature_layer`
+    for a mirrored layer: intersect the layer's features with the clipping
+    mask and dissolve the pieces on one attribute, all in PostGIS using the
+    feature geometry index. With `area_only`, the areas of the pieces are 
+    summed without unioning them.
+
+    :return: a geodataframe with the field, geometry, area and area_pct (a 
+        dataframe without the geometry, with `area_only`)
+    :rtype: gpd.GeoDataFrame
+    """
+    aoi_epsg = int(clipping_mask_gdf.crs.to_authority()[1])
+    aoi_wkt = clipping_mask_gdf.unary_union.wkt
+
+    if area_only:
+        select = "SELECT category, NULL, SUM(ST_Area(ST_Transform(geom, %(out_srid)s)))"
+    else:
+        select = "SELECT category, ST_AsBinary(ST_Transform(ST_Union(geom), %(out_srid)s)), ST_Area(ST_Transform(ST_Union(geom), %(out_srid)s))"
+
+    sql = """
+        WITH aoi AS (
+            SELECT ST_Transform(ST_GeomFromText(%(wkt)s, %(aoi_srid)s), %(srid)s) AS geom
+        ), pieces AS (
+            SELECT
+                f.attributes ->> %(field)s AS category,
+                ST_CollectionExtract(ST_Intersection(f.geom, aoi.geom), 3) AS geom
+            FROM {table} f, aoi
+            WHERE f.resource_id = %(resource_id)s
+                AND f.geom && aoi.geom
+                AND ST_Intersects(f.geom, aoi.geom)
+        )
+        {select}
+        FROM pieces
+        WHERE NOT ST_IsEmpty(geom)
+        GROUP BY category
+        ORDER BY category
+    """.format(
+        table=connection.ops.quote_name(MirroredFeature._meta.db_table),
+        select=select
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, dict(
+            wkt=aoi_wkt,
+            aoi_srid=aoi_epsg,
+            srid=RAINWAYS_DEFAULT_CRS,
+            out_srid=out_epsg_code,
+            field=feature_layer_field,
+            resource_id=resource.pk
+        ))
+        rows = cursor.fetchall()
+
+    columns = {
+        feature_layer_field: [r[0] for r in rows],
+        'area': [r[2] for r in rows]
+    }
+    if area_only:
+        dissolved = pd.DataFrame(columns)
+    else:
+        dissolved = gpd.GeoDataFrame(
+            columns,
+            geometry=[wkb.loads(bytes(r[1])) for r in rows],
+            crs=out_epsg_code
+        )
+    total_area = dissolved['area'].sum()
+    dissolved['area_pct'] = dissolved['area'] / total_area
+    return dissolved
+
+
+def get_precomputed_cells(zone_geom, layers):
+    """find the precomputed raster summaries for grid cells that lie entirely
+    within a zone, working from the coarsest grid to the finest: each grid
+    fills in what the coarser ones didn't cover. Only cells summarized for
+    all of the layers are used.
+
+    :param zone_geom: the zone, in RAINWAYS_DEFAULT_CRS
+    :type zone_geom: GEOSGeometry
+    :param layers: names of layers in RAINWAYS_RASTER_LAYERS
+    :type layers: list
+    :return: the moments of each cell used for each layer, and the part of the
+        zone not covered by those cells
+    :rtype: tuple
+    """
+    summaries = defaultdict(list)
+    remainder = zone_geom
+
+    for grid in RAINWAYS_CELL_GRIDS:
+        by_cell = defaultdict(dict)
+        geoms = {}
+        for summary in RasterCellSummary.objects.filter(grid=grid, layer__in=layers, geom__coveredby=remainder):
+            by_cell[summary.cell][summary.layer] = summary.moments()
+            geoms[summary.cell] = summary.geom
+
+        complete = [c for c, by_layer in by_cell.items() if len(by_layer) == len(layers)]
+        if not complete:
+            continue
+
+        for c in complete:
+            for layer in layers:
+                summaries[layer].append(by_cell[c][layer])
+        remainder = remainder.difference(MultiPolygon([geoms[c] for c in complete]).unary_union)
+        if remainder.empty:
+            break
+
+    return dict(summaries), remainder
+
+
+def get_layer_versions():
+    """identifies the current version of the data behind Rainways analysis:
+    when each mirrored feature layer was last mirrored, the raster layers
+    used, and the latest precomputed raster cell summaries. Any change makes
+    for a new version.
+
+    :rtype: dict
+    """
+    mirrored = Resource.objects\
+        .filter(href__in=[RAINWAYS_RESOURCES[l] for l in RAINWAYS_MIRRORED_LAYERS.keys()], features__isnull=False)\
+        .distinct()\
+        .values_list('href', 'datetime')
+
+    return dict(
+        version=RAINWAYS_RESULT_CACHE_VERSION,
+        mirrored={href: dt.isoformat() for href, dt in mirrored},
+        rasters={name: layer['href'] for name, layer in RAINWAYS_RASTER_LAYERS.items()},
+        cells=RasterCellSummary.objects.aggregate(latest=Max('id'))['latest']
+    )
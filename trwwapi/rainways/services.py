@@ -0,0 +1,209 @@
+"""keeps local copies of the external data used in Rainways analysis: the
+feature layers, and summaries of the raster layers by grid cell
+"""
+
+import json
+import logging
+import math
+
+import requests
+import geopandas as gpd
+from shapely import wkb
+from tenacity import retry, wait_random_exponential, stop_after_attempt
+from rasterio.warp import transform_bounds
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
+from django.db import transaction
+from django.utils.timezone import now
+
+from ..common.config import (
+    RAINWAYS_DEFAULT_CRS,
+    RAINWAYS_RESOURCES,
+    RAINWAYS_REQUEST_TIMEOUT,
+    RAINWAYS_MIRROR_COLLECTION,
+    RAINWAYS_MIRROR_PAGE_SIZE,
+    RAINWAYS_RASTER_LAYERS,
+    RAINWAYS_CELL_SIZE,
+    RAINWAYS_CELL_BATCH_SIZE
+)
+from ..rainfall.models import Pixel
+from .models import Collection, Resource, MirroredFeature, RasterCellSummary
+from .rasters import raster_pool
+from .zonal import zone_values, value_moments
+
+
+logger = logging.getLogger(__name__)
+
+
+@retry(stop=stop_after_attempt(5), wait=wait_random_exponential(multiplier=2, max=30), reraise=True)
+def _fetch_feature_page(feature_layer_query_url, offset, page_size, out_epsg_code, **query):
+    params = dict(
+        where="1=1",
+        outFields="*",
+        returnGeometry='true',
+        outSR=out_epsg_code,
+        resultOffset=offset,
+        resultRecordCount=page_size,
+        orderByFields="OBJECTID",
+        f='geojson'
+    )
+    params.update(query)
+    response = requests.get(
+        feature_layer_query_url,
+        params=params,
+        timeout=RAINWAYS_REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    page = response.json()
+    if 'error' in page.keys():
+        raise ValueError(page['error'])
+    return page
+
+
+def fetch_feature_layer(feature_layer_query_url, page_size=RAINWAYS_MIRROR_PAGE_SIZE, out_epsg_code=RAINWAYS_DEFAULT_CRS, **query):
+    """get all of the features in an Esri feature layer as GeoJSON features,
+    a page at a time. Additional query parameters (e.g., a spatial filter) are
+    passed through to the feature service.
+    """
+    offset = 0
+    while True:
+        page = _fetch_feature_page(feature_layer_query_url, offset, page_size, out_epsg_code, **query)
+        features = page.get('features', [])
+        yield from features
+        offset += len(features)
+        exceeded = page.get('properties', {}).get('exceededTransferLimit', False)
+        if not features or not (exceeded or len(features) == page_size):
+            break
+
+
+def _to_multipolygon(geometry, srid):
+    geom = GEOSGeometry(json.dumps(geometry), srid=srid)
+    if geom.geom_type == 'Polygon':
+        geom = MultiPolygon(geom, srid=srid)
+    return geom
+
+
+def get_mirror_resource(layer):
+    """get (or create) the Resource that records a mirrored layer's source and
+    when it was last mirrored.
+    """
+    url = RAINWAYS_RESOURCES[layer]
+    resource = Resource.objects.filter(href=url).first()
+    if resource is None:
+        resource = Resource.objects.create(
+            title=layer,
+            description="Local mirror of the {0} feature layer, for Rainways analysis".format(layer),
+            datetime=now(),
+            href=url
+        )
+    collection, _ = Collection.objects.get_or_create(title=RAINWAYS_MIRROR_COLLECTION)
+    collection.resources.add(resource)
+    return resource
+
+
+def mirror_feature_layer(layer):
+    """copy every feature in one of the Rainways feature layers (a key in
+    RAINWAYS_MIRRORED_LAYERS) into MirroredFeature, replacing any previous
+    copy in a single transaction. Geometries are stored in
+    RAINWAYS_DEFAULT_CRS.
+
+    :return: the layer's Resource, and the number of features mirrored
+    :rtype: tuple
+    """
+    resource = get_mirror_resource(layer)
+
+    mirrored = [
+        MirroredFeature(
+            resource=resource,
+            attributes=feature.get('properties') or {},
+            geom=_to_multipolygon(feature['geometry'], RAINWAYS_DEFAULT_CRS)
+        )
+        for feature in fetch_feature_layer(resource.href)
+        if feature.get('geometry')
+    ]
+
+    with transaction.atomic():
+        resource.features.all().delete()
+        MirroredFeature.objects.bulk_create(mirrored, batch_size=500)
+        resource.datetime = now()
+        resource.save()
+
+    logger.info("mirrored {0} features from {1}".format(len(mirrored), layer))
+    return resource, len(mirrored)
+
+
+def _pixel_cells():
+    for pixel in Pixel.objects.order_by('pixel_id').iterator():
+        yield pixel.pixel_id, pixel.geom.transform(RAINWAYS_DEFAULT_CRS, clone=True)
+
+
+def _square_cells(href, cell_size=RAINWAYS_CELL_SIZE):
+    """square cells of a regular grid covering a raster
+    """
+    with raster_pool.dataset(href) as src:
+        minx, miny, maxx, maxy = transform_bounds(src.crs, "EPSG:{0}".format(RAINWAYS_DEFAULT_CRS), *src.bounds)
+    for row in range(math.floor(miny / cell_size), math.floor(maxy / cell_size) + 1):
+        for col in range(math.floor(minx / cell_size), math.floor(maxx / cell_size) + 1):
+            bbox = (col * cell_size, row * cell_size, (col + 1) * cell_size, (row + 1) * cell_size)
+            yield "{0}:{1}".format(col, row), Polygon.from_bbox(bbox)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def summarize_raster_cells(layers, grid):
+    """precompute summaries of raster layers for every cell of a grid,
+    replacing any previous summaries. Cells are read from the rasters in
+    batches; each raster is read once per batch for all of the layers in it.
+
+    :param layers: names of layers in RAINWAYS_RASTER_LAYERS, which must have
+        a range
+    :type layers: list
+    :param grid: "pixel" for the rainfall pixels, or "cell" for square cells
+        of RAINWAYS_CELL_SIZE
+    :type grid: str
+    :return: number of cells summarized
+    :rtype: int
+    """
+    if grid == 'pixel':
+        cells = _pixel_cells()
+    else:
+        cells = _square_cells(RAINWAYS_RASTER_LAYERS[layers[0]]['href'])
+
+    count = 0
+    with transaction.atomic():
+        RasterCellSummary.objects.filter(grid=grid, layer__in=layers).delete()
+
+        for batch in _batches(cells, RAINWAYS_CELL_BATCH_SIZE):
+            zones = gpd.GeoDataFrame(
+                geometry=[wkb.loads(bytes(geom.wkb)) for _, geom in batch],
+                crs=RAINWAYS_DEFAULT_CRS
+            )
+            try:
+                values = zone_values(zones, layers)
+            except ValueError:
+                # none of the cells in the batch overlap the rasters
+                values = {layer: [[]] * len(batch) for layer in layers}
+
+            RasterCellSummary.objects.bulk_create([
+                RasterCellSummary(
+                    layer=layer,
+                    grid=grid,
+                    cell=cell,
+                    geom=geom,
+                    **value_moments(cell_values, RAINWAYS_RASTER_LAYERS[layer]['range'])
+                )
+                for layer in layers
+                for (cell, geom), cell_values in zip(batch, values[layer])
+            ])
+            count += len(batch)
+            logger.debug("summarized {0} {1} cells".format(count, grid))
+
+    return count
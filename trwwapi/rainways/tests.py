@@ -1,10 +1,45 @@
 from django.test import TestCase, SimpleTestCase
 from rest_framework.test import APIClient, APIRequestFactory
+import json
+import os
+import tempfile
+import threading
+import zlib
 import requests
+from time import sleep, perf_counter
+from unittest import mock
 
-from .core import RwPublicResult
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box, Polygon, MultiPolygon
+from shapely.geometry.base import BaseGeometry
+from django.contrib.gis.geos import GEOSGeometry
+
+from .core import RwCore, RwPublicResult, RwPublicAnalysis, RwBatchAnalysis, StageResult, StageCancelled, analyze_aoi, normalize_polygons
+from . import services
+from .feature_cache import tiles_for_bbox, tile_bounds, get_features_for_bbox
+from .rasters import raster_pool
+from .overlay import intersection_areas
+from .zonal import summarize_values, zonal_stats, zone_values, value_moments, combine_moments, summarize_moments
 from .views import rainways_area_of_interest_analysis
 from ..common.models import TrwwApiResponseSchema
+from ..common.config import RAINWAYS_INLINE_MAX_AREA
+
+# about 0.85 km by 1.1 km
+SMALL_AOI_GEOJSON = {
+    "type": "FeatureCollection",
+    "features": [{
+        "type": "Feature",
+        "properties": {},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[-80.0, 40.4], [-79.99, 40.4], [-79.99, 40.41], [-80.0, 40.41], [-80.0, 40.4]]]
+        }
+    }]
+}
 
 class RwPublicTestCases(TestCase):
 
@@ -43,3 +78,470 @@ class RwPublicTestCases(TestCase):
         self.assertEqual(response.status_code, 200)
         r = TrwwApiResponseSchema.Schema().load(response.data)
         self.assertIsInstance(r, TrwwApiResponseSchema)
+
+
+class RwPublicAnalysisRunTestCases(SimpleTestCase):
+    """Tests for running the analysis stages concurrently (the stages 
+    themselves are stubbed out, since they need network access)
+    """
+
+    def setUp(self):
+        self.aoi_geojson = SMALL_AOI_GEOJSON
+
+    def _analysis_with_stages(self, seconds):
+        analysis = RwPublicAnalysis(self.aoi_geojson)
+        for name, s in zip(['raster_summary', 'soil_summary', 'sustain_summary', 'rainfall_summary'], seconds):
+            setattr(analysis, name, lambda s=s: sleep(s))
+        return analysis
+
+    def test_stages_run_concurrently(self):
+        analysis = self._analysis_with_stages([0.2, 0.2, 0.2, 0.2])
+        started = perf_counter()
+        analysis.run()
+        self.assertLess(perf_counter() - started, 0.6)
+        self.assertEqual(set(analysis.timings.keys()), {'rasters', 'soils', 'sustain', 'rainfall'})
+        self.assertEqual(analysis.status, 'success')
+
+    def test_stage_timeout(self):
+        analysis = self._analysis_with_stages([0, 0, 0, 1])
+        analysis.run(timeout=0.2)
+        self.assertEqual(analysis.status, 'failed')
+        self.assertTrue(any('rainfall' in m for m in analysis.messages))
+
+    def test_late_stage_results_ignored(self):
+        analysis = self._analysis_with_stages([0, 0, 0, 0])
+        def slow_rainfall():
+            sleep(0.3)
+            return StageResult(results=dict(rainfall=[dict(val=1.0)]), messages=["late"])
+        analysis.rainfall_summary = slow_rainfall
+        analysis.run(timeout=0.1)
+        # the stage finishes after the analysis has given up on it
+        sleep(0.4)
+        self.assertEqual(analysis.results.rainfall, [])
+        self.assertNotIn("late", analysis.messages)
+        self.assertNotIn('rainfall', analysis.timings)
+
+    def test_timed_out_stage_cancelled(self):
+        analysis = self._analysis_with_stages([0, 0, 0, 0])
+        stopped = threading.Event()
+        def slow_rainfall():
+            analysis.cancelled.wait(1)
+            try:
+                analysis.check_cancelled()
+            except StageCancelled:
+                stopped.set()
+                raise
+            return StageResult(results=dict(rainfall=[dict(val=1.0)]))
+        analysis.rainfall_summary = slow_rainfall
+        analysis.run(timeout=0.1)
+        # the abandoned stage gives up at its next check
+        self.assertTrue(stopped.wait(1))
+        self.assertEqual(analysis.results.rainfall, [])
+
+    def test_mirrored_resources_looked_up_once(self):
+        analysis = RwPublicAnalysis(self.aoi_geojson)
+        with mock.patch('trwwapi.rainways.core.get_mirrored_resources', return_value={}) as lookup, \
+            mock.patch.object(RwPublicAnalysis, 'clip_and_dissolve_esri_feature_layer', return_value=(True, pd.DataFrame(columns=['area']))):
+            analysis.soil_summary()
+            analysis.sustain_summary()
+        lookup.assert_called_once()
+
+
+class MirrorPagingTestCases(SimpleTestCase):
+
+    def test_pages_until_exhausted(self):
+        pages = [
+            dict(features=[{}, {}], properties=dict(exceededTransferLimit=True)),
+            dict(features=[{}])
+        ]
+        with mock.patch.object(services, '_fetch_feature_page', side_effect=pages) as fetch:
+            features = list(services.fetch_feature_layer("https://example.com/query", page_size=2))
+
+        self.assertEqual(len(features), 3)
+        self.assertEqual([c.args[1] for c in fetch.call_args_list], [0, 2])
+
+
+class FeatureTileTestCases(SimpleTestCase):
+
+    def test_tiles_cover_bbox(self):
+        tiles = tiles_for_bbox([-10, 5, 120, 95], tile_size=100)
+        self.assertEqual(sorted(tiles), [(-1, 0), (0, 0), (1, 0)])
+        self.assertEqual(tile_bounds((1, 0), tile_size=100), [100, 0, 200, 100])
+
+    def test_bbox_on_tile_edges(self):
+        self.assertEqual(tiles_for_bbox([0, 0, 99.9, 99.9], tile_size=100), [(0, 0)])
+
+    def test_missing_tiles_fetched_together(self):
+        def feature(fid, x0, y0, x1, y1):
+            return dict(type="Feature", id=fid, properties={}, geometry=box(x0, y0, x1, y1).__geo_interface__)
+
+        features = [feature(1, 10, 10, 20, 20), feature(2, 90, 10, 110, 20), feature(3, 150, 50, 160, 60)]
+        conn = mock.Mock()
+        conn.mget.return_value = [None, None]
+
+        with mock.patch('trwwapi.rainways.feature_cache.get_queue') as get_queue, \
+            mock.patch('trwwapi.rainways.feature_cache.fetch_feature_layer', return_value=iter(features)) as fetch:
+            get_queue.return_value.connection = conn
+            fc = get_features_for_bbox('https://example.com/query', ['FIELD'], [0, 0, 199, 99], epsg_code=2272, tile_size=100)
+
+        fetch.assert_called_once()
+        self.assertEqual(fetch.call_args.kwargs['geometry'], "0,0,200,100")
+        self.assertEqual(sorted(f['id'] for f in fc['features']), [1, 2, 3])
+        by_tile = {tuple(t['tile']): t for t in fc['properties']['tiles']}
+        self.assertEqual(set(by_tile.keys()), {(0, 0), (1, 0)})
+        stored = {
+            tuple(t['tile']): sorted(f['id'] for f in t['features'])
+            for t in [json.loads(zlib.decompress(c.args[1])) for c in conn.pipeline.return_value.set.call_args_list]
+        }
+        self.assertEqual(stored, {(0, 0): [1, 2], (1, 0): [2, 3]})
+
+
+class ClipCogTestCases(SimpleTestCase):
+    """clips a local GeoTIFF standing in for the slope COG on S3
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "slope.tif")
+        # 64 x 64 cells of 10 m, with values equal to the cell's row
+        data = np.repeat(np.arange(64, dtype='float32')[:, None], 64, axis=1)[None, :, :]
+        with rasterio.open(
+            self.path, 'w', driver='GTiff', width=64, height=64, count=1, dtype='float32',
+            crs='EPSG:3857', transform=from_origin(0, 640, 10, 10), tiled=True, blockxsize=16, blockysize=16
+        ) as dst:
+            dst.write(data)
+        # covers rows 10-19 and columns 10-19
+        self.aoi_gdf = gpd.GeoDataFrame(geometry=[box(100, 440, 200, 540)], crs='EPSG:3857')
+
+    def tearDown(self):
+        raster_pool.close()
+        self.tmpdir.cleanup()
+
+    def test_clip_reads_window(self):
+        success, arr = RwCore().clip_cog(self.path, self.aoi_gdf, reproj_mask_to=3857)
+
+        self.assertTrue(success)
+        self.assertEqual(arr.shape, (1, 10, 10))
+        self.assertEqual(arr.min(), 10)
+        self.assertEqual(arr.max(), 19)
+
+    def test_dataset_is_reused(self):
+        with raster_pool.dataset(self.path) as first:
+            pass
+        with raster_pool.dataset(self.path) as second:
+            self.assertIs(first, second)
+            # a handle is only used by one thread at a time
+            with raster_pool.dataset(self.path) as third:
+                self.assertIsNot(second, third)
+
+
+class ZonalStatsTestCases(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "layers.tif")
+        # two bands on 64 x 64 cells of 10 m: the cell's row, and 100 + its column
+        rows = np.repeat(np.arange(64, dtype='float32')[:, None], 64, axis=1)
+        data = np.stack([rows, 100 + rows.T])
+        with rasterio.open(
+            self.path, 'w', driver='GTiff', width=64, height=64, count=2, dtype='float32',
+            crs='EPSG:3857', transform=from_origin(0, 640, 10, 10), tiled=True, blockxsize=16, blockysize=16
+        ) as dst:
+            dst.write(data)
+        self.layers = dict(
+            slope=dict(href=self.path, band=1),
+            elev=dict(href=self.path, band=2)
+        )
+        # rows 10-19 x columns 10-19, and rows 30-31 x columns 40-43
+        self.zones = gpd.GeoDataFrame(
+            geometry=[box(100, 440, 200, 540), box(400, 320, 440, 340)],
+            crs='EPSG:3857'
+        )
+
+    def tearDown(self):
+        raster_pool.close()
+        self.tmpdir.cleanup()
+
+    def test_summarize_values(self):
+        stats = summarize_values(np.arange(1, 101), percentiles=[50], bins=4)
+        self.assertEqual(stats['count'], 100)
+        self.assertEqual((stats['min'], stats['max'], stats['avg']), (1, 100, 50.5))
+        self.assertAlmostEqual(stats['std'], np.arange(1, 101).std())
+        self.assertEqual(stats['percentiles'], {'50': 50.5})
+        self.assertEqual(stats['histogram']['counts'], [25, 25, 25, 25])
+
+    def test_summarize_no_values(self):
+        stats = summarize_values(np.array([]))
+        self.assertEqual(stats['count'], 0)
+        self.assertIsNone(stats['avg'])
+
+    def test_stats_per_zone_and_layer(self):
+        with mock.patch.dict('trwwapi.rainways.zonal.RAINWAYS_RASTER_LAYERS', self.layers, clear=True), \
+            mock.patch.object(raster_pool, '_checkout', wraps=raster_pool._checkout) as checkout:
+            stats = zonal_stats(self.zones)
+
+        # both layers come from one read of the raster
+        self.assertEqual(checkout.call_count, 1)
+        self.assertEqual([s['count'] for s in stats['slope']], [100, 8])
+        self.assertEqual((stats['slope'][0]['min'], stats['slope'][0]['max']), (10, 19))
+        self.assertEqual((stats['slope'][1]['min'], stats['slope'][1]['max']), (30, 31))
+        self.assertEqual((stats['elev'][1]['min'], stats['elev'][1]['max']), (140, 143))
+
+    def test_combined_moments_match_values(self):
+        values = np.random.default_rng(0).uniform(0, 90, 1000)
+        moments = combine_moments([value_moments(values[:300], (0, 90)), value_moments(values[300:], (0, 90))])
+        stats = summarize_moments(moments, (0, 90))
+        exact = summarize_values(values)
+
+        self.assertEqual(stats['count'], exact['count'])
+        for k in ['min', 'max', 'avg', 'std']:
+            self.assertAlmostEqual(stats[k], exact[k])
+        # interpolated from 0.9-wide bins
+        self.assertAlmostEqual(stats['percentiles']['50'], exact['percentiles']['50'], delta=1)
+        self.assertEqual(sum(stats['histogram']['counts']), 1000)
+        self.assertEqual(len(stats['histogram']['edges']), 11)
+
+    def test_precomputed_cells_with_exact_boundary(self):
+        layers = {k: dict(v, range=(0, 200)) for k, v in self.layers.items()}
+        zone = self.zones.iloc[[0]]
+        # the west half of the zone is covered by precomputed cells
+        west = gpd.GeoDataFrame(geometry=[box(100, 440, 150, 540)], crs='EPSG:3857')
+        east = gpd.GeoDataFrame(geometry=[box(150, 440, 200, 540)], crs='EPSG:3857').to_crs(epsg=2272)
+
+        with mock.patch.dict('trwwapi.rainways.zonal.RAINWAYS_RASTER_LAYERS', layers, clear=True):
+            west_values = zone_values(west, ['slope', 'elev'])
+            cells = {k: [value_moments(v[0], (0, 200))] for k, v in west_values.items()}
+            remainder = GEOSGeometry(memoryview(east.geometry.iloc[0].wkb), srid=2272)
+            with mock.patch('trwwapi.rainways.zonal.RAINWAYS_CELL_SUMMARY_MIN_AREA', 0), \
+                mock.patch('trwwapi.rainways.zonal.get_precomputed_cells', return_value=(cells, remainder)):
+                stats = zonal_stats(zone, precomputed=True)
+            exact = zonal_stats(zone)
+
+        for layer in ['slope', 'elev']:
+            self.assertEqual(stats[layer][0]['count'], exact[layer][0]['count'])
+            self.assertAlmostEqual(stats[layer][0]['avg'], exact[layer][0]['avg'], places=4)
+            self.assertEqual(stats[layer][0]['min'], exact[layer][0]['min'])
+            self.assertEqual(stats[layer][0]['max'], exact[layer][0]['max'])
+
+
+class AoiAnalysisJobTestCases(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.aoi_geojson = SMALL_AOI_GEOJSON
+
+    def test_small_aoi_area(self):
+        area = RwPublicAnalysis(self.aoi_geojson).aoi_area()
+        self.assertLess(area, RAINWAYS_INLINE_MAX_AREA)
+        self.assertGreater(area, RAINWAYS_INLINE_MAX_AREA / 4)
+
+    def test_async_request_is_queued(self):
+        queue = mock.Mock()
+        queue.enqueue.return_value = mock.Mock(id='abc', **{'get_status.return_value': 'queued'})
+        request = self.factory.generic(
+            'GET',
+            '/rainways/public/aoi-analysis/acsa/?async=true',
+            json.dumps(dict(geojson=self.aoi_geojson)),
+            content_type='application/json'
+        )
+        with mock.patch('trwwapi.rainways.views.get_queue', return_value=queue), \
+            mock.patch.object(RwPublicAnalysis, 'result_cache_key', return_value='key'), \
+            mock.patch.object(RwPublicAnalysis, 'get_cached_summary', return_value=None):
+            response = rainways_area_of_interest_analysis(request)
+
+        queue.enqueue.assert_called_once_with(analyze_aoi, self.aoi_geojson)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertEqual(response.data['meta']['jobId'], 'abc')
+        self.assertTrue(response.data['meta']['jobUrl'].endswith('/rainways/public/aoi-analysis/acsa/abc/'))
+
+    def test_finished_job(self):
+        job = mock.Mock(id='abc', result=dict(data={'soils': []}, status='success', messages=[], meta={'count': 1}))
+        job.get_status.return_value = 'finished'
+        queue = mock.Mock(**{'fetch_job.return_value': job})
+        request = self.factory.get('/rainways/public/aoi-analysis/acsa/abc/')
+        with mock.patch('trwwapi.rainways.views.get_queue', return_value=queue):
+            response = rainways_area_of_interest_analysis(request, jobid='abc')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'success')
+        self.assertEqual(response.data['data'], {'soils': []})
+        self.assertEqual(response.data['meta']['count'], 1)
+        self.assertEqual(response.data['meta']['jobStatus'], 'finished')
+
+    def test_finished_job_with_failed_analysis(self):
+        job = mock.Mock(id='abc', result=dict(data={}, status='failed', messages=['Soils: timed out'], meta={}))
+        job.get_status.return_value = 'finished'
+        queue = mock.Mock(**{'fetch_job.return_value': job})
+        request = self.factory.get('/rainways/public/aoi-analysis/acsa/abc/')
+        with mock.patch('trwwapi.rainways.views.get_queue', return_value=queue):
+            response = rainways_area_of_interest_analysis(request, jobid='abc')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data['status'], 'failed')
+        self.assertEqual(response.data['messages'], ['Soils: timed out'])
+        self.assertEqual(response.data['meta']['jobStatus'], 'finished')
+
+
+class AoiResultCacheTestCases(SimpleTestCase):
+
+    def _key(self, geojson):
+        with mock.patch('trwwapi.rainways.core.get_layer_versions', return_value=dict(version=1)):
+            return RwPublicAnalysis(geojson).result_cache_key()
+
+    def _aoi(self, ring):
+        return dict(SMALL_AOI_GEOJSON, features=[dict(
+            SMALL_AOI_GEOJSON['features'][0],
+            geometry=dict(type="Polygon", coordinates=[ring])
+        )])
+
+    def test_same_area_drawn_differently(self):
+        ring = SMALL_AOI_GEOJSON['features'][0]['geometry']['coordinates'][0]
+        # reversed, and starting from another vertex
+        redrawn = [ring[1], ring[0], ring[3], ring[2], ring[1]]
+        self.assertEqual(self._key(SMALL_AOI_GEOJSON), self._key(self._aoi(redrawn)))
+
+    def test_within_tolerance(self):
+        ring = SMALL_AOI_GEOJSON['features'][0]['geometry']['coordinates'][0]
+        # about 1 cm
+        nudged = [[x + 0.0000001, y] for x, y in ring]
+        moved = [[x + 0.001, y] for x, y in ring]
+        self.assertEqual(self._key(SMALL_AOI_GEOJSON), self._key(self._aoi(nudged)))
+        self.assertNotEqual(self._key(SMALL_AOI_GEOJSON), self._key(self._aoi(moved)))
+
+    def test_normalize_polygons(self):
+        shell = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+        hole = [(2, 2), (2, 4), (4, 4), (4, 2), (2, 2)]
+        other = [(6, 6), (6, 8), (8, 8), (8, 6), (6, 6)]
+        drawn = Polygon(shell, [hole, other])
+        # clockwise, from another vertex, with the holes the other way round
+        redrawn = Polygon(
+            [(10, 10), (10, 0), (0, 0), (0, 10), (10, 10)],
+            [[(8, 8), (8, 6), (6, 6), (6, 8), (8, 8)], [(4, 4), (4, 2), (2, 2), (2, 4), (4, 4)]]
+        )
+        self.assertEqual(normalize_polygons(drawn).wkb_hex, normalize_polygons(redrawn).wkb_hex)
+        self.assertEqual(list(normalize_polygons(redrawn).exterior.coords), shell)
+
+        east = box(20, 0, 30, 10)
+        self.assertEqual(
+            normalize_polygons(MultiPolygon([drawn, east])).wkb_hex,
+            normalize_polygons(MultiPolygon([east, redrawn])).wkb_hex
+        )
+
+    def test_key_without_shapely_normalize(self):
+        # the locked Shapely (1.7) has no `normalize`
+        with mock.patch.object(BaseGeometry, 'normalize', side_effect=AttributeError, create=True):
+            self.test_same_area_drawn_differently()
+
+    def test_layer_versions_in_key(self):
+        key = self._key(SMALL_AOI_GEOJSON)
+        with mock.patch('trwwapi.rainways.core.get_layer_versions', return_value=dict(version=2)):
+            self.assertNotEqual(key, RwPublicAnalysis(SMALL_AOI_GEOJSON).result_cache_key())
+
+
+class RwBatchAnalysisTestCases(SimpleTestCase):
+
+    def setUp(self):
+        west = SMALL_AOI_GEOJSON['features'][0]
+        east = dict(west, id="east", geometry=dict(
+            type="Polygon",
+            coordinates=[[[x + 0.01, y] for x, y in west['geometry']['coordinates'][0]]]
+        ))
+        self.geojson = dict(type="FeatureCollection", features=[west, east])
+
+    def test_layer_summary_per_feature(self):
+        analysis = RwBatchAnalysis(self.geojson)
+        minx, miny, maxx, maxy = analysis.aoi_gdf.to_crs(epsg=2272).total_bounds
+        midx = (minx + maxx) / 2
+        # "A" covers the west feature and "B" the east one, with a sliver of the west
+        layer = gpd.GeoDataFrame(
+            {'SOIL_HYDRO': ['A', 'B']},
+            geometry=[box(minx - 10, miny - 10, midx - 1000, maxy + 10), box(midx - 1000, miny - 10, maxx + 10, maxy + 10)],
+            crs=2272
+        )
+        with mock.patch.object(RwBatchAnalysis, '_layer_features', return_value=layer) as features:
+            analysis.apply_stage_result(analysis.batch_layer_summary('soils'))
+
+        # fetched once for both features
+        features.assert_called_once()
+        west, east = analysis.results
+        self.assertEqual(sorted(r['SOIL_HYDRO'] for r in west.soils), ['A', 'B'])
+        self.assertEqual([r['SOIL_HYDRO'] for r in east.soils], ['B'])
+        self.assertAlmostEqual(sum(r['area_pct'] for r in west.soils), 1)
+        self.assertAlmostEqual(east.soils[0]['area_pct'], 1)
+
+    def test_rainfall_queried_once(self):
+        analysis = RwBatchAnalysis(self.geojson)
+        rows = [dict(id='1', ts='2021-01-01', val=1.0, src=''), dict(id='2', ts='2021-01-01', val=2.0, src='')]
+        with mock.patch('trwwapi.rainways.core.get_pixel_ids_for_point', side_effect=[['1'], ['2']]), \
+            mock.patch('trwwapi.rainways.core.query_sensors_rollup_monthly', return_value=rows) as query:
+            analysis.apply_stage_result(analysis.batch_rainfall_summary())
+
+        query.assert_called_once()
+        self.assertEqual(query.call_args.args[2], ['1', '2'])
+        self.assertEqual([r.rainfall[0]['val'] for r in analysis.results], [1.0, 2.0])
+
+    def test_rainfall_missing_pixel_fails(self):
+        analysis = RwBatchAnalysis(self.geojson)
+        rows = [dict(id='1', ts='2021-01-01', val=1.0, src='')]
+        with mock.patch('trwwapi.rainways.core.get_pixel_ids_for_point', side_effect=[['1'], []]), \
+            mock.patch('trwwapi.rainways.core.query_sensors_rollup_monthly', return_value=rows), \
+            mock.patch.object(RwBatchAnalysis, 'stages', return_value={'rainfall': analysis.batch_rainfall_summary}):
+            analysis.run()
+
+        self.assertEqual(analysis.status, 'failed')
+        self.assertEqual([r.rainfall for r in analysis.results], [rows, []])
+        self.assertEqual(analysis.messages, ["No radar rainfall pixel contains feature 1."])
+
+        # so it isn't cached as a result
+        with mock.patch('trwwapi.rainways.core.get_queue') as get_queue:
+            analysis.cache_summary(analysis.summary(), 'key')
+        get_queue.return_value.connection.set.assert_not_called()
+
+    def test_summary_per_feature(self):
+        summary = RwBatchAnalysis(self.geojson).summary()
+        self.assertEqual([f['feature'] for f in summary['data']['features']], [0, 1])
+        self.assertEqual(summary['data']['features'][1]['id'], "east")
+
+
+class IntersectionAreasTestCases(SimpleTestCase):
+
+    def setUp(self):
+        self.features = gpd.GeoDataFrame(
+            {'SOIL_HYDRO': ['A', 'B', 'A']},
+            geometry=[box(0, 0, 10, 10), box(10, 0, 20, 10), box(20, 0, 30, 10)],
+            crs=2272
+        )
+        # two overlapping features: 5-25 and 15-18
+        self.mask = gpd.GeoDataFrame(geometry=[box(5, 0, 25, 10), box(15, 0, 18, 10)], crs=2272)
+
+    def test_matches_overlay_and_dissolve(self):
+        areas = intersection_areas(self.mask, self.features, ['SOIL_HYDRO'])
+        mask = gpd.GeoDataFrame(geometry=[self.mask.unary_union], crs=2272)
+        dissolved = gpd.overlay(mask, self.features, how='intersection').dissolve(by=['SOIL_HYDRO']).reset_index()
+
+        self.assertEqual(list(areas['SOIL_HYDRO']), list(dissolved['SOIL_HYDRO']))
+        self.assertEqual(list(areas['area']), list(dissolved.area))
+        self.assertEqual(list(areas['area']), [100, 100])
+        self.assertAlmostEqual(areas['area_pct'].sum(), 1)
+
+    def test_per_zone(self):
+        areas = intersection_areas(self.mask, self.features, ['SOIL_HYDRO'], zones=True)
+        self.assertEqual(
+            areas[['zone', 'SOIL_HYDRO', 'area']].values.tolist(),
+            [[0, 'A', 100], [0, 'B', 100], [1, 'B', 30]]
+        )
+        self.assertEqual(list(areas.loc[areas['zone'] == 1, 'area_pct']), [1])
+
+    def test_inputs_not_modified(self):
+        mask = self.mask.to_crs(4326)
+        before = mask.copy()
+        intersection_areas(mask, self.features, ['SOIL_HYDRO'])
+        self.assertTrue(mask.crs.equals(before.crs))
+        self.assertTrue(mask.geom_equals(before).all())
+        self.assertEqual(list(self.features.columns), ['SOIL_HYDRO', 'geometry'])
+
+    def test_no_overlap(self):
+        mask = gpd.GeoDataFrame(geometry=[box(100, 100, 110, 110)], crs=2272)
+        areas = intersection_areas(mask, self.features, ['SOIL_HYDRO'])
+        self.assertTrue(areas.empty)
+        self.assertEqual(list(areas.columns), ['SOIL_HYDRO', 'area', 'area_pct'])
@@ -1,7 +1,7 @@
 from django.shortcuts import redirect
 from django.urls import path, include
 # from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
-from .views import rainways_area_of_interest_analysis, ApiDefaultRouter
+from .views import rainways_area_of_interest_analysis, rainways_batch_analysis, ApiDefaultRouter
 
 router = ApiDefaultRouter()
 
@@ -25,4 +25,7 @@ urlpatterns = [
     # which uses a geographic model to select the right data resources for the 
     # analysis)
     path('public/aoi-analysis/acsa/', rainways_area_of_interest_analysis),
+    path('public/aoi-analysis/acsa/batch/', rainways_batch_analysis),
+    path('public/aoi-analysis/acsa/batch/<str:jobid>/', rainways_batch_analysis),
+    path('public/aoi-analysis/acsa/<str:jobid>/', rainways_area_of_interest_analysis),
 ]
\ No newline at end of file
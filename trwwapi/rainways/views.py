@@ -1,11 +1,19 @@
 from django.shortcuts import render
 from django.utils.safestring import mark_safe
 from rest_framework import routers
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.response import Response
+from django_rq import get_queue
 
-from .core import RwPublicResult, RwPublicAnalysis
+from .core import RwPublicAnalysis, RwBatchAnalysis, analyze_aoi, analyze_aoi_batch
+from ..common.config import (
+    RAINWAYS_INLINE_MAX_AREA,
+    RAINWAYS_QUEUE,
+    RAINWAYS_BATCH_MAX_FEATURES,
+    RAINWAYS_BATCH_INLINE_MAX_FEATURES
+)
 from ..common.models import TrwwApiResponseSchema
+from ..common.renderers import get_high_volume_renderer_classes
 
 # -------------------------------------------------------------------
 # API ROOT VIEW
@@ -31,44 +39,162 @@ class ApiDefaultRouter(routers.DefaultRouter):
 # -------------------------------------------------------------------
 # API Analytical Views
 
+def _aoi_analysis_job_response(request, jobid):
+    """status of a queued AOI analysis, and its results once finished
+    """
+    job = get_queue(RAINWAYS_QUEUE).fetch_job(jobid)
+    if job is None:
+        r = TrwwApiResponseSchema(
+            status_code=404,
+            status='failed',
+            messages=['The requested job {} does not exist.'.format(jobid)]
+        )
+        return Response(data=TrwwApiResponseSchema.Schema().dump(r), status=r.status_code)
+
+    job_meta = {"jobId": job.id, "jobUrl": request.build_absolute_uri()}
+    # one of [queued, started, deferred, finished, failed]
+    job_status = job.get_status()
+
+    if job.result:
+        # the job finished, but the analysis itself may not have succeeded
+        status = job.result.get('status', 'success')
+        meta = job.result['meta']
+        meta.update(job_meta)
+        meta['jobStatus'] = job_status
+        r = TrwwApiResponseSchema(
+            data=job.result['data'],
+            status_code=200 if status == 'success' else 500,
+            status=status,
+            messages=job.result['messages'],
+            meta=meta
+        )
+    elif job_status == 'failed':
+        r = TrwwApiResponseSchema(
+            status_code=500,
+            status=job_status,
+            messages=['The analysis failed.'],
+            meta=job_meta
+        )
+    else:
+        r = TrwwApiResponseSchema(status=job_status, meta=job_meta)
+
+    return Response(data=TrwwApiResponseSchema.Schema().dump(r), status=r.status_code)
+
+
+def _bad_request(request, message):
+    r = TrwwApiResponseSchema(
+        args=request.data,
+        status_code=400, 
+        status='failed', 
+        messages=[message]
+    )
+    return Response(
+        data=TrwwApiResponseSchema.Schema().dump(r),
+        status=r.status_code
+    )
+
+
+def _queue_analysis(request, analyze, analysis):
+    """queue an analysis, and respond with the URL of the job
+    """
+    job = get_queue(RAINWAYS_QUEUE).enqueue(analyze, analysis.aoi_geojson)
+    r = TrwwApiResponseSchema(
+        status=job.get_status(),
+        messages=['running job {0}'.format(job.id)],
+        meta={
+            "count": len(analysis.aoi_gdf.index),
+            "jobId": job.id,
+            "jobUrl": "{0}{1}/".format(request.build_absolute_uri(request.path), job.id)
+        }
+    )
+    return Response(data=TrwwApiResponseSchema.Schema().dump(r), status=r.status_code)
+
+
+def _analysis_response(analysis, summary, cache_key):
+    """respond with the results of an analysis, running it first if they
+    weren't cached
+    """
+    if summary is None:
+        analysis.run()
+        summary = analysis.summary()
+        analysis.cache_summary(summary, cache_key)
+
+    status = summary.get('status', 'success')
+    r = TrwwApiResponseSchema(
+        # args={"geojson": analysis.aoi_geojson},
+        data=summary['data'], # response schema expects a dictionary here.
+        status_code=200 if status == 'success' else 500, 
+        status=status, 
+        messages=summary['messages'],
+        meta=summary['meta']
+    )
+    return Response(data=TrwwApiResponseSchema.Schema().dump(r), status=r.status_code)
+
+
 @api_view(['GET'])
-def rainways_area_of_interest_analysis(request):
+@renderer_classes(get_high_volume_renderer_classes())
+def rainways_area_of_interest_analysis(request, jobid=None):
     """
     Given a GeoJSON, this returns summary statistics for intersecting layers of interest.
     
     This endpoint is used primarily for the public-facing Rainways web app.
+
+    Large AOIs (or any AOI, with `?async=true`) are analyzed as a queued job:
+    the response includes a `jobUrl` in its meta, which returns the status of 
+    the job and the results once it has finished.
     """
 
+    if jobid is not None:
+        return _aoi_analysis_job_response(request, jobid)
+
     # handle malformed data in request here:
     if 'geojson' not in request.data.keys():
+        return _bad_request(request, 'Include geojson in `geojson` object within the submitted json')
 
-        r = TrwwApiResponseSchema(
-            args=request.data,
-            status_code=400, 
-            status='failed', 
-            messages=['Include geojson in `geojson` object within the submitted json']
-        )
-        return Response(
-            data=TrwwApiResponseSchema.Schema().dump(r),
-            status=r.status_code
-        )
+    analysis = RwPublicAnalysis(request.data['geojson'])
 
+    # the same AOI may have been analyzed already
+    cache_key = analysis.result_cache_key()
+    summary = analysis.get_cached_summary(cache_key)
 
-    # conduct analysis
-    analysis = RwPublicAnalysis(request.data['geojson'])
-    
-    analysis.slope_summary()
-    analysis.soil_summary()
-    analysis.sustain_summary()
-    analysis.rainfall_summary()
+    # queue the analysis of large AOIs, so they don't hold up a web worker
+    run_async = str(request.query_params.get('async', '')).lower() in ['true', '1', 'yes']
+    if summary is None and (run_async or analysis.aoi_area() > RAINWAYS_INLINE_MAX_AREA):
+        return _queue_analysis(request, analyze_aoi, analysis)
 
-    r = TrwwApiResponseSchema(
-        # args={"geojson": analysis.aoi_geojson},
-        data=RwPublicResult.Schema().dump(analysis.results), # response schema expects a dictionary here.
-        status_code=200, 
-        status='success', 
-        messages=analysis.messages,
-        meta={"count": len(analysis.aoi_gdf.index)}
-    )
+    return _analysis_response(analysis, summary, cache_key)
+
+
+@api_view(['GET', 'POST'])
+@renderer_classes(get_high_volume_renderer_classes())
+def rainways_batch_analysis(request, jobid=None):
+    """
+    Given a GeoJSON FeatureCollection (e.g., of sewersheds), this returns the 
+    same summary statistics as the AOI analysis for each feature.
+
+    Each layer is fetched and processed once for all of the features. More 
+    than a few features (or any number, with `?async=true`) are analyzed as a
+    queued job: the response includes a `jobUrl` in its meta, which returns 
+    the status of the job and the results once it has finished.
+    """
+
+    if jobid is not None:
+        return _aoi_analysis_job_response(request, jobid)
+
+    geojson = request.data.get('geojson')
+    if not geojson or not geojson.get('features'):
+        return _bad_request(request, 'Include a GeoJSON FeatureCollection in a `geojson` object within the submitted json')
+    if len(geojson['features']) > RAINWAYS_BATCH_MAX_FEATURES:
+        return _bad_request(request, 'Include at most {0} features in the FeatureCollection'.format(RAINWAYS_BATCH_MAX_FEATURES))
+
+    analysis = RwBatchAnalysis(geojson)
+
+    cache_key = analysis.result_cache_key()
+    summary = analysis.get_cached_summary(cache_key)
+
+    run_async = str(request.query_params.get('async', '')).lower() in ['true', '1', 'yes']
+    too_big = len(analysis.aoi_gdf.index) > RAINWAYS_BATCH_INLINE_MAX_FEATURES or analysis.aoi_area() > RAINWAYS_INLINE_MAX_AREA
+    if summary is None and (run_async or too_big):
+        return _queue_analysis(request, analyze_aoi_batch, analysis)
 
-    return Response(data=TrwwApiResponseSchema.Schema().dump(r), status=r.status_code)
\ No newline at end of file
+    return _analysis_response(analysis, summary, cache_key)
@@ -0,0 +1,226 @@
+"""zonal statistics for the raster layers used in Rainways analysis.
+
+Layers are bands of rasters (see RAINWAYS_RASTER_LAYERS). Each raster is read
+once, for the window covering all of the zones, and every layer in it is
+summarized for every zone from that one read.
+
+Large zones can instead use summaries precomputed for grid cells (see
+`services.summarize_raster_cells`): cells that fall entirely within the zone
+are combined from their moments and histograms, and only the rest of the
+zone, along its boundary, is read from the raster.
+"""
+
+from collections import defaultdict
+
+import numpy as np
+import geopandas as gpd
+from shapely import wkb
+from rasterio import mask as rasterio_mask
+from rasterio.features import geometry_mask
+from django.contrib.gis.geos import GEOSGeometry
+
+from ..common.config import (
+    RAINWAYS_DEFAULT_CRS,
+    RAINWAYS_RASTER_LAYERS,
+    RAINWAYS_ZONAL_PERCENTILES,
+    RAINWAYS_ZONAL_HISTOGRAM_BINS,
+    RAINWAYS_CELL_HISTOGRAM_BINS,
+    RAINWAYS_CELL_SUMMARY_MIN_AREA
+)
+from .rasters import raster_pool
+from .selectors import get_precomputed_cells
+
+
+def summarize_values(
+    values: np.ndarray,
+    percentiles=RAINWAYS_ZONAL_PERCENTILES,
+    bins=RAINWAYS_ZONAL_HISTOGRAM_BINS
+    ) -> dict:
+    """summary statistics for a 1-D array of (valid) values
+
+    :return: count, min, max, avg, std, percentiles and histogram; all but the
+        count are None when there are no values
+    :rtype: dict
+    """
+    values = np.asarray(values, dtype='float64')
+    if values.size == 0:
+        return dict(count=0, min=None, max=None, avg=None, std=None, percentiles=None, histogram=None)
+
+    counts, edges = np.histogram(values, bins=bins)
+    return dict(
+        count=int(values.size),
+        min=float(values.min()),
+        max=float(values.max()),
+        avg=float(values.mean()),
+        std=float(values.std()),
+        percentiles={
+            str(p): float(v)
+            for p, v in zip(percentiles, np.percentile(values, percentiles))
+        },
+        histogram=dict(counts=counts.tolist(), edges=edges.tolist())
+    )
+
+
+def histogram_edges(value_range, bins=RAINWAYS_CELL_HISTOGRAM_BINS):
+    return np.linspace(value_range[0], value_range[1], bins + 1)
+
+
+def value_moments(values: np.ndarray, value_range, bins=RAINWAYS_CELL_HISTOGRAM_BINS) -> dict:
+    """the parts of a summary that can be combined across zones: count, sum,
+    sum of squares, min, max, and a histogram over a fixed range (values
+    outside the range are counted in the end bins)
+    """
+    values = np.asarray(values, dtype='float64')
+    counts, _ = np.histogram(
+        np.clip(values, value_range[0], value_range[1]),
+        bins=histogram_edges(value_range, bins)
+    )
+    return dict(
+        count=int(values.size),
+        sum=float(values.sum()),
+        sum_sq=float(np.square(values).sum()),
+        min=float(values.min()) if values.size else None,
+        max=float(values.max()) if values.size else None,
+        histogram=counts.tolist()
+    )
+
+
+def combine_moments(moments: list) -> dict:
+    mins = [m['min'] for m in moments if m['count']]
+    maxs = [m['max'] for m in moments if m['count']]
+    return dict(
+        count=sum(m['count'] for m in moments),
+        sum=sum(m['sum'] for m in moments),
+        sum_sq=sum(m['sum_sq'] for m in moments),
+        min=min(mins) if mins else None,
+        max=max(maxs) if maxs else None,
+        histogram=np.sum([m['histogram'] for m in moments], axis=0).tolist()
+    )
+
+
+def summarize_moments(
+    moments: dict,
+    value_range,
+    percentiles=RAINWAYS_ZONAL_PERCENTILES,
+    bins=RAINWAYS_ZONAL_HISTOGRAM_BINS
+    ) -> dict:
+    """summary statistics (as from `summarize_values`) from combined moments.
+    Percentiles are interpolated from the histogram, and the histogram is
+    over the layer's range rather than the range of the values.
+    """
+    count = moments['count']
+    if count == 0:
+        return summarize_values([])
+
+    avg = moments['sum'] / count
+    std = np.sqrt(max(moments['sum_sq'] / count - avg ** 2, 0))
+
+    counts = np.asarray(moments['histogram'])
+    edges = histogram_edges(value_range, len(counts))
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    at = np.interp(np.asarray(percentiles) / 100 * count, cumulative, edges)
+
+    if len(counts) % bins == 0:
+        edges = edges[::len(counts) // bins]
+        counts = counts.reshape(bins, -1).sum(axis=1)
+
+    return dict(
+        count=int(count),
+        min=moments['min'],
+        max=moments['max'],
+        avg=float(avg),
+        std=float(std),
+        percentiles={
+            str(p): float(np.clip(v, moments['min'], moments['max']))
+            for p, v in zip(percentiles, at)
+        },
+        histogram=dict(counts=counts.tolist(), edges=edges.tolist())
+    )
+
+
+def zone_values(zones_gdf: gpd.GeoDataFrame, layers: list) -> dict:
+    """the valid values of each layer within each zone (row) of a
+    geodataframe, reading each raster once. Empty zones have no values.
+
+    :return: for each layer, a list with an array of values for each zone
+    :rtype: dict
+    """
+    # group the layers by the raster they are in, so each is read once
+    by_raster = defaultdict(list)
+    for name in layers:
+        layer = RAINWAYS_RASTER_LAYERS[name]
+        by_raster[layer['href']].append((name, layer.get('band', 1)))
+
+    results = {name: [np.array([])] * len(zones_gdf) for name in layers}
+    present = [i for i, g in enumerate(zones_gdf.geometry) if g is not None and not g.is_empty]
+    if not present:
+        return results
+
+    for href, bands in by_raster.items():
+        with raster_pool.dataset(href) as src:
+            zones = zones_gdf if zones_gdf.crs.is_exact_same(src.crs) else zones_gdf.to_crs(src.crs)
+            shapes = [zones.geometry.iloc[i] for i in present]
+            # the window covering all of the zones
+            _, _, window = rasterio_mask.raster_geometry_mask(src, shapes, crop=True)
+            arr = src.read([b for _, b in bands], window=window, masked=True)
+            transform = src.window_transform(window)
+
+        valid = ~np.ma.getmaskarray(arr)
+        for zone, shape in zip(present, shapes):
+            inside = ~geometry_mask([shape], out_shape=arr.shape[1:], transform=transform)
+            for i, (name, _) in enumerate(bands):
+                results[name][zone] = arr.data[i][inside & valid[i]]
+
+    return results
+
+
+def zonal_stats(zones_gdf: gpd.GeoDataFrame, layers=None, precomputed=False, **kwargs) -> dict:
+    """summarize raster layers for each zone (row) of a geodataframe.
+
+    :param zones_gdf: polygons to summarize the layers for, in any CRS
+    :type zones_gdf: gpd.GeoDataFrame
+    :param layers: names of layers in RAINWAYS_RASTER_LAYERS (defaults to all)
+    :type layers: list, optional
+    :param precomputed: use precomputed cell summaries for large zones, if
+        all of the layers have them
+    :type precomputed: bool, optional
+    :param kwargs: passed on to `summarize_values` and `summarize_moments`
+    :return: for each layer, a list with the summary for each zone in order
+    :rtype: dict
+    """
+    layers = layers or list(RAINWAYS_RASTER_LAYERS.keys())
+
+    # for each zone, the moments of the precomputed cells within it
+    cells = [None] * len(zones_gdf)
+    if precomputed and all('range' in RAINWAYS_RASTER_LAYERS[l] for l in layers):
+        zones_gdf = zones_gdf.to_crs(epsg=RAINWAYS_DEFAULT_CRS)
+        remainders = list(zones_gdf.geometry)
+        for i, shape in enumerate(zones_gdf.geometry):
+            if shape.area < RAINWAYS_CELL_SUMMARY_MIN_AREA:
+                continue
+            summaries, remainder = get_precomputed_cells(
+                GEOSGeometry(memoryview(shape.wkb), srid=RAINWAYS_DEFAULT_CRS),
+                layers
+            )
+            if summaries:
+                cells[i] = summaries
+                remainders[i] = wkb.loads(bytes(remainder.wkb)) if not remainder.empty else None
+        # only what isn't covered by cells is read from the rasters
+        zones_gdf = gpd.GeoDataFrame(geometry=remainders, crs=zones_gdf.crs)
+
+    values = zone_values(zones_gdf, layers)
+
+    results = {}
+    for name in layers:
+        results[name] = []
+        for zone_cells, zone_values_ in zip(cells, values[name]):
+            if zone_cells is None:
+                results[name].append(summarize_values(zone_values_, **kwargs))
+                continue
+            value_range = RAINWAYS_RASTER_LAYERS[name]['range']
+            moments = combine_moments(
+                zone_cells[name] + [value_moments(zone_values_, value_range)]
+            )
+            results[name].append(summarize_moments(moments, value_range, **kwargs))
+
+    return results
@@ -71,6 +71,7 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'trwwapi.common.middleware.CompressionMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -205,6 +206,29 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema'
 }
 
+# Renderers used by the high-volume routes (the high-level rainfall API and 
+# Rainways analysis endpoints). FastJSONRenderer uses orjson if available.
+# Set HIGH_VOLUME_BROWSABLE_API=False in the environment to only serve JSON from
+# those routes.
+HIGH_VOLUME_BROWSABLE_API = os.getenv('HIGH_VOLUME_BROWSABLE_API', 'true').lower() in ['true', '1', 'yes']
+HIGH_VOLUME_RENDERER_CLASSES = [
+    'trwwapi.common.renderers.FastJSONRenderer'
+]
+if HIGH_VOLUME_BROWSABLE_API:
+    HIGH_VOLUME_RENDERER_CLASSES.append('rest_framework.renderers.BrowsableAPIRenderer')
+
+# Run a listener thread in each gunicorn web worker (see gunicorn.conf.py) that 
+# picks up notifications from the observation tables when data changes, so 
+# per-process caches can be invalidated. Each 
+# listener holds a database connection open.
+OBSERVATION_LISTENER_ENABLED = os.getenv('OBSERVATION_LISTENER_ENABLED', 'false').lower() in ['true', '1', 'yes']
+
+# GDAL caches used when reading rasters (e.g., COGs on S3) for Rainways 
+# analysis: the raster block cache, in MB, and the cache of bytes fetched from
+# remote files, in MB. Both are per process.
+RAINWAYS_GDAL_CACHEMAX = int(os.getenv('RAINWAYS_GDAL_CACHEMAX', 256))
+RAINWAYS_VSI_CACHE_SIZE = int(os.getenv('RAINWAYS_VSI_CACHE_SIZE', 64))
+
 SPECTACULAR_SETTINGS = {
     'TITLE': '3RWW Rainfall API',
     'DESCRIPTION': 'Get 3RWW high-resolution rainfall data',
@@ -225,6 +249,11 @@ RQ_QUEUES = {
     'default': {
         'URL': os.getenv('REDIS_URL', 'redis://redis:6379/0'),
         'DEFAULT_TIMEOUT': 900,
+    },
+    # rainfall requests the planner expects to be expensive
+    'large': {
+        'URL': os.getenv('REDIS_URL', 'redis://redis:6379/0'),
+        'DEFAULT_TIMEOUT': 3600,
     }
 }
 